@@ -0,0 +1,670 @@
+#!/bin/python3
+# Microbenchmarks for the proof of concept server
+# Usage: python3 benchmark.py [benchmark name...]
+import importlib.util, os, sys, time, json, random, tempfile, socket, multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Condition, Thread
+from queue import Queue
+
+# Load the server as a module, since its file name isn't a valid module name
+def loadServer():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proof-of-concept-server.py")
+  spec = importlib.util.spec_from_file_location("server", path)
+  module = importlib.util.module_from_spec(spec)
+  # Register it, so worker processes can find its functions
+  sys.modules["server"] = module
+  spec.loader.exec_module(module)
+  return module
+
+server = loadServer()
+
+
+# Chat queue as it was before the ring buffer, kept here for comparison
+class ListChatQueue():
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.queue = []
+    self.message_id = 0
+    self.oldest_message_id = 0
+    self.lock = Condition()
+
+  def addMessages(self, msg_list):
+    with self.lock:
+      for msg in msg_list:
+        while len(self.queue) >= self.capacity:
+          self.queue.remove(self.queue[0])
+          self.oldest_message_id += 1
+        msg_for_queue = msg.copy()
+        msg_for_queue["timestamp"] = int(time.time())
+        msg_for_queue["mid"] = self.message_id
+        self.queue.append(msg_for_queue)
+        self.message_id += 1
+      self.lock.notify_all()
+
+  def _posOfMID(self, message_id):
+    if message_id < self.oldest_message_id:
+      return -1
+    elif message_id >= self.message_id:
+      return None
+    else:
+      return message_id - self.oldest_message_id
+
+  def getNewMessages(self, message_id=None, timeout=None):
+    with self.lock:
+      if message_id == None or message_id < -1 or message_id >= self.message_id:
+        message_id = self.message_id - 1
+      if self._posOfMID(message_id + 1) == None or len(self.queue) == 0:
+        if not self.lock.wait(timeout):
+          return []
+      start_from = self._posOfMID(message_id) + 1
+      new_messages = []
+      for i in range(start_from, len(self.queue)):
+        new_messages.append(self.queue[i])
+      return new_messages
+
+
+# Socket IO wrapper as it was before the preallocated receive buffer, kept here for comparison
+class BytesSocketIOWrapper():
+  def __init__(self, sock):
+    self._sock = sock
+    self._receive_buffer = b""
+    self.incoming_message_queue = Queue()
+    self.connection_open = True
+
+  def receive(self):
+    if self.connection_open:
+      chunk = self._sock.recv(4096)
+      if len(chunk) == 0:
+        self.connection_open = False
+      self._receive_buffer += chunk
+      eol = self._receive_buffer.find(b'\r\n')
+      while eol != -1:
+        self.incoming_message_queue.put(self._receive_buffer[:eol+2].decode('utf-8'))
+        self._receive_buffer = self._receive_buffer[eol+2:]
+        eol = self._receive_buffer.find(b'\r\n')
+
+
+# IRC message parser as it was before lazy tag parsing, kept here for comparison
+class EagerIRCMessage():
+  def __init__(self, raw_message):
+    # Check for correct type
+    if type(raw_message) != str:
+      raise TypeError("Message must be a string")
+
+    tags_segment = None
+    prefix_segment = None
+    command_segment = None
+    params_segment = None
+    start = 0
+    end = 0
+
+    self.tags = None
+    self.nickname = None
+    self.username = None
+    self.server = None
+    self.command = []
+    self.params = None
+
+    # Get tags, if any
+    if raw_message[start] == '@':
+      end = raw_message.find(' ', start)
+      if end == -1:
+        raise ValueError("Invalid IRC command syntax: End of tags section is missing")
+      tags_segment = raw_message[start+1:end]
+      start = end + 1
+
+      # Parse tags
+      self.tags = {}
+      for tag in tags_segment.split(';'):
+        separator = tag.find('=')
+        if separator == -1:
+          # Key with no value
+          self.tags[tag] = None
+        else:
+          # Key with value
+          key = tag[:separator]
+          value = tag[separator+1:]
+          # Convert escape codes
+          value = value.replace('\\:', ';')\
+                       .replace('\\s', ' ')\
+                       .replace('\\\\', '\\')\
+                       .replace('\\r', '\r')\
+                       .replace('\\n', '\n')
+          self.tags[key] = value
+
+    # Get prefix, if defined
+    if raw_message[start] == ':':
+      end = raw_message.find(' ', start)
+      if end == -1:
+        raise ValueError("Invalid IRC command syntax: End of prefix section is missing")
+      prefix_segment = raw_message[start+1:end]
+      start = end + 1
+
+      # Parse prefix
+      user_start = prefix_segment.find('!')
+      host_start = prefix_segment.find('@')
+      if user_start == host_start == -1:
+        self.server = prefix_segment
+      else:
+        if user_start == -1:    # username not defined, so host is defined
+          self.nickname = prefix_segment[:host_start]
+          self.server = prefix_segment[host_start+1:]
+        else:                   # username defined
+          self.nickname = prefix_segment[:user_start]
+          if host_start == -1:  # but host not defined
+            self.username = prefix_segment[user_start+1:]
+          else:                 # all 3 defined
+            self.username = prefix_segment[user_start+1:host_start]
+            self.server = prefix_segment[host_start+1:]
+
+    # Get command, channel and acknowledgement
+    # There are either parameters or the end of line after the command segment
+    end = raw_message.find(':', start)
+    if end == -1:
+      end = raw_message.find('\r\n', start)
+    if end == -1:
+      raise ValueError("Invalid IRC command syntax: End of message not found")
+    command_segment = raw_message[start:end-1]
+    start = end
+    self.command = command_segment.split(' ')
+
+    # Get parameters, if any
+    if raw_message[start] == ':':
+      end = raw_message.find('\r\n', start)
+      if end == -1:
+        raise ValueError("Invalid IRC command syntax: End of message not found")
+      params_segment = raw_message[start+1:end]
+      self.params = params_segment
+
+
+
+# Socket that replays recorded data instead of talking to a server
+class ReplaySocket():
+  def __init__(self, data):
+    self.data = data
+    self.pos = 0
+
+  def recv(self, size):
+    chunk = self.data[self.pos:self.pos+size]
+    self.pos += len(chunk)
+    return chunk
+
+  def recv_into(self, buffer, size):
+    chunk = self.data[self.pos:self.pos+size]
+    buffer[:len(chunk)] = chunk
+    self.pos += len(chunk)
+    return len(chunk)
+
+
+# Generates real-looking Twitch PRIVMSG lines
+def twitchChatCorpus(count, seed=1234):
+  rng = random.Random(seed)
+  words = ["LUL", "KEKW", "Kappa", "PogChamp", "gg", "lets", "go", "what", "was", "that", "monkaS", "OMEGALUL", "nice", "play", "chat", "is", "this", "real", "o7", "Pog"]
+  badges = ["", "subscriber/12,premium/1", "moderator/1,subscriber/3", "vip/1,bits/1000", "broadcaster/1,subscriber/0", "premium/1"]
+  lines = []
+  for i in range(count):
+    user = f"chatter_{rng.randrange(2000)}"
+    text = " ".join(rng.choice(words) for j in range(rng.randrange(1, 14)))
+    emotes = "25:0-4" if text.startswith("Kappa") else ""
+    tags = ";".join([
+      f"badge-info=subscriber/{rng.randrange(40)}", f"badges={rng.choice(badges)}",
+      f"client-nonce={rng.getrandbits(128):032x}", f"color=#{rng.getrandbits(24):06X}" if rng.random() < 0.8 else "color=",
+      f"display-name={user.capitalize()}", f"emotes={emotes}", "first-msg=0", "flags=",
+      f"id={rng.getrandbits(128):032x}", "mod=0", "returning-chatter=0", "room-id=123456789", "subscriber=1",
+      f"tmi-sent-ts={1700000000000 + i * 37}", "turbo=0", f"user-id={rng.randrange(10**8)}", "user-type=",
+    ] + (["reply-parent-display-name=Someone", "reply-parent-msg-body=what\\sdid\\syou\\ssay?"] if rng.random() < 0.1 else []))
+    lines.append(f"@{tags} :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #channel :{text}\r\n")
+  return lines
+
+
+# Runs func the given number of times and returns the average time per call in microseconds
+def timeit(func, count):
+  start = time.perf_counter()
+  for i in range(count):
+    func(i)
+  return (time.perf_counter() - start) / count * 1e6
+
+
+# Appends to a full queue (so every append evicts) and reads the last few messages
+def benchmarkChatQueue():
+  msg = {"user": "benchmark", "user_color": "#FF0000", "message": "Kappa 123", "badges": [], "emotes": []}
+  # Keep the expiry thread of the ring buffer queue asleep
+  server.QUEUE_MSG_TIMEOUT = 3600
+  print("Chat queue: append with eviction / read last 10 messages (µs per call)")
+  for capacity in [10000, 30000, 100000]:
+    results = []
+    for name, queue_class in [("list", ListChatQueue), ("ring", server.ChatQueue)]:
+      queue = queue_class(capacity)
+      queue.addMessages([msg] * capacity)
+      append_time = timeit(lambda i: queue.addMessages([msg]), 2000)
+      read_time = timeit(lambda i: queue.getNewMessages(queue.message_id - 11, timeout=0), 2000)
+      results.append(f"{name}: {append_time:8.2f} / {read_time:8.2f}")
+    print(f"  {capacity:6} messages   " + "   ".join(results))
+
+
+# Builds a get-messages response by encoding the messages on every poll vs joining pre-encoded ones
+def benchmarkResponseEncoding():
+  msg = {
+    "user": "benchmark", "user_color": "#FF0000", "message": "Kappa hello chat PogChamp",
+    "badges": [server.twitchGetEmoteInfo("1")], "emotes": [{"start": 0, "end": 5, "scales": server.twitchGetEmoteInfo("25")}]
+  }
+  server.QUEUE_MSG_TIMEOUT = 3600
+  print("get-messages response body (µs per poll)")
+  for count in [1, 35, 500]:
+    queue = server.ChatQueue(count)
+    queue.addMessages([msg] * count)
+    per_poll_time = timeit(lambda i: json.dumps({"sid": server.SESSION_ID, "messages": queue.getNewMessages(-1, timeout=0)}).encode('utf-8'), 500)
+    cached_time = timeit(lambda i: server.encodeMessagesResponse(server.SESSION_ID, queue.getNewMessagesEncoded(-1, timeout=0)), 500)
+    print(f"  {count:6} messages   json.dumps per poll: {per_poll_time:8.2f}   pre-encoded: {cached_time:8.2f}")
+
+
+# Splits a recorded burst of chat into lines, with the old and the new socket wrapper
+def benchmarkIRCFraming():
+  data = "".join(twitchChatCorpus(20000)).encode('utf-8')
+  print("IRC receive framing (lines per second)")
+
+  start = time.perf_counter()
+  wrapper = BytesSocketIOWrapper(ReplaySocket(data))
+  lines = 0
+  while wrapper.connection_open:
+    wrapper.receive()
+    while not wrapper.incoming_message_queue.empty():
+      wrapper.incoming_message_queue.get()
+      lines += 1
+  old_rate = lines / (time.perf_counter() - start)
+
+  results = []
+  for read_size in [4096, 65536]:
+    start = time.perf_counter()
+    wrapper = server.SocketIOWrapper(ReplaySocket(data), read_size)
+    lines = 0
+    while wrapper.connection_open:
+      lines += len(wrapper.receive())
+    results.append(f"bytearray ({read_size} byte reads): {lines / (time.perf_counter() - start):10.0f}")
+  print(f"  bytes + Queue (4096 byte reads): {old_rate:10.0f}   " + "   ".join(results))
+
+
+# Parses chat lines and reads the tags the PRIVMSG handler uses, with the old and the new parser
+def benchmarkIRCParser():
+  lines = twitchChatCorpus(50000)
+  print("IRC message parser (messages per second)")
+
+  def parseAll(parser_class):
+    start = time.perf_counter()
+    for line in lines:
+      message = parser_class(line)
+      tags = message.tags
+      if message.command[0] == "PRIVMSG":
+        "color" in tags and tags["color"]
+        "display-name" in tags and tags["display-name"]
+        "reply-parent-display-name" in tags and tags["reply-parent-display-name"] and tags["reply-parent-msg-body"]
+        "badges" in tags and tags["badges"]
+        "emotes" in tags and tags["emotes"]
+    return len(lines) / (time.perf_counter() - start)
+
+  print(f"  eager tags: {parseAll(EagerIRCMessage):10.0f}   lazy tags: {parseAll(server.parsedIRCMessage):10.0f}")
+
+
+# Stand-in for the Twitch and BetterTTV APIs, answering each request after a delay, with ETags
+class StubAPIHandler(BaseHTTPRequestHandler):
+  latency = 0.1
+  requests_handled = 0
+  responses = {
+    "/validate": {"client_id": "stub", "login": "stubuser", "user_id": "1", "scopes": ["chat:read"]},
+    "/helix/users": {"data": [{"id": "2"}]},
+    "/helix/chat/badges/global": {"data": [{"set_id": "premium", "versions": [
+      {"id": "1", "image_url_1x": "p1", "image_url_2x": "p2", "image_url_4x": "p4"}]}]},
+    "/helix/chat/badges": {"data": [{"set_id": "subscriber", "versions": [
+      {"id": str(months), "image_url_1x": f"s{months}", "image_url_2x": f"s{months}x2", "image_url_4x": f"s{months}x4"} for months in range(24)]}]},
+    "/bttv/global": [{"code": f"global{i}", "id": f"g{i}"} for i in range(100)],
+    "/bttv/users/2": {"sharedEmotes": [{"code": f"channel{i}", "id": f"c{i}"} for i in range(50)]},
+  }
+
+  def do_GET(self):
+    time.sleep(self.latency)
+    StubAPIHandler.requests_handled += 1
+    path = self.path.split('?')[0]
+    body = json.dumps(self.responses[path]).encode('utf-8')
+    etag = f'"{hash(body)}"'
+    if self.headers.get("If-None-Match") == etag:
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("ETag", etag)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+# Starts the stub API, and points the server's API endpoints at it
+def startStubAPI():
+  stub = ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+  Thread(target=stub.serve_forever, daemon=True).start()
+  base = f"http://127.0.0.1:{stub.server_address[1]}"
+  server.TWITCH_VALIDATE_URL = base + "/validate"
+  server.TWITCH_USERS_URL = base + "/helix/users"
+  server.TWITCH_GLOBAL_BADGES_URL = base + "/helix/chat/badges/global"
+  server.TWITCH_CHANNEL_BADGES_URL = base + "/helix/chat/badges"
+  server.BTTV_GLOBAL_EMOTES_URL = base + "/bttv/global"
+  server.BTTV_CHANNEL_EMOTES_URL = base + "/bttv/users/{}"
+  server.OAUTH_TOKEN = "stub"
+  server.api_session = server.createAPISession()
+  return stub
+
+
+# Gets chat badges and emotes from a stub API with a cold cache, a warm cache, and an expired cache
+def benchmarkBootstrap():
+  stub = startStubAPI()
+  server.log.configure("warning", 1000, "summarize")
+  print(f"Twitch/BTTV bootstrap ({StubAPIHandler.latency * 1000:.0f} ms per API request)")
+  with tempfile.TemporaryDirectory() as cache_dir:
+    cache_path = os.path.join(cache_dir, "api-cache.json")
+    for name, ttl, max_age in [("cold cache", 3600, float('inf')), ("warm cache", 3600, float('inf')), ("expired cache, revalidated", 0, None)]:
+      server.api_cache = server.APICache(cache_path, ttl)
+      StubAPIHandler.requests_handled = 0
+      start = time.perf_counter()
+      tables = server.twitchBootstrap(["stubchannel"], max_age)
+      assert type(tables) != int
+      print(f"  {name:28} {(time.perf_counter() - start) * 1000:8.1f} ms   {StubAPIHandler.requests_handled} requests")
+  server.log.flush()
+  stub.shutdown()
+
+
+# Stand-in for the Twitch IRC server, sending a burst of chat to the channels each connection joins
+class StubIRCHandler(StreamRequestHandler):
+  corpus = []
+
+  def handle(self):
+    self.wfile.write(b":tmi.twitch.tv 001 stubuser :Welcome, GLHF!\r\n")
+    for line in self.rfile:
+      if line.startswith(b"CAP REQ"):
+        self.wfile.write(b":tmi.twitch.tv CAP * ACK :" + line.partition(b":")[2].strip() + b"\r\n")
+      elif line.startswith(b"JOIN "):
+        channels = line[5:].strip().split(b',')
+        # Spread the burst over the joined channels
+        burst = b"".join([self.corpus[i].replace(b"#channel", channels[i % len(channels)]) for i in range(len(self.corpus))])
+        self.wfile.write(burst)
+
+
+# Runs the stub IRC server in its own process, so it doesn't compete with the server for the GIL
+def runStubIRC(port_queue, corpus):
+  StubIRCHandler.corpus = corpus
+  ThreadingTCPServer.daemon_threads = True
+  stub = ThreadingTCPServer(('127.0.0.1', 0), StubIRCHandler)
+  port_queue.put(stub.server_address[1])
+  stub.serve_forever()
+
+
+# Socket wrapper for the stub IRC server, which doesn't use TLS
+class PlainSocketContext():
+  def wrap_socket(self, sock, server_hostname=None):
+    return sock
+
+
+# Sends bursts of chat to 8 channels, handled by 1 to 4 IRC worker processes in supervisor mode
+def benchmarkIRCSharding():
+  channel_count = 8
+  messages_per_worker = 40000
+  stub_api = startStubAPI()
+  StubAPIHandler.latency = 0
+  server.api_cache = server.APICache(None, 3600)
+  server.log.configure("error", 1000, "summarize")
+  server.ssl.create_default_context = PlainSocketContext
+  server.QUEUE_MSG_TIMEOUT = 3600
+  server.QUEUE_MSG_COUNT_LIMIT = 10000
+  server.TABLE_REFRESH_INTERVAL = 0
+  server.CHANNELS = [f"channel{i}" for i in range(channel_count)]
+  print(f"IRC supervisor mode, {channel_count} channels (messages per second, {os.cpu_count()} CPUs)")
+  for worker_count in [1, 2, 4]:
+    port_queue = multiprocessing.Queue()
+    corpus = [line.encode('utf-8') for line in twitchChatCorpus(messages_per_worker)]
+    stub_irc = multiprocessing.Process(target=runStubIRC, args=(port_queue, corpus), daemon=True)
+    stub_irc.start()
+    server.IRC_SERVER = '127.0.0.1'
+    server.IRC_PORT = port_queue.get()
+    server.IRC_WORKERS = worker_count
+    server.chat_channels = {name: server.ChatChannel(name) for name in server.CHANNELS}
+    supervisor = server.IRCSupervisor(server.assignChannelsToWorkers(server.CHANNELS, worker_count, {}))
+    supervisor_thread = Thread(target=supervisor.run)
+    start = time.perf_counter()
+    supervisor_thread.start()
+    # Every worker's connection gets its own burst
+    expected = messages_per_worker * worker_count
+    received = 0
+    while received < expected and time.perf_counter() - start < 120:
+      time.sleep(0.01)
+      received = sum([channel.queue.message_id for channel in server.chat_channels.values()])
+    duration = time.perf_counter() - start
+    supervisor.stop()
+    supervisor_thread.join()
+    stub_irc.terminate()
+    print(f"  {worker_count} workers: {received / duration:10.0f}   ({received} messages in {duration:.2f} s, including startup)")
+  server.log.flush()
+  stub_api.shutdown()
+
+
+# Waits for messages and sends back how long each took to arrive after it was added
+def measureWakeLatency(queue, count, connection):
+  latencies = []
+  message_id = None
+  while len(latencies) < count:
+    message_id, new_messages = queue.getNewEncodedBatch(message_id, timeout=5)
+    now = time.perf_counter()
+    latencies += [now - json.loads(encoded_msg)["sent"] for encoded_msg in new_messages]
+  connection.send(latencies)
+
+
+# Appends to a full queue and reads the last few messages with each queue backend,
+# and measures how long waiting readers take to get a message, in the same process for the memory backend and in another process for the shared one
+def benchmarkSharedQueue():
+  msg = {"user": "benchmark", "user_color": "#FF0000", "message": "Kappa 123", "badges": [], "emotes": []}
+  server.QUEUE_MSG_TIMEOUT = 3600
+  server.log.configure("error", 1000, "summarize")
+  print("Chat queue backends: append with eviction / read last 10 messages (µs per call)")
+  for capacity in [10000, 100000]:
+    results = []
+    for name, queue in [("memory", server.ChatQueue(capacity)), ("shared", server.SharedChatQueue(capacity, capacity * 256))]:
+      queue.addMessages([msg] * capacity)
+      append_time = timeit(lambda i: queue.addMessages([msg]), 2000)
+      read_time = timeit(lambda i: queue.getNewEncodedBatch(queue.message_id - 11, timeout=0), 2000)
+      results.append(f"{name}: {append_time:8.2f} / {read_time:8.2f}")
+      if name == "shared":
+        queue.close()
+    print(f"  {capacity:6} messages   " + "   ".join(results))
+  print("Waiting reader wake-up latency (ms, mean / max of 200 messages)")
+  for name, queue in [("memory, same process", server.ChatQueue(1000)), ("shared, other process", server.SharedChatQueue(1000, 1000 * 256))]:
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    if name[:6] == "memory":
+      reader = Thread(target=measureWakeLatency, args=(queue, 200, sender))
+    else:
+      reader = multiprocessing.Process(target=measureWakeLatency, args=(queue, 200, sender))
+    reader.start()
+    time.sleep(0.2)
+    for i in range(200):
+      queue.addMessages([dict(msg, sent=time.perf_counter())])
+      time.sleep(0.01)
+    latencies = receiver.recv()
+    reader.join()
+    if name[:6] == "shared":
+      queue.close()
+    print(f"  {name:22} {sum(latencies) / len(latencies) * 1000:6.2f} / {max(latencies) * 1000:6.2f}")
+  server.log.flush()
+
+
+# Waits for the messages after given message ID and builds a response from them, noting when that was done
+def waitAndRespond(queue, message_id, done_times):
+  if isinstance(queue, ListChatQueue):
+    # Each client encodes its own copy of the messages, as before batches were shared
+    server.encodeMessagesResponse(server.SESSION_ID, [json.dumps(msg).encode('utf-8') for msg in queue.getNewMessages(message_id, timeout=5)])
+  else:
+    queue.getNewBatch(message_id, timeout=5).response(server.messagesResponse)
+  done_times.append(time.perf_counter())
+
+
+# Measures how long each waiting client takes from a batch of messages being added until it has its response,
+# with all clients woken up by notify_all and building their own response, and with the clients sharing the batch of the message ID they wait for
+def benchmarkWaiterFanOut():
+  msg = {"user": "benchmark", "user_color": "#FF0000", "message": "Kappa hello chat PogChamp", "badges": [], "emotes": []}
+  server.QUEUE_MSG_TIMEOUT = 3600
+  print("Waiting clients fan-out, 10 new messages (ms until a client has its response: median / 90th percentile / last client)")
+  for waiter_count in [10, 100, 1000]:
+    results = []
+    for name, queue in [("notify_all", ListChatQueue(1000)), ("shared batches", server.ChatQueue(1000))]:
+      queue.addMessages([msg] * 100)
+      done_times = []
+      waiters = [Thread(target=waitAndRespond, args=(queue, queue.message_id - 1, done_times)) for i in range(waiter_count)]
+      for waiter in waiters:
+        waiter.start()
+      time.sleep(0.5)
+      start = time.perf_counter()
+      queue.addMessages([msg] * 10)
+      for waiter in waiters:
+        waiter.join()
+      latencies = sorted((done_time - start) * 1000 for done_time in done_times)
+      results.append(f"{name}: {latencies[len(latencies) // 2]:7.2f} / {latencies[len(latencies) * 9 // 10]:7.2f} / {latencies[-1]:7.2f}")
+    print(f"  {waiter_count:5} clients   " + "   ".join(results))
+
+
+# Long-polls a queue until the given number of messages arrived, and sends back the sizes of the responses and how long each message took to arrive after it was added
+# Without a policy, responds as soon as there are new messages, and sleeps 250 ms between polls like script.js did before batching
+def pollBatches(queue, count, policy, connection):
+  sizes = []
+  latencies = []
+  message_id = None
+  while len(latencies) < count:
+    if policy == None:
+      batch = queue.getNewBatch(message_id, timeout=5)
+    else:
+      batch = server.getCoalescedBatch(queue, message_id, 5, policy)
+    now = time.perf_counter()
+    message_id = batch.last_message_id
+    if len(batch.messages) > 0:
+      sizes.append(len(batch.messages))
+      latencies += [now - json.loads(encoded_msg)["sent"] for encoded_msg in batch.messages]
+    if policy == None:
+      time.sleep(0.25)
+  connection.send((sizes, latencies))
+
+
+# Feeds bursty chat (bursts of 40 messages in 200 ms, with single messages in between) to a long-polling client,
+# with and without batching on the server
+def benchmarkBatching():
+  msg = {"user": "benchmark", "user_color": "#FF0000", "message": "Kappa 123", "badges": [], "emotes": []}
+  server.QUEUE_MSG_TIMEOUT = 3600
+  print("Long-polling bursty chat (responses, mean batch size, mean / max latency in ms)")
+  for name, policy in [("250 ms client sleep", None), ("min 10, 250 ms delay", server.BatchPolicy({"batch_min": "10", "batch_delay": "250"})),
+                       ("min 20, 100 ms delay", server.BatchPolicy({"batch_min": "20", "batch_delay": "100"}))]:
+    queue = server.ChatQueue(1000)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    poller = Thread(target=pollBatches, args=(queue, 129, policy, sender))
+    poller.start()
+    time.sleep(0.2)
+    for burst in range(3):
+      for i in range(40):
+        queue.addMessages([dict(msg, sent=time.perf_counter())])
+        time.sleep(0.005)
+      for i in range(3):
+        time.sleep(0.3)
+        queue.addMessages([dict(msg, sent=time.perf_counter())])
+    sizes, latencies = receiver.recv()
+    poller.join()
+    print(f"  {name:22} {len(sizes):4}   {sum(sizes) / len(sizes):6.1f}   {sum(latencies) / len(latencies) * 1000:7.1f} / {max(latencies) * 1000:7.1f}")
+
+
+# Reconnects with a big backlog of messages, sending all of them vs only the ones the overlay has room for,
+# then floods a rate limited client with a raid, sending it a batch after every few messages
+def benchmarkLoadShedding():
+  msg = {
+    "user": "benchmark", "user_color": "#FF0000", "message": "Kappa hello chat PogChamp",
+    "badges": [server.twitchGetEmoteInfo("1")], "emotes": [{"start": 0, "end": 5, "scales": server.twitchGetEmoteInfo("25")}]
+  }
+  server.QUEUE_MSG_TIMEOUT = 3600
+  print("Reconnecting with a backlog (response bytes, µs per response)")
+  for count in [1000, 5000]:
+    queue = server.ChatQueue(count)
+    queue.addMessages([msg] * count)
+    results = []
+    for name, options in [("all", None), ("count_max=35", server.OverlayOptions())]:
+      if options != None:
+        options.updateFromQuery({"count_max": "35"})
+      # Build the response again for every reconnect, like the batch of a queue that keeps changing would be
+      build = lambda i: server.messagesResponse(queue.getNewBatch(-1, 0, options))
+      results.append(f"{name}: {len(build(0)):8} B {timeit(lambda i: (queue.ready_batches.clear(), build(i)), 200):8.1f}")
+    print(f"  {count:6} messages   " + "   ".join(results))
+  print("Raid of 1000 messages in 1 s, a batch every 5 messages (messages sent, µs per batch)")
+  queue = server.ChatQueue(1000)
+  for max_rate in [None, 10, 2]:
+    options = server.OverlayOptions()
+    options.updateFromQuery({"count_max": "35", "max_rate": str(max_rate)})
+    sampler = server.RateSampler()
+    sent, message_id, elapsed = 0, -1, 0
+    for i in range(200):
+      queue.addMessages([msg] * 5)
+      start = time.perf_counter()
+      batch = queue.getNewBatch(message_id, 0, options)
+      message_id = batch.last_message_id
+      response = server.clientResponse(batch, server.messagesResponse, options, sampler)
+      elapsed += time.perf_counter() - start
+      sent += len(json.loads(response)["messages"])
+      time.sleep(0.005)
+    print(f"  max_rate={str(max_rate):5}   {sent:5}   {elapsed / 200 * 1e6:8.1f}")
+
+
+# Sends batches of chat with a few badges and emotes each, with their image URLs in every message vs the compact format
+def benchmarkCompactFormat():
+  rng = random.Random(1234)
+  badges = [{scale: f"https://static-cdn.jtvnw.net/badges/v1/{rng.getrandbits(128):032x}/{scale}" for scale in [1, 2, 4]} for i in range(30)]
+  emotes = [server.twitchGetEmoteInfo(str(rng.randrange(10**6))) for i in range(50)]
+  server.QUEUE_MSG_TIMEOUT = 3600
+  queue = server.ChatQueue(1000)
+  queue.addMessages([{
+    "user": f"Chatter_{rng.randrange(2000)}", "user_color": f"#{rng.getrandbits(24):06X}", "message": "Kappa hello chat PogChamp",
+    "badges": rng.sample(badges, rng.randrange(3)), "emotes": [{"start": 0, "end": 5, "scales": rng.choice(emotes)}, {"start": 18, "end": 26, "scales": rng.choice(emotes)}]
+  } for i in range(1000)])
+  print("Batches of 35 messages (response bytes, µs per batch of messages encoded for the first time)")
+  for name, compact in [("full", False), ("compact", True)]:
+    options = server.OverlayOptions()
+    options.compact = compact
+    sizes = []
+    start = time.perf_counter()
+    for message_id in range(-1, 999 - 35, 35):
+      sizes.append(len(server.clientResponse(queue.getNewBatch(message_id, 0, options, 35), server.messagesResponse, options, server.RateSampler())))
+    elapsed = (time.perf_counter() - start) / len(sizes) * 1e6
+    print(f"  {name:8} first: {sizes[0]:6} B   later: {sum(sizes[1:]) / (len(sizes) - 1):8.0f} B   {elapsed:8.1f}")
+  # Full messages were encoded when they were added, which is what encoding them as compact ones is comparable to
+  messages = queue.getNewMessages(-1, timeout=0)
+  start = time.perf_counter()
+  for i in range(0, 999 - 35, 35):
+    [server.encodeEntry(msg) for msg in messages[i:i + 35]]
+  print(f"  full, encoded when added to the queue:         {(time.perf_counter() - start) / len(sizes) * 1e6:8.1f}")
+
+
+BENCHMARKS = {
+  "chat-queue": benchmarkChatQueue,
+  "response-encoding": benchmarkResponseEncoding,
+  "irc-framing": benchmarkIRCFraming,
+  "irc-parser": benchmarkIRCParser,
+  "bootstrap": benchmarkBootstrap,
+  "irc-sharding": benchmarkIRCSharding,
+  "shared-queue": benchmarkSharedQueue,
+  "waiter-fan-out": benchmarkWaiterFanOut,
+  "batching": benchmarkBatching,
+  "load-shedding": benchmarkLoadShedding,
+  "compact-format": benchmarkCompactFormat,
+}
+
+if __name__ == "__main__":
+  names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+  for name in names:
+    if not name in BENCHMARKS:
+      print(f"Unknown benchmark '{name}'. Available benchmarks are: {', '.join(BENCHMARKS)}")
+      exit(1)
+    BENCHMARKS[name]()
@@ -1,30 +1,195 @@
 #!/bin/python3
-import os, mimetypes, time, json, socket, sys, ssl, random, requests
+import os, signal, mimetypes, time, json, socket, select, sys, ssl, random, asyncio, base64, hashlib, struct, gzip, functools, itertools, mmap, pickle, bisect, requests
+import concurrent.futures, multiprocessing, multiprocessing.connection, multiprocessing.shared_memory
+from http import HTTPStatus
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
-from threading import Thread, Condition
+from threading import Thread, Condition, Event, Lock, RLock
+from collections import OrderedDict, deque
 from queue import Queue
 
 SESSION_ID = str(time.time_ns())
 LOCAL_PORT = None
 HTTP_REQUEST_TIMEOUT = None
+HTTP_SERVER_MODE = "threading"
+HTTP_KEEP_ALIVE_TIMEOUT = 60
+HTTP_KEEP_ALIVE_MAX_REQUESTS = 1000
+HTTP_PROCESSES = 0
+BATCH_MIN_MESSAGES = 1
+BATCH_MAX_DELAY = 0
+BATCH_MAX_MESSAGES = 0
 QUEUE_MSG_TIMEOUT = None
 QUEUE_MSG_COUNT_LIMIT = None
+QUEUE_BACKEND = "memory"
+SHARED_QUEUE_SIZE = 16777216
+JOURNAL_DIR = ""
+JOURNAL_FSYNC_INTERVAL = 1
+JOURNAL_SEGMENT_SIZE = 4194304
+JOURNAL_SEGMENT_AGE = 3600
+BADGE_CACHE_SIZE = 512
+ASSET_DICTIONARY_SIZE = 4096
 IRC_SERVER = None
 IRC_PORT = None
-CHANNEL = None
+IRC_READ_SIZE = 65536
+INGEST_POOL = "thread"
+INGEST_WORKERS = 2
+INGEST_QUEUE_SIZE = 64
+LOG_LEVEL = "chat"
+LOG_BUFFER_SIZE = 1000
+LOG_OVERFLOW_POLICY = "summarize"
+API_TIMEOUT = 10
+API_CACHE_FILE = "api-cache.json"
+API_CACHE_TTL = 3600
+TABLE_REFRESH_INTERVAL = 1800
+IRC_WORKERS = 0
+IRC_WORKER_ASSIGNMENT = {}
+CHANNELS = None
 OAUTH_TOKEN = None
 
 http_server = None
-chat_queue = None
+static_file_cache = None
+# Functions returning counters of different parts of the server, served at /stats
+stats_providers = {}
+# In HTTP server processes, gets the counters from the main process instead
+remote_stats = None
+# Channels we show chat of, by name
+chat_channels = {}
 oauth_client_id = None
 user_id = None
 username = None
-channel_id = None
+# Badge resolver and BTTV emote index of each channel used by enrichChatMessages, set separately in every enrichment worker process
+enrichment_tables = None
+# In enrichment worker processes, generation of the tables of each channel in use
+enrichment_generations = {}
+# Worker processes are forked, so they start with the config, log, and chat queues of the main process instead of being passed them
+# Pinned, since other start methods are the default on some platforms and Python versions
+process_context = multiprocessing.get_context("fork")
+# API requests
+api_session = None
+api_cache = None
+
+
+# Console log levels, from most to least verbose
+# "chat" is the echo of every chat message
+LOG_LEVELS = ["debug", "chat", "info", "warning", "error"]
+
+
+# Console logger, which writes from a background thread, so threads producing output never wait for the terminal
+# Lines are kept in a bounded buffer, and when it's full, new lines are dropped, or dropped and counted in a summary line
+class ConsoleLogger():
+  def __init__(self):
+    self.lock = Condition()
+    self.buffer = deque()
+    self.writer = None
+    self.writing = False
+    # Lines suppressed since the last summary, and in total
+    self.suppressed = 0
+    self.suppressed_total = 0
+    self.written = 0
+    self.configure(LOG_LEVEL, LOG_BUFFER_SIZE, LOG_OVERFLOW_POLICY)
+    # Held while writing, so a process is never forked in the middle of a write, with stdout locked
+    self.write_lock = Lock()
+    # Forked worker processes don't inherit the writer thread, so they start their own
+    os.register_at_fork(before=self._beforeFork, after_in_parent=self._afterForkInParent, after_in_child=self._afterFork)
+
+  def _beforeFork(self):
+    self.write_lock.acquire()
+
+  def _afterForkInParent(self):
+    self.write_lock.release()
+
+  def _afterFork(self):
+    self.write_lock = Lock()
+    self.lock = Condition()
+    self.buffer = deque()
+    self.writer = None
+    self.writing = False
+
+  # Applies log settings, normally the ones from the config file
+  def configure(self, level, buffer_size, overflow_policy):
+    self.level = LOG_LEVELS.index(level)
+    self.buffer_size = buffer_size
+    self.overflow_policy = overflow_policy
+
+  # Checks if lines of the given level are written, to skip formatting ones that aren't
+  def enabled(self, level):
+    return LOG_LEVELS.index(level) >= self.level
+
+  def debug(self, *args):
+    self._log(0, args)
+
+  def chat(self, *args):
+    self._log(1, args)
+
+  def info(self, *args):
+    self._log(2, args)
+
+  def warning(self, *args):
+    self._log(3, args)
+
+  def error(self, *args):
+    self._log(4, args)
+
+  # Puts a line in the buffer, joining args like print does
+  def _log(self, level, args):
+    if level < self.level:
+      return
+    line = " ".join([str(arg) for arg in args])
+    with self.lock:
+      if len(self.buffer) >= self.buffer_size:
+        self.suppressed += 1
+        self.suppressed_total += 1
+        return
+      self.buffer.append(line)
+      # Start writer thread on first use
+      if self.writer == None:
+        self.writer = Thread(target=self._writeLines, daemon=True)
+        self.writer.start()
+      self.lock.notify_all()
+
+  # Writes buffered lines to the console
+  def _writeLines(self):
+    while True:
+      with self.lock:
+        while len(self.buffer) == 0 and (self.suppressed == 0 or self.overflow_policy != "summarize"):
+          self.lock.wait()
+        lines = list(self.buffer)
+        self.buffer.clear()
+        suppressed = self.suppressed
+        self.suppressed = 0
+        self.writing = True
+      if suppressed > 0 and self.overflow_policy == "summarize":
+        lines.append(f"…{suppressed} messages suppressed")
+      with self.write_lock:
+        try:
+          sys.stdout.write("\n".join(lines) + "\n")
+          sys.stdout.flush()
+        except (OSError, ValueError):
+          pass
+      with self.lock:
+        self.written += len(lines)
+        self.writing = False
+        self.lock.notify_all()
+
+  # Waits until everything that was logged is written, or the timeout expires
+  def flush(self, timeout=5):
+    with self.lock:
+      self.lock.wait_for(lambda: len(self.buffer) == 0 and not self.writing, timeout)
+
+  # Returns counters of written and suppressed lines
+  def stats(self):
+    with self.lock:
+      return {
+        "written": self.written,
+        "buffered": len(self.buffer),
+        "suppressed": self.suppressed_total
+      }
+
+log = ConsoleLogger()
 
 
 # Load config from file
 def loadConfig(config_file_path):
-  global LOCAL_PORT, HTTP_REQUEST_TIMEOUT, QUEUE_MSG_TIMEOUT, QUEUE_MSG_COUNT_LIMIT, IRC_SERVER, IRC_PORT, CHANNEL, OAUTH_TOKEN
+  global LOCAL_PORT, HTTP_REQUEST_TIMEOUT, HTTP_SERVER_MODE, HTTP_KEEP_ALIVE_TIMEOUT, HTTP_KEEP_ALIVE_MAX_REQUESTS, HTTP_PROCESSES, BATCH_MIN_MESSAGES, BATCH_MAX_DELAY, BATCH_MAX_MESSAGES, QUEUE_MSG_TIMEOUT, QUEUE_MSG_COUNT_LIMIT, QUEUE_BACKEND, SHARED_QUEUE_SIZE, JOURNAL_DIR, JOURNAL_FSYNC_INTERVAL, JOURNAL_SEGMENT_SIZE, JOURNAL_SEGMENT_AGE, BADGE_CACHE_SIZE, ASSET_DICTIONARY_SIZE, IRC_SERVER, IRC_PORT, IRC_READ_SIZE, INGEST_POOL, INGEST_WORKERS, INGEST_QUEUE_SIZE, LOG_LEVEL, LOG_BUFFER_SIZE, LOG_OVERFLOW_POLICY, API_TIMEOUT, API_CACHE_FILE, API_CACHE_TTL, TABLE_REFRESH_INTERVAL, IRC_WORKERS, IRC_WORKER_ASSIGNMENT, CHANNELS, OAUTH_TOKEN
   def parseIntValue(key, val):
     try:
       return int(value)
@@ -52,8 +217,73 @@ def loadConfig(config_file_path):
             IRC_PORT = parseIntValue(key, value)
             if IRC_PORT == None:
               return False
+          elif key == "irc-read-size":
+            IRC_READ_SIZE = parseIntValue(key, value)
+            if IRC_READ_SIZE == None:
+              return False
+          elif key == "irc-workers":
+            IRC_WORKERS = parseIntValue(key, value)
+            if IRC_WORKERS == None:
+              return False
+          elif key == "irc-worker-assignment":
+            # Pairs of channel and worker number, like "channel1:0,channel2:1"
+            IRC_WORKER_ASSIGNMENT = {}
+            for pair in value.split(','):
+              channel, separator, worker = pair.strip().rpartition(':')
+              try:
+                IRC_WORKER_ASSIGNMENT[channel.lower().removeprefix('#')] = int(worker)
+              except ValueError:
+                print(f"{key} must be a list of channel:worker pairs, separated by commas.")
+                return False
+          elif key == "ingest-pool":
+            if not value in ["thread", "process"]:
+              print(f"{key} must be either 'thread' or 'process'.")
+              return False
+            INGEST_POOL = value
+          elif key == "ingest-workers":
+            INGEST_WORKERS = parseIntValue(key, value)
+            if INGEST_WORKERS == None:
+              return False
+          elif key == "log-level":
+            if not value in LOG_LEVELS:
+              print(f"{key} must be one of: {', '.join(LOG_LEVELS)}")
+              return False
+            LOG_LEVEL = value
+          elif key == "log-buffer-size":
+            LOG_BUFFER_SIZE = parseIntValue(key, value)
+            if LOG_BUFFER_SIZE == None:
+              return False
+            if LOG_BUFFER_SIZE < 1:
+              print(f"{key} must be at least 1.")
+              return False
+          elif key == "log-overflow-policy":
+            if not value in ["drop", "summarize"]:
+              print(f"{key} must be either 'drop' or 'summarize'.")
+              return False
+            LOG_OVERFLOW_POLICY = value
+          elif key == "ingest-queue-size":
+            INGEST_QUEUE_SIZE = parseIntValue(key, value)
+            if INGEST_QUEUE_SIZE == None:
+              return False
+          elif key == "api-timeout":
+            API_TIMEOUT = parseIntValue(key, value)
+            if API_TIMEOUT == None:
+              return False
+          elif key == "api-cache-file":
+            API_CACHE_FILE = value
+          elif key == "api-cache-ttl":
+            API_CACHE_TTL = parseIntValue(key, value)
+            if API_CACHE_TTL == None:
+              return False
+          elif key == "table-refresh-interval":
+            TABLE_REFRESH_INTERVAL = parseIntValue(key, value)
+            if TABLE_REFRESH_INTERVAL == None:
+              return False
           elif key == "channel":
-            CHANNEL = value
+            # One or more channels, separated by commas
+            CHANNELS = [channel.strip().lower().removeprefix('#') for channel in value.split(',') if channel.strip() != ""]
+            if len(CHANNELS) == 0:
+              CHANNELS = None
           elif key == "oauth-token":
             OAUTH_TOKEN = value
           elif key == "local-port":
@@ -64,6 +294,36 @@ def loadConfig(config_file_path):
             HTTP_REQUEST_TIMEOUT = parseIntValue(key, value)
             if HTTP_REQUEST_TIMEOUT == None:
               return False
+          elif key == "http-server-mode":
+            if not value in ["threading", "asyncio"]:
+              print(f"{key} must be either 'threading' or 'asyncio'.")
+              return False
+            HTTP_SERVER_MODE = value
+          elif key == "http-keep-alive-timeout":
+            HTTP_KEEP_ALIVE_TIMEOUT = parseIntValue(key, value)
+            if HTTP_KEEP_ALIVE_TIMEOUT == None:
+              return False
+          elif key == "http-keep-alive-max-requests":
+            HTTP_KEEP_ALIVE_MAX_REQUESTS = parseIntValue(key, value)
+            if HTTP_KEEP_ALIVE_MAX_REQUESTS == None:
+              return False
+          elif key == "http-processes":
+            HTTP_PROCESSES = parseIntValue(key, value)
+            if HTTP_PROCESSES == None:
+              return False
+          elif key in ["batch-min-messages", "batch-max-delay", "batch-max-messages"]:
+            batch_value = parseIntValue(key, value)
+            if batch_value == None:
+              return False
+            if batch_value < 0:
+              print(f"{key} can't be negative.")
+              return False
+            if key == "batch-min-messages":
+              BATCH_MIN_MESSAGES = batch_value
+            elif key == "batch-max-delay":
+              BATCH_MAX_DELAY = batch_value
+            else:
+              BATCH_MAX_MESSAGES = batch_value
           elif key == "queue-msg-timeout":
             QUEUE_MSG_TIMEOUT = parseIntValue(key, value)
             if QUEUE_MSG_TIMEOUT == None:
@@ -72,6 +332,43 @@ def loadConfig(config_file_path):
             QUEUE_MSG_COUNT_LIMIT = parseIntValue(key, value)
             if QUEUE_MSG_COUNT_LIMIT == None:
               return False
+          elif key == "queue-backend":
+            if not value in ["memory", "shared"]:
+              print(f"{key} must be either 'memory' or 'shared'.")
+              return False
+            QUEUE_BACKEND = value
+          elif key == "journal-dir":
+            JOURNAL_DIR = value
+          elif key == "journal-fsync-interval":
+            JOURNAL_FSYNC_INTERVAL = parseIntValue(key, value)
+            if JOURNAL_FSYNC_INTERVAL == None:
+              return False
+          elif key == "journal-segment-size":
+            JOURNAL_SEGMENT_SIZE = parseIntValue(key, value)
+            if JOURNAL_SEGMENT_SIZE == None:
+              return False
+          elif key == "journal-segment-age":
+            JOURNAL_SEGMENT_AGE = parseIntValue(key, value)
+            if JOURNAL_SEGMENT_AGE == None:
+              return False
+          elif key == "shared-queue-size":
+            SHARED_QUEUE_SIZE = parseIntValue(key, value)
+            if SHARED_QUEUE_SIZE == None:
+              return False
+            if SHARED_QUEUE_SIZE < 1:
+              print(f"{key} must be at least 1.")
+              return False
+          elif key == "badge-cache-size":
+            BADGE_CACHE_SIZE = parseIntValue(key, value)
+            if BADGE_CACHE_SIZE == None:
+              return False
+          elif key == "asset-dictionary-size":
+            ASSET_DICTIONARY_SIZE = parseIntValue(key, value)
+            if ASSET_DICTIONARY_SIZE == None:
+              return False
+            if ASSET_DICTIONARY_SIZE <= 0:
+              print(f"{key} must be positive.")
+              return False
           else:
             print(f"Unknown option '{key}' found in config file '{config_file_path}'.")
   # Handle common file errors
@@ -82,273 +379,2695 @@ def loadConfig(config_file_path):
     print(f"Permission denied for config file '{config_file_path}'.")
     return False
   # Make sure we got all the requred parameters
-  for param in [LOCAL_PORT, HTTP_REQUEST_TIMEOUT, QUEUE_MSG_TIMEOUT, QUEUE_MSG_COUNT_LIMIT, IRC_SERVER, IRC_PORT, CHANNEL, OAUTH_TOKEN]:
+  for param in [LOCAL_PORT, HTTP_REQUEST_TIMEOUT, QUEUE_MSG_TIMEOUT, QUEUE_MSG_COUNT_LIMIT, IRC_SERVER, IRC_PORT, CHANNELS, OAUTH_TOKEN]:
     if param == None:
       print(f"Config file '{config_file_path}' is missing some options.")
       print("Required options are: local-port, http-request-timeout, queue-msg-timeout, queue-msg-count-limit, irc-server, irc-port, channel, oauth-token")
       return False
-  return True
+  # HTTP server processes can only read chat queues in shared memory
+  if HTTP_PROCESSES > 0 and QUEUE_BACKEND != "shared":
+    print("http-processes requires queue-backend=shared.")
+    return False
+  # Make sure channels are assigned to workers that exist
+  for channel, worker in IRC_WORKER_ASSIGNMENT.items():
+    if not channel in CHANNELS:
+      print(f"Channel '{channel}' in irc-worker-assignment isn't in the channel list.")
+      return False
+    if worker < 0 or worker >= IRC_WORKERS:
+      print(f"Channel '{channel}' is assigned to worker {worker}, but irc-workers is {IRC_WORKERS}.")
+      return False
+  return True
+
+
+# Index of the messages in a chat queue by Twitch message ID and by user ID, so moderation can find them without going through the queue
+# Entries are kept in message ID order, so the ones of messages leaving the queue are always at the front
+class MessageIndex():
+  def __init__(self):
+    # Tuples of message ID, Twitch message ID and user ID
+    self.entries = deque()
+    self.by_msg_id = {}
+    # Message IDs of each user, from oldest to newest
+    self.by_user_id = {}
+
+  # Adds a message that was just added to the queue
+  def add(self, message_id, msg):
+    msg_id = msg.get("id")
+    user_id = msg.get("user_id")
+    if msg_id == None and user_id == None:
+      return
+    self.entries.append((message_id, msg_id, user_id))
+    if msg_id != None:
+      self.by_msg_id[msg_id] = message_id
+    if user_id != None:
+      self.by_user_id.setdefault(user_id, deque()).append(message_id)
+
+  # Forgets messages with IDs before the given one, which left the queue
+  def evictBefore(self, message_id):
+    while len(self.entries) > 0 and self.entries[0][0] < message_id:
+      evicted_id, msg_id, user_id = self.entries.popleft()
+      if msg_id != None and self.by_msg_id.get(msg_id) == evicted_id:
+        del self.by_msg_id[msg_id]
+      user_messages = self.by_user_id.get(user_id)
+      if user_messages != None and user_messages[0] == evicted_id:
+        user_messages.popleft()
+        if len(user_messages) == 0:
+          del self.by_user_id[user_id]
+
+  # Removes the message with the given Twitch message ID, or all messages of the given user ID, from the index
+  # Returns the list of their message IDs
+  def take(self, msg_id=None, user_id=None):
+    if msg_id != None:
+      message_id = self.by_msg_id.pop(msg_id, None)
+      return [message_id] if message_id != None else []
+    return list(self.by_user_id.pop(user_id, []))
+
+
+# Gets the monotonic clock time when a message with the given timestamp expires, for messages that weren't added just now
+def expiryDeadline(timestamp):
+  return time.monotonic() + timestamp + QUEUE_MSG_TIMEOUT - time.time()
+
+
+# Encoder of queue entries, which are encoded once on every append, so one encoder is kept instead of json.dumps making one for every call
+# Entries are never circular, so it doesn't check for that, but otherwise encodes them exactly like json.dumps does
+if json.encoder.c_make_encoder != None:
+  _entry_encoder = json.encoder.c_make_encoder(None, json.JSONEncoder().default, json.encoder.encode_basestring_ascii, None, ": ", ", ", False, False, True)
+else:
+  _entry_encoder = None
+
+# Encodes a queue entry as UTF-8 JSON
+def encodeEntry(msg):
+  if _entry_encoder == None:
+    return json.dumps(msg).encode('utf-8')
+  return "".join(_entry_encoder(msg, 0)).encode('utf-8')
+
+
+# Kinds of queue entries, kept next to their pre-encoded bytes, so they're told apart without looking inside them
+# Chat messages, entries that delete messages, and tombstones that deleted messages are replaced by
+MESSAGE_ENTRY = 0
+DELETION_ENTRY = 1
+TOMBSTONE_ENTRY = 2
+
+# Gets the kind of an entry read back from the journal, which only has chat messages and deletion entries
+def journalEntryKind(msg):
+  return DELETION_ENTRY if "delete" in msg or "clear" in msg else MESSAGE_ENTRY
+
+
+# Key of the batches of new messages clients can share: the message ID they want messages after, the options of their overlay,
+# and the most messages they want at once
+# Options are the most messages the overlay can show, and the variant of the messages it wants (see encodeMessageVariant)
+def batchKey(message_id, overlay_options, max_messages=None):
+  if overlay_options == None:
+    return (message_id, None, None, max_messages)
+  return (message_id, overlay_options.message_count_max, overlay_options.variant(), max_messages)
+
+
+# New messages after a message ID, shared by all clients that asked for the same messages
+# Clients only read it, so its messages, and the responses built from them, are shared instead of copied for each client
+class MessageBatch():
+  def __init__(self, key):
+    self.key = key
+    self.last_message_id = key[0]
+    # Pre-encoded messages, their kinds, number of messages left out of them because the overlay has no room for them,
+    # and monotonic clock time when they were there, only set once the batch is completed
+    self.messages = ()
+    self.kinds = ()
+    self.skipped = 0
+    self.completed_at = None
+    self.ready = Event()
+    # Number of clients waiting for the batch, and futures of the asyncio ones, along with their event loops
+    self.waiters = 0
+    self.async_waiters = []
+    # Events of the waiting threads, in the order they're woken up in once the batch is completed
+    self.wakeups = deque()
+    # Responses built from the batch, by the function that built them and its other arguments
+    self.responses = {}
+    # Reentrant, since responses can be built from other responses of the same batch
+    self.lock = RLock()
+
+  # Fills in the messages and their kinds, and wakes up all clients waiting for them
+  def complete(self, last_message_id, messages, kinds, skipped=0):
+    self.last_message_id = last_message_id
+    self.messages = messages
+    self.kinds = kinds
+    self.skipped = skipped
+    self.completed_at = time.monotonic()
+    self.ready.set()
+    self.wakeNext()
+    # Wake up asyncio clients, which is safe to do from any thread
+    for loop, future in self.async_waiters:
+      loop.call_soon_threadsafe(_resolveFuture, future)
+    self.async_waiters = []
+
+  # Registers a thread waiting for the batch, along with the event it waits for
+  def addWaiter(self, wakeup):
+    self.waiters += 1
+    self.wakeups.append(wakeup)
+
+  # Wakes up the next waiting thread, which calls this again once it's awake, so the thread completing the batch doesn't wake them all up itself
+  # Threads woken up by their own event take their turn, so no lock shared by all of them has to be taken by each in turn
+  def wakeNext(self):
+    try:
+      self.wakeups.popleft().set()
+    except IndexError:
+      pass
+
+  # Registers an asyncio client to be woken up when the batch is completed
+  # Returns a tuple of its event loop and the future it should wait for
+  def addAsyncWaiter(self, loop):
+    waiter = (loop, loop.create_future())
+    self.waiters += 1
+    self.async_waiters.append(waiter)
+    return waiter
+
+  # Unregisters a client that stopped waiting, along with its future if it's an asyncio client, or its event
+  def removeWaiter(self, waiter):
+    self.waiters -= 1
+    if waiter in self.async_waiters:
+      self.async_waiters.remove(waiter)
+      return
+    try:
+      self.wakeups.remove(waiter)
+    except ValueError:
+      # Its turn to be woken up came already, so wake up the next thread in its place
+      if self.ready.is_set():
+        self.wakeNext()
+
+  # Gets a copy of the batch with only some of its messages, counting the others as skipped
+  def thinned(self, messages, kinds, dropped):
+    batch = MessageBatch(self.key)
+    batch.complete(self.last_message_id, messages, kinds, self.skipped + dropped)
+    return batch
+
+  # Gets a response built from the batch by the given function, which is only called once for all clients
+  # Any other arguments are passed to the function, and responses built with different ones are kept apart
+  def response(self, build, *args):
+    key = (build,) + args
+    response = self.responses.get(key)
+    if response == None:
+      with self.lock:
+        response = self.responses.get(key)
+        if response == None:
+          response = build(self, *args)
+          self.responses[key] = response
+    return response
+
+
+# Chat queue
+# Messages are kept in a fixed-capacity ring buffer, where message ID N lives in slot N % capacity
+# Each message is also stored pre-encoded as JSON in a parallel buffer, so it only gets serialized once
+class ChatQueue():
+  # Least seconds between checks for expired messages while the queue isn't used
+  EXPIRY_INTERVAL = 1
+
+  def __init__(self, capacity=None):
+    self.capacity = capacity if capacity != None else QUEUE_MSG_COUNT_LIMIT
+    assert self.capacity > 0
+    self.queue = [None] * self.capacity
+    self.encoded_queue = [None] * self.capacity
+    self.kinds = [None] * self.capacity
+    # Messages encoded as a variant overlays ask for, like with the images of a single scale, created when an overlay first asks for that variant,
+    # along with the stamps telling if they're still valid
+    self.variant_encoded_queues = {}
+    self.variant_stamps = {}
+    # Monotonic clock time when each message expires, in the same slots as the messages
+    # Messages are added in order, so these only ever increase from the oldest message to the newest
+    self.deadlines = [None] * self.capacity
+    self.message_id = 0
+    self.oldest_message_id = 0
+    # Reentrant, since deleting messages also adds a deletion entry
+    self.lock = RLock()
+    # Condition the thread removing expired messages while nothing else uses the queue waits on
+    self.expiry = Condition(self.lock)
+    # Batches clients are waiting for, and batches of messages already in queue, by the key of their clients
+    # Ready batches are only valid until the queue changes
+    self.waiting_batches = {}
+    self.ready_batches = {}
+    # Journal new messages are written to, if enabled
+    self.journal = None
+    # Messages by Twitch message ID and user ID, for deleting them
+    self.index = MessageIndex()
+    # IDs of the deletion entries, oldest first, so the ones among skipped messages are found by bisecting instead of going through all of them
+    # IDs of entries that left the queue are only forgotten once they're at least half of them
+    self.deletion_ids = []
+    Thread(target=self._expireWhenIdle, daemon=True).start()
+
+  # Number of messages currently in queue
+  # Queue must be locked by calling function
+  def _length(self):
+    return self.message_id - self.oldest_message_id
+
+  # Removes the oldest message from queue
+  # Unless a new message takes its slot right away, its slot is cleared, so the message's memory is freed
+  # Queue must be locked by calling function, which also forgets ready batches and index entries of evicted messages
+  def _evictOldest(self, replaced=False):
+    slot = self.oldest_message_id % self.capacity
+    if not replaced:
+      self.queue[slot] = None
+      self.encoded_queue[slot] = None
+      self.kinds[slot] = None
+      self.deadlines[slot] = None
+    for buffer in self.variant_encoded_queues.values():
+      buffer[slot] = None
+    self.oldest_message_id += 1
+
+  # Keeps the ID of a new deletion entry, forgetting the ones that left the queue if they're at least half of them
+  # Queue must be locked by calling function
+  def _addDeletionID(self, message_id):
+    evicted = bisect.bisect_left(self.deletion_ids, self.oldest_message_id)
+    if evicted > 0 and evicted * 2 >= len(self.deletion_ids):
+      del self.deletion_ids[:evicted]
+    self.deletion_ids.append(message_id)
+
+  # Replaces a message with a tombstone, so overlays that didn't get it yet never show it
+  # Queue must be locked by calling function, and message must be in queue
+  def _tombstone(self, message_id):
+    tombstone = {"mid": message_id, "timestamp": self.queue[message_id % self.capacity]["timestamp"], "deleted": True}
+    self.queue[message_id % self.capacity] = tombstone
+    self.encoded_queue[message_id % self.capacity] = encodeEntry(tombstone)
+    self.kinds[message_id % self.capacity] = TOMBSTONE_ENTRY
+    for buffer in self.variant_encoded_queues.values():
+      buffer[message_id % self.capacity] = None
+    self.ready_batches = {}
+
+  # Deletes the messages in queue that a deletion entry is about, before the entry itself is added
+  # Clearing chat replaces every message in queue with a tombstone, so overlays still continue from their message IDs
+  # Queue must be locked by calling function
+  def _applyDeletion(self, deletion):
+    if deletion.get("clear"):
+      message_ids = range(self.oldest_message_id, self.message_id)
+      self.index.evictBefore(self.message_id)
+    else:
+      message_ids = deletion.get("delete", [])
+    for message_id in message_ids:
+      if self.oldest_message_id <= message_id < self.message_id and self.kinds[message_id % self.capacity] == MESSAGE_ENTRY:
+        self._tombstone(message_id)
+
+  # Deletes a message by its Twitch message ID, all messages of a user by their user ID, or all messages if neither is given
+  # Deleted messages are replaced by tombstones, and a deletion entry is added after them, so overlays showing them can remove them
+  def deleteMessages(self, msg_id=None, user_id=None):
+    with self.lock:
+      if msg_id == None and user_id == None:
+        deletion = {"clear": True}
+      else:
+        deletion = {"delete": self.index.take(msg_id, user_id)}
+        if len(deletion["delete"]) == 0:
+          return
+      self._applyDeletion(deletion)
+      self.addMessages([deletion], DELETION_ENTRY)
+
+  # Returns messages with IDs in range [first_id, end_id) from the given buffer as a list
+  # Queue must be locked by calling function, and IDs must be within the queue's bounds
+  def _slice(self, first_id, end_id, buffer=None):
+    if buffer == None:
+      buffer = self.queue
+    if first_id >= end_id:
+      return []
+    start = first_id % self.capacity
+    end = end_id % self.capacity
+    # Range is contiguous in the buffer
+    if start < end:
+      return buffer[start:end]
+    # Range wraps around the end of the buffer
+    return buffer[start:] + buffer[:end]
+
+  # Adds messages of the given kind to queue
+  def addMessages(self, msg_list, kind=MESSAGE_ENTRY):
+    with self.lock:
+      self._expireMessages()
+      was_empty = self._length() == 0
+      messages_added = False
+      first_message_id = self.message_id
+      encoded_messages = []
+      timestamp = int(time.time())
+      deadline = time.monotonic() + QUEUE_MSG_TIMEOUT
+      for msg in msg_list:
+        # Remove message if queue is full, whose slot the new message takes
+        if self.message_id - self.oldest_message_id >= self.capacity:
+          self._evictOldest(replaced=True)
+        # Add message to queue
+        slot = self.message_id % self.capacity
+        msg_for_queue = msg.copy()
+        msg_for_queue["timestamp"] = timestamp
+        msg_for_queue["mid"] = self.message_id
+        encoded_msg = encodeEntry(msg_for_queue)
+        self.queue[slot] = msg_for_queue
+        self.encoded_queue[slot] = encoded_msg
+        self.deadlines[slot] = deadline
+        self.kinds[slot] = kind
+        encoded_messages.append(encoded_msg)
+        self.index.add(self.message_id, msg_for_queue)
+        if kind == DELETION_ENTRY:
+          self._addDeletionID(self.message_id)
+        self.message_id += 1
+        # Mark that at least one new message was added
+        messages_added = True
+      self.index.evictBefore(self.oldest_message_id)
+      if self.journal != None and messages_added:
+        self.journal.append(encoded_messages, first_message_id, self.oldest_message_id)
+      if messages_added:
+        # Complete every batch clients are waiting for at once, each built a single time for all of its clients
+        self.ready_batches = {}
+        waiting_batches = self.waiting_batches
+        self.waiting_batches = {}
+        for batch in waiting_batches.values():
+          self._completeBatch(batch)
+      # Wake up the expiry thread, only if it was waiting for the queue to stop being empty
+      if was_empty and messages_added:
+        self.expiry.notify()
+
+  # Puts messages read from the journal into the empty queue, continuing message IDs from where they left off
+  def restoreMessages(self, encoded_messages, next_message_id):
+    with self.lock:
+      assert self._length() == 0
+      encoded_messages = encoded_messages[max(len(encoded_messages) - self.capacity, 0):]
+      self.message_id = next_message_id - len(encoded_messages)
+      self.oldest_message_id = self.message_id
+      for encoded_msg in encoded_messages:
+        msg = decodeMessage(encoded_msg)
+        # Only deletion entries are in the journal, so delete their messages again
+        self._applyDeletion(msg)
+        self.queue[self.message_id % self.capacity] = msg
+        self.encoded_queue[self.message_id % self.capacity] = encoded_msg
+        self.kinds[self.message_id % self.capacity] = journalEntryKind(msg)
+        self.deadlines[self.message_id % self.capacity] = expiryDeadline(msg["timestamp"])
+        self.index.add(self.message_id, msg)
+        if self.kinds[self.message_id % self.capacity] == DELETION_ENTRY:
+          self._addDeletionID(self.message_id)
+        self.message_id += 1
+      # Wake up the expiry thread
+      self.expiry.notify()
+
+  # Removes expired messages from queue, which is cheap enough to do on every read and append
+  # Queue must be locked by calling function
+  def _expireMessages(self):
+    if self._length() == 0:
+      return
+    now = time.monotonic()
+    if self.deadlines[self.oldest_message_id % self.capacity] > now:
+      return
+    while self._length() > 0 and self.deadlines[self.oldest_message_id % self.capacity] <= now:
+      self._evictOldest()
+    self.ready_batches = {}
+    self.index.evictBefore(self.oldest_message_id)
+
+  # Removes expired messages from queue while no reads or appends do it, so their memory doesn't stay in use
+  # It doesn't matter if this runs late, since reads never return expired messages anyway, so it wakes up at most once every EXPIRY_INTERVAL
+  def _expireWhenIdle(self):
+    with self.lock:
+      while True:
+        self._expireMessages()
+        # If queue is empty, wait until there's an item to remove
+        if self._length() == 0:
+          self.expiry.wait()
+          continue
+        # Wait until it's time to remove the oldest message
+        self.expiry.wait(max(self.deadlines[self.oldest_message_id % self.capacity] - time.monotonic(), self.EXPIRY_INTERVAL))
+
+  # Gets the position in the queue of given message ID, counting from the oldest message
+  # Queue must be locked by calling function
+  # Returns -1 if the message expired, None if message hasn't been received yet, or position of message in queue
+  def _posOfMID(self, message_id):
+    if message_id < self.oldest_message_id:
+      return -1
+    elif message_id >= self.message_id:
+      return None
+    else:
+      return message_id - self.oldest_message_id
+
+  # Same as above, but locks queue, so it can be safely called externally
+  def posOfMID(self, message_id):
+    with self.lock:
+      self._expireMessages()
+      return self._posOfMID(message_id)
+
+  # Returns new messages from queue after message ID or waits for new messages if there aren't any
+  def getNewMessages(self, message_id=None, timeout=None):
+    # Messages that are already there are sliced right out of the queue, without building a batch
+    with self.lock:
+      self._expireMessages()
+      message_id = self._normalizeMID(message_id)
+      if self._hasMessagesAfter(message_id):
+        return self._slice(self._firstIDAfter(message_id), self.message_id)
+    batch = self.getNewBatch(message_id, timeout)
+    with self.lock:
+      # Leave out messages of the batch that left the queue since
+      first_id = max(batch.last_message_id + 1 - len(batch.messages), self.oldest_message_id)
+      return self._slice(first_id, batch.last_message_id + 1)
+
+  # Same as above, but returns the messages pre-encoded as UTF-8 JSON
+  def getNewMessagesEncoded(self, message_id=None, timeout=None):
+    return self.getNewBatch(message_id, timeout).messages
+
+  # Same as above, but also returns the ID of the last message returned, so the caller can continue from there
+  # If overlay options are given, only the messages it can show are returned, with only the images of its scale
+  # Returns a tuple of the last message ID and the list of pre-encoded messages
+  def getNewEncodedBatch(self, message_id=None, timeout=None, overlay_options=None):
+    batch = self.getNewBatch(message_id, timeout, overlay_options)
+    return (batch.last_message_id, batch.messages)
+
+  # Same as above, but returns the MessageBatch shared with all other clients that asked for the same messages
+  # If max messages is given, only that many of the oldest new messages are returned, and the caller continues with the rest
+  # If a wakeup event is given, it's set when new messages arrive, and the caller can also set it to stop waiting early
+  # On timeout, or if woken up early, the batch is empty
+  def getNewBatch(self, message_id=None, timeout=None, overlay_options=None, max_messages=None, wakeup=None):
+    assert type(message_id) == int or message_id == None
+    with self.lock:
+      batch = self._findBatch(message_id, overlay_options, max_messages)
+      if batch.ready.is_set():
+        return batch
+      waiter = wakeup if wakeup != None else Event()
+      batch.addWaiter(waiter)
+    # Wait for new messages to arrive, if there weren't any or all of them expired
+    if not waiter.wait(timeout) or not batch.ready.is_set():
+      with self.lock:
+        self._cancelWait(batch, waiter)
+      # Return empty batch on timeout
+      return MessageBatch(batch.key)
+    batch.wakeNext()
+    return self._recheckOptions(batch, overlay_options)
+
+  # Same as getNewMessagesEncoded, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewMessagesEncodedAsync(self, message_id=None, timeout=None):
+    return (await self.getNewBatchAsync(message_id, timeout)).messages
+
+  # Same as getNewEncodedBatch, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewEncodedBatchAsync(self, message_id=None, timeout=None, overlay_options=None):
+    batch = await self.getNewBatchAsync(message_id, timeout, overlay_options)
+    return (batch.last_message_id, batch.messages)
+
+  # Same as getNewBatch, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewBatchAsync(self, message_id=None, timeout=None, overlay_options=None, max_messages=None):
+    assert type(message_id) == int or message_id == None
+    loop = asyncio.get_running_loop()
+    with self.lock:
+      batch = self._findBatch(message_id, overlay_options, max_messages)
+      if batch.ready.is_set():
+        return batch
+      # Register to be woken up when the batch is completed
+      waiter = batch.addAsyncWaiter(loop)
+    try:
+      await asyncio.wait_for(waiter[1], timeout)
+    except asyncio.TimeoutError:
+      with self.lock:
+        self._cancelWait(batch, waiter)
+      # Return empty batch on timeout
+      return MessageBatch(batch.key)
+    return self._recheckOptions(batch, overlay_options)
+
+  # Gets the batch of messages after given message ID for clients with the given overlay options
+  # If there are messages, the batch is ready, and shared with clients asking for them until the queue changes
+  # Otherwise, the batch is shared with clients waiting for the same messages, and completed when they arrive
+  # Queue must be locked by calling function
+  def _findBatch(self, message_id, overlay_options, max_messages=None):
+    self._expireMessages()
+    key = batchKey(self._normalizeMID(message_id), overlay_options, max_messages)
+    batch = self.ready_batches.get(key)
+    if batch != None:
+      return batch
+    if self._hasMessagesAfter(key[0]):
+      return self._completeBatch(MessageBatch(key))
+    batch = self.waiting_batches.get(key)
+    if batch == None:
+      batch = MessageBatch(key)
+      self.waiting_batches[key] = batch
+    return batch
+
+  # Fills in a batch with the messages after its message ID, as wanted by the overlay options in its key, and wakes up its clients
+  # Queue must be locked by calling function, and there must be messages after the message ID
+  def _completeBatch(self, batch):
+    message_id, message_count_max, variant, max_messages = batch.key
+    first_id = self._firstIDAfter(message_id)
+    start_from = self._firstIDAfter(message_id, message_count_max)
+    end_id = self.message_id if max_messages == None else min(start_from + max_messages, self.message_id)
+    buffer = self.encoded_queue if variant == None else self._variantBuffer(start_from, end_id, variant)
+    # Deletions among messages the overlay has no room for are still sent, since they can be about messages already on screen
+    deletions_start = bisect.bisect_left(self.deletion_ids, first_id)
+    deletions_end = bisect.bisect_left(self.deletion_ids, start_from, deletions_start)
+    deletions = [self.encoded_queue[mid % self.capacity] for mid in self.deletion_ids[deletions_start:deletions_end]]
+    kinds = [DELETION_ENTRY] * len(deletions) + self._slice(start_from, end_id, self.kinds)
+    batch.complete(end_id - 1, tuple(deletions + self._slice(start_from, end_id, buffer)), tuple(kinds), start_from - first_id - len(deletions))
+    self.ready_batches[batch.key] = batch
+    return batch
+
+  # Gets another batch for a client whose overlay options changed while it was waiting for the given one
+  def _recheckOptions(self, batch, overlay_options):
+    if batchKey(batch.key[0], overlay_options, batch.key[3]) == batch.key:
+      return batch
+    with self.lock:
+      return self._findBatch(batch.key[0], overlay_options, batch.key[3])
+
+  # Forgets a batch that is still waiting for messages once none of its clients wait for it anymore
+  # Queue must be locked by calling function
+  def _cancelWait(self, batch, waiter):
+    batch.removeWaiter(waiter)
+    if batch.waiters == 0 and self.waiting_batches.get(batch.key) is batch:
+      del self.waiting_batches[batch.key]
+
+  # Ignore pre-existing messages if message id was not given or is out of bounds
+  # Queue must be locked by calling function
+  def _normalizeMID(self, message_id):
+    if message_id == None or message_id < -1 or message_id >= self.message_id:
+      return self.message_id - 1
+    return message_id
+
+  # Checks if there are any messages in queue after given message ID
+  # Queue must be locked by calling function
+  def _hasMessagesAfter(self, message_id):
+    return self._posOfMID(message_id + 1) != None and self._length() > 0
+
+  # Gets the ID of the first message in queue after given message ID
+  # If limit is given, skips older messages so that at most that many are left
+  # Queue must be locked by calling function
+  def _firstIDAfter(self, message_id, limit=None):
+    start_from = self._posOfMID(message_id) + 1
+    assert start_from != None
+    start_from += self.oldest_message_id
+    if limit != None:
+      start_from = max(start_from, self.message_id - limit)
+    return start_from
+
+  # Gets the buffer of messages encoded as a single variant, encoding the ones with IDs in range [start_from, end_id) that weren't requested before
+  # Queue must be locked by calling function
+  def _variantBuffer(self, start_from, end_id, variant):
+    buffer = self.variant_encoded_queues.get(variant)
+    if buffer == None:
+      buffer = [None] * self.capacity
+      self.variant_encoded_queues[variant] = buffer
+      self.variant_stamps[variant] = [None] * self.capacity
+    stamps = self.variant_stamps[variant]
+    for mid in range(start_from, end_id):
+      if buffer[mid % self.capacity] == None or not variantIsCurrent(variant, stamps[mid % self.capacity]):
+        stamps[mid % self.capacity] = variantStamp(variant)
+        buffer[mid % self.capacity] = encodeMessageVariant(self.queue[mid % self.capacity], variant)
+    return buffer
+
+  # Prints current queue state to console
+  def debugQueue(self):
+    with self.lock:
+      print("message_id:", self.message_id)
+      print("oldest_message_id:", self.oldest_message_id)
+      print("queue:", self._slice(self.oldest_message_id, self.message_id))
+
+
+# Chat queue stored in shared memory, so HTTP server processes can read the messages the main process receives without copying them between processes
+# The shared memory has a header, a table of slots where message ID N lives in slot N % capacity, a ring of the IDs of the last deletion entries,
+# and a ring of pre-encoded messages
+# Only the process that created the queue writes to it, and the header's sequence number is odd while it's changing anything,
+# so readers don't lock anything, and just read again if the sequence number changed while they were reading
+# Readers of each process are woken up by a thread of that process, which polls the header for new messages
+class SharedChatQueue():
+  # Sequence number, at the start of the header
+  SEQUENCE = struct.Struct("<Q")
+  # Next message ID, oldest message ID, total bytes written to the ring, and number of deletion entries ever added, after the sequence number
+  STATE = struct.Struct("<QQQQ")
+  # Message ID of a deletion entry, where the Nth deletion entry lives in N % capacity, so the ones in queue are found by bisecting
+  DELETION_ID = struct.Struct("<Q")
+  # Position of the message in the ring (total bytes written before it), length, timestamp, monotonic clock time when it expires, and kind of entry
+  # The monotonic clock is the same for all processes, so readers skip expired messages the writer didn't remove yet
+  # Deleted messages are only marked as tombstones, which readers encode themselves
+  SLOT = struct.Struct("<QIIdB")
+  # Least and most seconds readers wait for a write in progress to finish, before reading again
+  WRITE_WAIT_MIN = 0.00005
+  WRITE_WAIT_MAX = 0.001
+  # Most seconds a process waits for the writer to take the pipe it wakes the process up with
+  REGISTRATION_TIMEOUT = 1
+  # Least seconds between checks for expired messages while no messages are added
+  EXPIRY_INTERVAL = 1
+
+  def __init__(self, capacity=None, data_size=None):
+    self.capacity = capacity if capacity != None else QUEUE_MSG_COUNT_LIMIT
+    self.data_size = data_size if data_size != None else SHARED_QUEUE_SIZE
+    assert self.capacity > 0 and self.data_size > 0
+    self.slots_offset = self.SEQUENCE.size + self.STATE.size
+    self.deletion_ids_offset = self.slots_offset + self.SLOT.size * self.capacity
+    self.data_offset = self.deletion_ids_offset + self.DELETION_ID.size * self.capacity
+    self.shm = multiprocessing.shared_memory.SharedMemory(create=True, size=self.data_offset + self.data_size)
+    # Writer state, only used by the process that created the queue
+    self.sequence = 0
+    self.message_id = 0
+    self.oldest_message_id = 0
+    self.data_head = 0
+    self.deletion_count = 0
+    # Messages too big to ever fit in the ring
+    self.dropped = 0
+    # Reentrant, since deleting messages also adds a deletion entry
+    self.lock = RLock()
+    # Condition the thread removing expired messages while no messages are added waits on
+    self.expiry = Condition(self.lock)
+    # Journal new messages are written to, if enabled
+    self.journal = None
+    # Messages by Twitch message ID and user ID, for deleting them
+    self.index = MessageIndex()
+    # Processes reading the queue send the writing end of a pipe through this socket, and the writer puts a byte in every pipe when it adds messages
+    self.owner_pid = os.getpid()
+    self.watcher_registrations, self.watcher_registration_sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.watcher_pipes = []
+    self._resetReaders()
+    # Forked processes have none of the reader threads of this one
+    os.register_at_fork(after_in_child=self._resetReaders)
+    Thread(target=self._expireWhenIdle, daemon=True).start()
+    Thread(target=self._takeWatchers, daemon=True).start()
+
+  # Reader state of the current process
+  def _resetReaders(self):
+    self.readers = Lock()
+    self.watching = False
+    # Pipe the writer wakes up this process with, created when it first waits for messages
+    # This process keeps the writing end too, to stop the thread watching for messages once no readers wait
+    self.wakeup_pipe = None
+    self.wakeup_pipe_writer = None
+    # Batches clients are waiting for, by the key of their clients
+    self.waiting_batches = {}
+    # Messages encoded as a variant overlays ask for, like with the images of a single scale, created when an overlay first asks for that variant,
+    # as tuples of message ID, message as it was in the queue (which changes if it's deleted), stamp telling if it's still valid, and encoded variant
+    self.variant_encoded_queues = {}
+
+  # Number of messages currently in queue
+  # Queue must be locked by calling function
+  def _length(self):
+    return self.message_id - self.oldest_message_id
+
+  # Gets the slot of given message ID, as a tuple of position in ring, length, timestamp, expiry deadline and kind
+  def _slot(self, message_id):
+    return self.SLOT.unpack_from(self.shm.buf, self.slots_offset + self.SLOT.size * (message_id % self.capacity))
+
+  # Marks the queue as changing, so readers know to read again
+  # Queue must be locked by calling function
+  def _beginWrite(self):
+    self.sequence += 1
+    self.SEQUENCE.pack_into(self.shm.buf, 0, self.sequence)
+
+  # Publishes the new state of the queue, before marking it as unchanging again
+  # Queue must be locked by calling function
+  def _endWrite(self):
+    self.STATE.pack_into(self.shm.buf, self.SEQUENCE.size, self.message_id, self.oldest_message_id, self.data_head, self.deletion_count)
+    self.sequence += 1
+    self.SEQUENCE.pack_into(self.shm.buf, 0, self.sequence)
+
+  # Writes a pre-encoded message to the ring, removing the oldest messages if there's no room for it
+  # Queue must be locked by calling function, and marked as changing
+  def _append(self, encoded_msg, kind, timestamp, deadline):
+    # Messages never wrap around the end of the ring, so they start over from its beginning if they don't fit
+    start = self.data_head
+    if start % self.data_size + len(encoded_msg) > self.data_size:
+      start += self.data_size - start % self.data_size
+    end = start + len(encoded_msg)
+    while self._length() > 0 and (self._length() >= self.capacity or self._slot(self.oldest_message_id)[0] < end - self.data_size):
+      self.oldest_message_id += 1
+    self.index.evictBefore(self.oldest_message_id)
+    position = self.data_offset + start % self.data_size
+    self.shm.buf[position:position + len(encoded_msg)] = encoded_msg
+    self.SLOT.pack_into(self.shm.buf, self.slots_offset + self.SLOT.size * (self.message_id % self.capacity), start, len(encoded_msg), timestamp, deadline, kind)
+    if kind == DELETION_ENTRY:
+      self.DELETION_ID.pack_into(self.shm.buf, self.deletion_ids_offset + self.DELETION_ID.size * (self.deletion_count % self.capacity), self.message_id)
+      self.deletion_count += 1
+    self.message_id += 1
+    self.data_head = end
+
+  # Adds messages of the given kind to queue
+  def addMessages(self, msg_list, kind=MESSAGE_ENTRY):
+    with self.lock:
+      self._beginWrite()
+      self._expireMessages()
+      was_empty = self._length() == 0
+      first_message_id = self.message_id
+      encoded_messages = []
+      deadline = time.monotonic() + QUEUE_MSG_TIMEOUT
+      for msg in msg_list:
+        msg_for_queue = msg.copy()
+        msg_for_queue["timestamp"] = int(time.time())
+        msg_for_queue["mid"] = self.message_id
+        encoded_msg = encodeEntry(msg_for_queue)
+        if len(encoded_msg) > self.data_size:
+          self.dropped += 1
+          log.warning("[Chat Queue] Message too big for shared queue, dropping it:", len(encoded_msg), "bytes")
+          continue
+        self._append(encoded_msg, kind, msg_for_queue["timestamp"], deadline)
+        self.index.add(self.message_id - 1, msg_for_queue)
+        encoded_messages.append(encoded_msg)
+      self._endWrite()
+      self._notifyWatchers()
+      if self.journal != None and len(encoded_messages) > 0:
+        self.journal.append(encoded_messages, first_message_id, self.oldest_message_id)
+      # Wake up the expiry thread, only if it was waiting for the queue to stop being empty
+      if was_empty and len(encoded_messages) > 0:
+        self.expiry.notify()
+    # Wake up readers of this process right away, instead of when their thread notices
+    self._wakeReaders()
+
+  # Puts messages read from the journal into the empty queue, continuing message IDs from where they left off
+  def restoreMessages(self, encoded_messages, next_message_id):
+    # Only messages after the last one that doesn't fit in the ring can be restored
+    for i in range(len(encoded_messages) - 1, -1, -1):
+      if len(encoded_messages[i]) > self.data_size:
+        encoded_messages = encoded_messages[i+1:]
+        break
+    with self.lock:
+      assert self._length() == 0
+      self._beginWrite()
+      self.message_id = next_message_id - len(encoded_messages)
+      self.oldest_message_id = self.message_id
+      for encoded_msg in encoded_messages:
+        msg = json.loads(encoded_msg)
+        # Only deletion entries are in the journal, so delete their messages again
+        self._applyDeletion(msg)
+        self._append(encoded_msg, journalEntryKind(msg), msg["timestamp"], expiryDeadline(msg["timestamp"]))
+        self.index.add(self.message_id - 1, msg)
+      self._endWrite()
+      # Wake up the expiry thread
+      self.expiry.notify()
+
+  # Deletes the messages in queue that a deletion entry is about, before the entry itself is added
+  # Clearing chat replaces every message in queue with a tombstone, so overlays still continue from their message IDs
+  # Queue must be locked by calling function, and marked as changing
+  def _applyDeletion(self, deletion):
+    if deletion.get("clear"):
+      message_ids = range(self.oldest_message_id, self.message_id)
+      self.index.evictBefore(self.message_id)
+    else:
+      message_ids = deletion.get("delete", [])
+    for message_id in message_ids:
+      if self.oldest_message_id <= message_id < self.message_id:
+        start, length, timestamp, deadline, kind = self._slot(message_id)
+        if kind == MESSAGE_ENTRY:
+          self.SLOT.pack_into(self.shm.buf, self.slots_offset + self.SLOT.size * (message_id % self.capacity), start, length, timestamp, deadline, TOMBSTONE_ENTRY)
+
+  # Deletes a message by its Twitch message ID, all messages of a user by their user ID, or all messages if neither is given
+  # Deleted messages are replaced by tombstones, and a deletion entry is added after them, so overlays showing them can remove them
+  def deleteMessages(self, msg_id=None, user_id=None):
+    with self.lock:
+      if msg_id == None and user_id == None:
+        deletion = {"clear": True}
+      else:
+        deletion = {"delete": self.index.take(msg_id, user_id)}
+        if len(deletion["delete"]) == 0:
+          return
+      self._beginWrite()
+      self._applyDeletion(deletion)
+      self._endWrite()
+      self.addMessages([deletion], DELETION_ENTRY)
+
+  # Checks if the oldest message in queue expired
+  # Queue must be locked by calling function
+  def _oldestExpired(self):
+    return self._length() > 0 and self._slot(self.oldest_message_id)[3] <= time.monotonic()
+
+  # Removes expired messages from queue
+  # Queue must be locked by calling function, and marked as changing
+  def _expireMessages(self):
+    if not self._oldestExpired():
+      return
+    now = time.monotonic()
+    while self._length() > 0 and self._slot(self.oldest_message_id)[3] <= now:
+      self.oldest_message_id += 1
+    self.index.evictBefore(self.oldest_message_id)
+
+  # Removes expired messages from queue while no messages are added, so their space in the ring can be reused
+  # Readers already skip expired messages, so it doesn't matter if this runs late, and it wakes up at most once every EXPIRY_INTERVAL
+  def _expireWhenIdle(self):
+    with self.lock:
+      while True:
+        if self._oldestExpired():
+          self._beginWrite()
+          self._expireMessages()
+          self._endWrite()
+        # If queue is empty, wait until there's an item to remove
+        if self._length() == 0:
+          self.expiry.wait()
+          continue
+        # Wait until it's time to remove the oldest message
+        self.expiry.wait(max(self._slot(self.oldest_message_id)[3] - time.monotonic(), self.EXPIRY_INTERVAL))
+
+  # Calls read with the shared memory, reading again if the queue changed in the meantime, and returns what it returned
+  # Writes are short, so readers that find one in progress wait a moment for it, without spinning while the writer isn't running
+  def _consistentRead(self, read):
+    buf = self.shm.buf
+    write_wait = self.WRITE_WAIT_MIN
+    while True:
+      sequence = self.SEQUENCE.unpack_from(buf, 0)[0]
+      if sequence % 2 == 1:
+        time.sleep(write_wait)
+        write_wait = min(write_wait * 2, self.WRITE_WAIT_MAX)
+        continue
+      result = read(buf)
+      if self.SEQUENCE.unpack_from(buf, 0)[0] == sequence:
+        return result
+
+  # Reads the state of the queue and the messages after given message ID
+  # If limit is given, skips older messages so that at most that many are returned
+  # Returns a tuple of the message ID after ignoring pre-existing messages if it was not given or is out of bounds,
+  # the next message ID, the ID of the first message after it, the ID of the first message returned, the list of pre-encoded messages, and the list of their kinds
+  def _read(self, message_id, limit=None):
+    return self._consistentRead(lambda buf: self._readMessages(buf, message_id, limit))
+
+  # Same as above, but may return a mix of old and new messages if the queue changes while reading
+  def _readMessages(self, buf, message_id, limit):
+    next_message_id, oldest_message_id, data_head, deletion_count = self.STATE.unpack_from(buf, self.SEQUENCE.size)
+    normalized_id = message_id
+    if message_id == None or message_id < -1 or message_id >= next_message_id:
+      normalized_id = next_message_id - 1
+    first_id = max(normalized_id + 1, oldest_message_id)
+    encoded_messages = []
+    kinds = []
+    unpack_slot, slot_size, slots_offset, data_offset, data_size = self.SLOT.unpack_from, self.SLOT.size, self.slots_offset, self.data_offset, self.data_size
+    # Skip messages that expired, but weren't removed yet
+    now = time.monotonic()
+    while first_id < next_message_id and unpack_slot(buf, slots_offset + slot_size * (first_id % self.capacity))[3] <= now:
+      first_id += 1
+    start_from = first_id
+    if limit != None:
+      start_from = max(start_from, next_message_id - limit)
+    for mid in range(start_from, next_message_id):
+      start, length, timestamp, deadline, kind = unpack_slot(buf, slots_offset + slot_size * (mid % self.capacity))
+      kinds.append(kind)
+      if kind == TOMBSTONE_ENTRY:
+        encoded_messages.append(json.dumps({"mid": mid, "timestamp": timestamp, "deleted": True}).encode('utf-8'))
+        continue
+      position = data_offset + start % data_size
+      encoded_messages.append(buf[position:position + length].tobytes())
+    return (normalized_id, next_message_id, first_id, start_from, encoded_messages, kinds)
+
+  # Reads the deletion entries with IDs in range [first_id, end_id), reading again if the queue changed in the meantime
+  # They're found by bisecting the ring of deletion entry IDs, so neither the other messages nor their slots are read
+  def _readDeletions(self, first_id, end_id):
+    return self._consistentRead(lambda buf: self._readDeletionEntries(buf, first_id, end_id))
+
+  # Gets the message ID of the Nth deletion entry
+  def _deletionID(self, buf, number):
+    return self.DELETION_ID.unpack_from(buf, self.deletion_ids_offset + self.DELETION_ID.size * (number % self.capacity))[0]
+
+  # Same as above, but may return a mix of old and new entries if the queue changes while reading
+  def _readDeletionEntries(self, buf, first_id, end_id):
+    next_message_id, oldest_message_id, data_head, deletion_count = self.STATE.unpack_from(buf, self.SEQUENCE.size)
+    first_id = max(first_id, oldest_message_id)
+    end_id = min(end_id, next_message_id)
+    # Every deletion entry in queue takes a slot, so they're all among the last capacity ones
+    low = max(deletion_count - self.capacity, 0)
+    high = deletion_count
+    while low < high:
+      middle = (low + high) // 2
+      if self._deletionID(buf, middle) < first_id:
+        low = middle + 1
+      else:
+        high = middle
+    deletions = []
+    for number in range(low, deletion_count):
+      mid = self._deletionID(buf, number)
+      if mid >= end_id:
+        break
+      start, length, timestamp, deadline, kind = self._slot(mid)
+      position = self.data_offset + start % self.data_size
+      deletions.append(buf[position:position + length].tobytes())
+    return deletions
+
+  # Reads the next and oldest message IDs, reading again if the queue changed in the meantime
+  # Messages that expired, but weren't removed yet, are counted as removed
+  def _state(self):
+    return self._consistentRead(self._readState)
+
+  # Same as above, but may return a mix of old and new IDs if the queue changes while reading
+  def _readState(self, buf):
+    next_message_id, oldest_message_id, data_head, deletion_count = self.STATE.unpack_from(buf, self.SEQUENCE.size)
+    now = time.monotonic()
+    while oldest_message_id < next_message_id and self._slot(oldest_message_id)[3] <= now:
+      oldest_message_id += 1
+    return (next_message_id, oldest_message_id)
+
+  # Gets the next message ID, without checking if the queue is changing, which is enough for noticing new messages
+  def _nextMessageID(self):
+    return self.STATE.unpack_from(self.shm.buf, self.SEQUENCE.size)[0]
+
+  # Completes the batches readers of the current process are waiting for, now that there are new messages
+  def _wakeReaders(self):
+    with self.readers:
+      waiting_batches = self.waiting_batches
+      self.waiting_batches = {}
+      for batch in waiting_batches.values():
+        # Keep waiting if the messages aren't there yet, since the thread watching for them noticed them before they were added
+        if not self._completeBatch(batch):
+          self.waiting_batches[batch.key] = batch
+
+  # Takes in the pipes of processes that start waiting for messages, letting each one know through its pipe once it will be woken up
+  def _takeWatchers(self):
+    while True:
+      try:
+        message, fds, flags, address = socket.recv_fds(self.watcher_registrations, 1, 1)
+      except OSError:
+        # Queue was closed
+        return
+      if len(fds) == 0:
+        return
+      with self.lock:
+        self.watcher_pipes += fds
+        for pipe_writer in fds:
+          os.write(pipe_writer, b"\0")
+
+  # Wakes up the other processes waiting for new messages
+  # Queue must be locked by calling function, and the new messages published
+  def _notifyWatchers(self):
+    for pipe_writer in list(self.watcher_pipes):
+      try:
+        os.write(pipe_writer, b"\0")
+      except BlockingIOError:
+        # Pipe is full, so the process has a wakeup waiting already
+        pass
+      except OSError:
+        # Process stopped
+        os.close(pipe_writer)
+        self.watcher_pipes.remove(pipe_writer)
+
+  # Wakes up the readers of the current process when new messages are added by another process, for as long as any of them wait
+  # Blocks on the pipe the writer puts a byte in for every new batch of messages, so nothing runs while no messages are added
+  def _watchForMessages(self):
+    while True:
+      with self.readers:
+        if len(self.waiting_batches) == 0:
+          self.watching = False
+          return
+      select.select([self.wakeup_pipe], [], [])
+      try:
+        os.read(self.wakeup_pipe, 4096)
+      except BlockingIOError:
+        pass
+      self._wakeReaders()
+
+  # Starts the thread waking up readers of the current process, if it isn't running yet
+  # The process that adds messages wakes up its own readers, so it doesn't need one
+  # Readers must be locked by calling function
+  def _startWatching(self):
+    if self.watching or os.getpid() == self.owner_pid:
+      return
+    if self.wakeup_pipe == None:
+      self.wakeup_pipe, self.wakeup_pipe_writer = os.pipe()
+      os.set_blocking(self.wakeup_pipe, False)
+      # The writer must never wait for a reader
+      os.set_blocking(self.wakeup_pipe_writer, False)
+      socket.send_fds(self.watcher_registration_sender, [b"\0"], [self.wakeup_pipe_writer])
+      # Messages added before the writer took the pipe wouldn't wake this process up, so wait until it did
+      # Readers check for new messages after this, so they don't miss the ones added in the meantime
+      select.select([self.wakeup_pipe], [], [], self.REGISTRATION_TIMEOUT)
+    self.watching = True
+    Thread(target=self._watchForMessages, daemon=True).start()
+
+  # Gets the position in the queue of given message ID, counting from the oldest message
+  # Returns -1 if the message expired, None if message hasn't been received yet, or position of message in queue
+  def posOfMID(self, message_id):
+    next_message_id, oldest_message_id = self._state()
+    if message_id < oldest_message_id:
+      return -1
+    elif message_id >= next_message_id:
+      return None
+    else:
+      return message_id - oldest_message_id
+
+  # Returns new messages from queue after message ID or waits for new messages if there aren't any
+  # Messages are only kept encoded, so they're decoded for every call, which is fine for tests and debugging, but clients are served with getNewBatch
+  def getNewMessages(self, message_id=None, timeout=None):
+    return [json.loads(encoded_msg) for encoded_msg in self.getNewMessagesEncoded(message_id, timeout)]
+
+  # Same as above, but returns the messages pre-encoded as UTF-8 JSON
+  def getNewMessagesEncoded(self, message_id=None, timeout=None):
+    return self.getNewBatch(message_id, timeout).messages
+
+  # Same as above, but also returns the ID of the last message returned, so the caller can continue from there
+  # If overlay options are given, only the messages it can show are returned, with only the images of its scale
+  # Returns a tuple of the last message ID and the list of pre-encoded messages
+  def getNewEncodedBatch(self, message_id=None, timeout=None, overlay_options=None):
+    batch = self.getNewBatch(message_id, timeout, overlay_options)
+    return (batch.last_message_id, batch.messages)
+
+  # Same as above, but returns the MessageBatch shared with all other clients of this process that asked for the same messages
+  # If max messages is given, only that many of the oldest new messages are returned, and the caller continues with the rest
+  # If a wakeup event is given, it's set when new messages arrive, and the caller can also set it to stop waiting early
+  # On timeout, or if woken up early, the batch is empty
+  def getNewBatch(self, message_id=None, timeout=None, overlay_options=None, max_messages=None, wakeup=None):
+    assert type(message_id) == int or message_id == None
+    batch, waiter = self._findBatch(message_id, overlay_options, max_messages, wakeup=wakeup)
+    if batch.ready.is_set():
+      return batch
+    # Wait for new messages to arrive, if there weren't any or all of them expired
+    if not waiter.wait(timeout) or not batch.ready.is_set():
+      with self.readers:
+        self._cancelWait(batch, waiter)
+      # Return empty batch on timeout
+      return MessageBatch(batch.key)
+    batch.wakeNext()
+    return self._recheckOptions(batch, overlay_options)
+
+  # Same as getNewMessagesEncoded, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewMessagesEncodedAsync(self, message_id=None, timeout=None):
+    return (await self.getNewBatchAsync(message_id, timeout)).messages
+
+  # Same as getNewEncodedBatch, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewEncodedBatchAsync(self, message_id=None, timeout=None, overlay_options=None):
+    batch = await self.getNewBatchAsync(message_id, timeout, overlay_options)
+    return (batch.last_message_id, batch.messages)
+
+  # Same as getNewBatch, but waits in an asyncio event loop instead of blocking the thread
+  async def getNewBatchAsync(self, message_id=None, timeout=None, overlay_options=None, max_messages=None):
+    assert type(message_id) == int or message_id == None
+    batch, waiter = self._findBatch(message_id, overlay_options, max_messages, asyncio.get_running_loop())
+    if batch.ready.is_set():
+      return batch
+    try:
+      await asyncio.wait_for(waiter[1], timeout)
+    except asyncio.TimeoutError:
+      with self.readers:
+        self._cancelWait(batch, waiter)
+      # Return empty batch on timeout
+      return MessageBatch(batch.key)
+    return self._recheckOptions(batch, overlay_options)
+
+  # Gets the batch of messages after given message ID for clients with the given overlay options
+  # If there are no messages yet, the client is registered to wait for the batch, which is shared with the clients of this process waiting for the same messages,
+  # and completed when they arrive, with the event loop if it's an asyncio client
+  # Returns a tuple of the batch, and what the client should wait for if it has to: its future if it's an asyncio client, or its event otherwise
+  def _findBatch(self, message_id, overlay_options, max_messages=None, loop=None, wakeup=None):
+    limit = overlay_options.message_count_max if overlay_options != None else None
+    message_id, next_message_id, first_id, start_from, encoded_messages, kinds = self._read(message_id, limit)
+    batch = MessageBatch(batchKey(message_id, overlay_options, max_messages))
+    if len(encoded_messages) > 0:
+      self._fillBatch(batch, first_id, start_from, encoded_messages, kinds)
+      return (batch, None)
+    with self.readers:
+      self._startWatching()
+      # Messages may have been added since they were read, before the thread watching for them could wake this client up
+      if self._nextMessageID() != next_message_id and self._completeBatch(batch):
+        return (batch, None)
+      batch = self.waiting_batches.setdefault(batch.key, batch)
+      if loop != None:
+        return (batch, batch.addAsyncWaiter(loop))
+      waiter = wakeup if wakeup != None else Event()
+      batch.addWaiter(waiter)
+      return (batch, waiter)
+
+  # Fills in a batch with the messages after its message ID, as wanted by the overlay options in its key, and wakes up its clients
+  # Returns False if there are no messages after its message ID yet
+  def _completeBatch(self, batch):
+    message_id, next_message_id, first_id, start_from, encoded_messages, kinds = self._read(batch.key[0], batch.key[1])
+    if len(encoded_messages) == 0:
+      return False
+    self._fillBatch(batch, first_id, start_from, encoded_messages, kinds)
+    return True
+
+  # Same as above, with messages that were already read, starting from start_from, after skipping the ones from first_id on the overlay has no room for
+  def _fillBatch(self, batch, first_id, start_from, encoded_messages, kinds):
+    message_id, message_count_max, variant, max_messages = batch.key
+    if max_messages != None:
+      encoded_messages = encoded_messages[:max_messages]
+      kinds = kinds[:max_messages]
+    if variant != None:
+      encoded_messages = self._variants(start_from, encoded_messages, variant)
+    # Deletions among skipped messages are still sent, since they can be about messages already on screen
+    deletions = self._readDeletions(first_id, start_from) if start_from > first_id else []
+    batch.complete(start_from + len(encoded_messages) - 1, tuple(deletions + encoded_messages), tuple([DELETION_ENTRY] * len(deletions) + kinds), start_from - first_id - len(deletions))
+
+  # Gets another batch for a client whose overlay options changed while it was waiting for the given one
+  def _recheckOptions(self, batch, overlay_options):
+    if batchKey(batch.key[0], overlay_options, batch.key[3]) == batch.key:
+      return batch
+    batch = MessageBatch(batchKey(batch.key[0], overlay_options, batch.key[3]))
+    self._completeBatch(batch)
+    return batch
+
+  # Forgets a batch that is still waiting for messages once none of its clients wait for it anymore
+  # Readers must be locked by calling function
+  def _cancelWait(self, batch, waiter):
+    batch.removeWaiter(waiter)
+    if batch.waiters == 0 and self.waiting_batches.get(batch.key) is batch:
+      del self.waiting_batches[batch.key]
+      # Let the thread watching for messages stop, now that no readers wait
+      if len(self.waiting_batches) == 0 and self.watching:
+        try:
+          os.write(self.wakeup_pipe_writer, b"\0")
+        except BlockingIOError:
+          pass
+
+  # Encodes messages from given message ID on as a single variant, reusing the ones that were requested before in this process
+  def _variants(self, start_from, encoded_messages, variant):
+    buffer = self.variant_encoded_queues.get(variant)
+    if buffer == None:
+      buffer = [None] * self.capacity
+      self.variant_encoded_queues[variant] = buffer
+    variant_messages = []
+    for mid, encoded_msg in enumerate(encoded_messages, start_from):
+      cached = buffer[mid % self.capacity]
+      if cached == None or cached[0] != mid or cached[1] != encoded_msg or not variantIsCurrent(variant, cached[2]):
+        cached = (mid, encoded_msg, variantStamp(variant), encodeMessageVariant(decodeMessage(encoded_msg), variant))
+        buffer[mid % self.capacity] = cached
+      variant_messages.append(cached[3])
+    return variant_messages
+
+  # Returns counters of the queue, to help with tuning the size of the ring
+  def stats(self):
+    with self.lock:
+      return {
+        "messages": self._length(),
+        "capacity": self.capacity,
+        "data_bytes": self.data_head - self._slot(self.oldest_message_id)[0] if self._length() > 0 else 0,
+        "data_size": self.data_size,
+        "dropped": self.dropped
+      }
+
+  # Removes the shared memory, once no process needs the queue anymore
+  # Only the process that created the queue should call this
+  def close(self):
+    self.shm.unlink()
+    # Stops the thread taking in pipes
+    self.watcher_registrations.shutdown(socket.SHUT_RDWR)
+    self.watcher_registrations.close()
+    self.watcher_registration_sender.close()
+    for pipe_writer in self.watcher_pipes:
+      os.close(pipe_writer)
+    self.watcher_pipes = []
+
+  # Prints current queue state to console
+  def debugQueue(self):
+    message_id, next_message_id, first_id, start_from, encoded_messages, kinds = self._read(-1)
+    print("message_id:", next_message_id)
+    print("oldest_message_id:", start_from)
+    print("queue:", [json.loads(encoded_msg) for encoded_msg in encoded_messages])
+
+
+# Creates a chat queue with the configured backend
+def createChatQueue():
+  if QUEUE_BACKEND == "shared":
+    return SharedChatQueue()
+  return ChatQueue()
+
+
+# Append-only journal of the messages of a channel, so its chat queue can be restored after a restart
+# Messages are stored as lines of pre-encoded JSON, in segment files named after the ID of their first message
+# Segments are started when the current one gets too big or too old, and removed once all of their messages left the queue
+class ChatJournal():
+  SEGMENT_SUFFIX = ".journal"
+
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(self.path, exist_ok=True)
+    self.lock = Lock()
+    self.file = None
+    self.segment_name = None
+    self.segment_size = 0
+    self.segment_started_at = None
+    # Whether there are writes that weren't synced to disk yet
+    self.dirty = False
+    self.appended = 0
+    self.fsyncs = 0
+    self.rotations = 0
+    if JOURNAL_FSYNC_INTERVAL > 0:
+      Thread(target=self._syncPeriodically, daemon=True).start()
+
+  # Gets the segments of the journal, as a list of tuples of first message ID and file name, from oldest to newest
+  def _segments(self):
+    segments = []
+    for name in os.listdir(self.path):
+      if name.endswith(self.SEGMENT_SUFFIX):
+        try:
+          segments.append((int(name.removesuffix(self.SEGMENT_SUFFIX)), name))
+        except ValueError:
+          pass
+    segments.sort()
+    return segments
+
+  # Reads the newest messages of the journal, going through segments from the end, until there's enough of them or they've expired
+  # Returns a tuple of the list of pre-encoded messages from oldest to newest, and the ID the next message should have
+  def replay(self, count_limit):
+    segments = self._segments()
+    next_message_id = segments[-1][0] if len(segments) > 0 else 0
+    newest_message_id = None
+    encoded_messages = []
+    target_time = int(time.time()) - QUEUE_MSG_TIMEOUT
+    done = False
+    for first_message_id, name in reversed(segments):
+      with open(os.path.join(self.path, name), 'rb') as segment:
+        if os.fstat(segment.fileno()).st_size == 0:
+          continue
+        with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+          # A message that was only partly written before stopping doesn't end with a newline, so it's skipped
+          end = data.rfind(b"\n")
+          while end != -1 and len(encoded_messages) < count_limit:
+            start = data.rfind(b"\n", 0, end) + 1
+            encoded_msg = data[start:end]
+            end = start - 1
+            try:
+              msg = json.loads(encoded_msg)
+              message_id, timestamp = msg["mid"], msg["timestamp"]
+            except (ValueError, TypeError, KeyError):
+              done = True
+              break
+            if newest_message_id == None:
+              newest_message_id = message_id
+              next_message_id = max(next_message_id, message_id + 1)
+            # Stop at expired messages, and at gaps in message IDs, which would mean part of the journal is missing
+            elif message_id != newest_message_id - len(encoded_messages):
+              done = True
+              break
+            if timestamp <= target_time:
+              done = True
+              break
+            encoded_messages.append(encoded_msg)
+      if done or len(encoded_messages) >= count_limit:
+        break
+    # Messages only fit in the queue if they come right before the next message ID
+    if newest_message_id != None and newest_message_id + 1 != next_message_id:
+      encoded_messages = []
+    encoded_messages.reverse()
+    return (encoded_messages, next_message_id)
+
+  # Starts a new segment, where the next message has the given ID, and removes the ones without messages from the oldest one in the queue on
+  # Journal must be locked by calling function, if it's already open
+  def _startSegment(self, next_message_id, oldest_message_id):
+    if self.file != None:
+      os.fsync(self.file.fileno())
+      self.file.close()
+      self.rotations += 1
+    self.segment_name = f"{next_message_id:020}{self.SEGMENT_SUFFIX}"
+    # Not buffered, so processes forked from this one have nothing left to write when they exit
+    self.file = open(os.path.join(self.path, self.segment_name), 'ab', buffering=0)
+    self.segment_size = self.file.tell()
+    self.segment_started_at = time.monotonic()
+    self.dirty = False
+    self._removeOldSegments(oldest_message_id)
+
+  # Removes segments whose messages all left the queue, by being evicted or expiring, so they'd never be replayed
+  # Journal must be locked by calling function
+  def _removeOldSegments(self, oldest_message_id):
+    segments = self._segments()
+    for i in range(len(segments) - 1):
+      # Each segment ends right before the next one starts
+      if segments[i+1][0] > oldest_message_id:
+        break
+      if segments[i][1] == self.segment_name:
+        continue
+      try:
+        os.remove(os.path.join(self.path, segments[i][1]))
+      except FileNotFoundError:
+        pass
+
+  # Opens the journal for writing, where the next message has the given ID, and the oldest message in the queue has the other one
+  def open(self, next_message_id, oldest_message_id):
+    with self.lock:
+      self._startSegment(next_message_id, oldest_message_id)
+
+  # Writes messages to the journal, starting a new segment first if the current one is too big or too old
+  # Takes the ID of the oldest message in the queue, so segments with only older messages can be removed
+  def append(self, encoded_messages, first_message_id, oldest_message_id):
+    with self.lock:
+      # Closed when stopping
+      if self.file == None:
+        return
+      if self.segment_size >= JOURNAL_SEGMENT_SIZE or time.monotonic() - self.segment_started_at >= JOURNAL_SEGMENT_AGE:
+        self._startSegment(first_message_id, oldest_message_id)
+      data = b"\n".join(encoded_messages) + b"\n"
+      self.file.write(data)
+      self.segment_size += len(data)
+      self.appended += len(encoded_messages)
+      self.dirty = True
+      if JOURNAL_FSYNC_INTERVAL == 0:
+        self._sync()
+
+  # Makes sure messages written to the journal are on disk
+  # Journal must be locked by calling function
+  def _sync(self):
+    os.fsync(self.file.fileno())
+    self.dirty = False
+    self.fsyncs += 1
+
+  # Syncs the journal to disk every few seconds, if anything was written to it
+  # Syncs a duplicate of the file descriptor, so writing doesn't have to wait for the disk
+  def _syncPeriodically(self):
+    while True:
+      time.sleep(JOURNAL_FSYNC_INTERVAL)
+      with self.lock:
+        if self.file == None or not self.dirty:
+          continue
+        fd = os.dup(self.file.fileno())
+        self.dirty = False
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      with self.lock:
+        self.fsyncs += 1
+
+  # Syncs and closes the journal
+  def close(self):
+    with self.lock:
+      if self.file != None:
+        self._sync()
+        self.file.close()
+        self.file = None
+
+  # Returns counters of the journal
+  def stats(self):
+    with self.lock:
+      return {
+        "segment": self.segment_name,
+        "segment_size": self.segment_size,
+        "appended": self.appended,
+        "fsyncs": self.fsyncs,
+        "rotations": self.rotations
+      }
+
+
+# Checks if the journal of a channel has segments that were written to since their messages would have expired
+def journalHasMessages(path):
+  target_time = time.time() - QUEUE_MSG_TIMEOUT
+  try:
+    names = os.listdir(path)
+  except FileNotFoundError:
+    return False
+  return any([name.endswith(ChatJournal.SEGMENT_SUFFIX) and os.path.getmtime(os.path.join(path, name)) >= target_time for name in names])
+
+
+# Gets the session ID stored in the journal, so overlays can continue where they left off after a restart
+# If the journal doesn't have one yet, or none of the channels have messages left to continue from, the current session ID is stored in it instead
+def journalSessionID(journal_dir, channel_names):
+  path = os.path.join(journal_dir, "session")
+  try:
+    with open(path, 'r') as session_file:
+      session_id = session_file.read().strip()
+    if session_id != "" and any([journalHasMessages(os.path.join(journal_dir, name)) for name in channel_names]):
+      return session_id
+  except FileNotFoundError:
+    pass
+  os.makedirs(journal_dir, exist_ok=True)
+  with open(path + ".tmp", 'w') as session_file:
+    session_file.write(SESSION_ID)
+  os.replace(path + ".tmp", path)
+  return SESSION_ID
+
+
+# Restores the chat queue of every channel from its journal, and writes new messages to it from then on
+def openJournals():
+  journals = {}
+  for name, channel in chat_channels.items():
+    journal = ChatJournal(os.path.join(JOURNAL_DIR, name))
+    encoded_messages, next_message_id = journal.replay(channel.queue.capacity)
+    channel.queue.restoreMessages(encoded_messages, next_message_id)
+    journal.open(next_message_id, next_message_id - len(encoded_messages))
+    channel.queue.journal = journal
+    journals[name] = journal
+    log.info(f"[Journal] Restored {len(encoded_messages)} messages of #{name}, continuing from message ID {next_message_id}")
+  return journals
+
+
+# Image scales that badges and emotes can have
+IMAGE_SCALES = [1, 2, 4]
+
+
+# Picks the image an overlay would show at the given scale, the same way script.js does
+# That's the smallest scale that's big enough, or the biggest one if none are
+def pickImageScale(scales, scale):
+  if scale in scales:
+    return scale
+  best_scale = None
+  for i in [4, 2, 1]:
+    if i in scales and (best_scale == None or i >= scale):
+      best_scale = i
+  return best_scale
+
+
+# Decodes a pre-encoded message, turning the image scales back into numbers, since JSON only has string keys
+def decodeMessage(encoded_msg):
+  msg = json.loads(encoded_msg)
+  if "badges" in msg:
+    msg["badges"] = [{int(scale): url for scale, url in badge.items()} for badge in msg["badges"]]
+  if "emotes" in msg:
+    for emote in msg["emotes"]:
+      emote["scales"] = {int(scale): url for scale, url in emote["scales"].items()}
+  return msg
+
+
+# Returns a copy of a message, that only has the images an overlay would show at the given scale
+def scaleMessage(msg, scale):
+  def scaleImage(scales):
+    best_scale = pickImageScale(scales, scale)
+    if best_scale == None:
+      return scales
+    return {best_scale: scales[best_scale]}
+
+  scaled_msg = msg.copy()
+  if "badges" in msg:
+    scaled_msg["badges"] = [scaleImage(badge) for badge in msg["badges"]]
+  if "emotes" in msg:
+    scaled_msg["emotes"] = [dict(emote, scales=scaleImage(emote["scales"])) for emote in msg["emotes"]]
+  return scaled_msg
+
+
+# Image URLs of badges and emotes by small integer IDs, which messages in the compact format refer to instead of repeating them
+# Overlays get the definitions once, and then only the ones changed since, so they can look up the IDs themselves
+# Every process serving overlays has its own dictionary, telling overlays apart from the others by its random ID
+# Once it's full, the IDs of the least recently used images are defined again for new ones,
+# so messages encoded before those images were last used are encoded again, since they may refer to them
+class AssetDictionary():
+  # Share of the IDs freed at once when the dictionary is full, so the least recently used images aren't looked for on every new one
+  EVICTION_SHARE = 8
+
+  def __init__(self, size=None):
+    self.size = size if size != None else ASSET_DICTIONARY_SIZE
+    self.id = os.urandom(6).hex()
+    self.lock = Lock()
+    # Lists of ID, the use it was last used by, and whether it was freed, by the image URLs of each scale
+    self.ids = {}
+    # Dicts of image URLs assetID was given, along with their entry of ids, by their identity, since messages share the dicts of the badge and emote tables
+    # The dicts are kept here so their identities aren't reused by other dicts, until they're forgotten all at once when there's too many or the tables change
+    self.objects = {}
+    # Pre-encoded definition of each ID, and IDs that were freed to be defined again
+    self.definitions = []
+    self.free_ids = []
+    # IDs in the order they were defined, overlays keep up by counting how many of these they have
+    self.changes = []
+    # Numbers of uses, which are handed out in order without locking, and the last use of the images whose IDs were freed
+    self.uses = itertools.count()
+    self.valid_after = -1
+    self.redefined = 0
+
+  # Gets the ID of the image with the given URLs of each scale, adding it if it's new
+  def assetID(self, scales):
+    known = self.objects.get(id(scales))
+    if known != None:
+      entry = known[1]
+      entry[1] = next(self.uses)
+      # The ID may have been freed before it was marked as used, which is only noticed if it's marked as freed now
+      if not entry[2]:
+        return entry[0]
+    key = tuple(sorted(scales.items()))
+    entry = self.ids.get(key)
+    if entry != None:
+      entry[1] = next(self.uses)
+      if not entry[2]:
+        self._remember(scales, entry)
+        return entry[0]
+    with self.lock:
+      entry = self.ids.get(key)
+      if entry != None:
+        entry[1] = next(self.uses)
+        self._remember(scales, entry)
+        return entry[0]
+      if len(self.definitions) < self.size:
+        asset_id = len(self.definitions)
+        self.definitions.append(None)
+      else:
+        if len(self.free_ids) == 0:
+          self._freeLeastRecentlyUsed()
+        asset_id = self.free_ids.pop()
+        self.redefined += 1
+      self.definitions[asset_id] = json.dumps(scales).encode('utf-8')
+      self.ids[key] = [asset_id, next(self.uses), False]
+      self._remember(scales, self.ids[key])
+      self.changes.append(asset_id)
+      # Start over with a new dictionary ID once changes pile up, so overlays that are far behind get the current definitions instead
+      if len(self.changes) > 2 * self.size:
+        self.id = os.urandom(6).hex()
+        self.changes = list(range(len(self.definitions)))
+      return asset_id
+
+  # Remembers the entry of a dict of image URLs by its identity, so it's found without sorting its URLs next time
+  # Dicts that don't come from the tables, like ones decoded from shared memory, are new every time, so all of them are forgotten once there's too many
+  def _remember(self, scales, entry):
+    if len(self.objects) >= 2 * self.size:
+      self.objects = {}
+    self.objects[id(scales)] = (scales, entry)
+
+  # Forgets the dicts of image URLs assetID was given, once the tables they come from are replaced
+  def forgetObjects(self):
+    self.objects = {}
+
+  # Frees the IDs of the least recently used images, so they can be defined again
+  # Dictionary must be locked by calling function
+  def _freeLeastRecentlyUsed(self):
+    entries = sorted(self.ids.items(), key=lambda item: item[1][1])[:max(self.size // self.EVICTION_SHARE, 1)]
+    for key, entry in reversed(entries):
+      del self.ids[key]
+      entry[2] = True
+      self.free_ids.append(entry[0])
+      # Read once the image is marked as freed, so uses marked after this find it freed instead
+      self.valid_after = max(self.valid_after, entry[1])
+
+  # Gets the stamp of a message about to be encoded, which isCurrent checks later
+  def stamp(self):
+    return next(self.uses)
+
+  # Checks if a message encoded with the given stamp only refers to current definitions
+  def isCurrent(self, stamp):
+    return stamp > self.valid_after
+
+  # Pre-encodes the definitions an overlay that has the first given number of changes of the dictionary with the given ID is missing
+  # Only the current definition of IDs that were defined more than once is sent
+  # Returns a tuple of the definitions as JSON, or an empty string if it has all of them, the ID of the dictionary, and how many changes it will have
+  def encodeMissing(self, dictionary_id, count):
+    with self.lock:
+      if dictionary_id != self.id:
+        count = 0
+      end = len(self.changes)
+      if count >= end:
+        return (b"", self.id, end)
+      asset_ids = list(dict.fromkeys(self.changes[count:end]))
+      return (b"".join([
+        b'{"dict": "', self.id.encode('utf-8'), f'", "next": {end}, "ids": {json.dumps(asset_ids)}, "defs": ['.encode('utf-8'),
+        b", ".join([self.definitions[asset_id] for asset_id in asset_ids]), b']}'
+      ]), self.id, end)
+
+  # Returns counters of the dictionary, to help with tuning its size
+  def stats(self):
+    with self.lock:
+      return {"id": self.id, "assets": len(self.definitions), "size": self.size, "changes": len(self.changes), "redefined": self.redefined}
+
+asset_dictionary = AssetDictionary()
+
+
+# Returns a copy of a message in the compact format, where badges are asset IDs, and emotes are lists of their start, end and asset ID
+def compactMessage(msg, dictionary):
+  compact_msg = msg.copy()
+  if "badges" in msg:
+    compact_msg["badges"] = [dictionary.assetID(badge) for badge in msg["badges"]]
+  if "emotes" in msg:
+    compact_msg["emotes"] = [[emote["start"], emote["end"], dictionary.assetID(emote["scales"])] for emote in msg["emotes"]]
+  return compact_msg
+
+
+# Variant of messages for overlays that use the compact format
+COMPACT_VARIANT = "compact"
+
+# Encodes a message as a variant an overlay asked for: in the compact format, or with only the images of a single scale
+def encodeMessageVariant(msg, variant):
+  if variant == COMPACT_VARIANT:
+    return encodeEntry(compactMessage(msg, asset_dictionary))
+  return encodeEntry(scaleMessage(msg, variant))
+
+# Gets what a message encoded as a variant from now on is checked against by variantIsCurrent
+def variantStamp(variant):
+  return asset_dictionary.stamp() if variant == COMPACT_VARIANT else None
+
+# Checks if a message encoded as a variant with the given stamp is still valid, which compact ones aren't once the asset IDs they refer to were defined again
+def variantIsCurrent(variant, stamp):
+  return variant != COMPACT_VARIANT or asset_dictionary.isCurrent(stamp)
+
+
+# Wakes up an asyncio client waiting for new messages
+# Must be called from the event loop the future belongs to
+def _resolveFuture(future):
+  if not future.done():
+    future.set_result(None)
+
+
+# Builds the JSON body of a get-messages response from pre-encoded messages
+# If messages were skipped, says how many, and the ID of the last message, so the client continues after the skipped ones
+# Pre-encoded asset definitions the client is missing are added, if there are any
+def encodeMessagesResponse(session_id, encoded_messages, skipped=0, last_message_id=None, assets=b""):
+  envelope = [
+    b'{"sid": ', json.dumps(session_id).encode('utf-8'),
+    b', "messages": [', b", ".join(encoded_messages), b']'
+  ]
+  if skipped > 0:
+    envelope.append(f', "skipped": {skipped}, "last_mid": {last_message_id}'.encode('utf-8'))
+  if assets != b"":
+    envelope += [b', "assets": ', assets]
+  envelope.append(b'}')
+  return b"".join(envelope)
+
+
+# Builds the JSON body of a get-messages response from a batch of new messages
+def messagesResponse(batch, assets=b""):
+  return encodeMessagesResponse(SESSION_ID, batch.messages, batch.skipped, batch.last_message_id, assets)
+
+
+# Twitch channel we show chat of, with its own chat queue and badge and emote tables
+# In IRC worker processes, the queue is a ChatQueueSender
+class ChatChannel():
+  def __init__(self, name, queue=None):
+    self.name = name
+    self.id = None
+    self.queue = queue if queue != None else createChatQueue()
+    self.badge_resolver = None
+    self.bttv_emotes = None
+
+  # Replaces the badge and emote tables of the channel
+  # The ingest pipeline only starts using them after its setTables is called
+  def setTables(self, badges, bttv_emotes):
+    self.badge_resolver = BadgeResolver(badges)
+    self.bttv_emotes = bttv_emotes
+    # Dicts of the old tables are found by their URLs from now on, instead of being kept by the asset dictionary
+    asset_dictionary.forgetObjects()
+
+
+# Files of the overlay that can be requested over HTTP
+STATIC_FILES = ["/script.js", "/ui.html", "/style.css"]
+
+
+# A single file of the overlay, kept in memory along with its gzip compressed version
+class StaticFile():
+  def __init__(self, path, mtime, content):
+    self.mtime = mtime
+    self.content_type = mimetypes.guess_type(path)[0]
+    self.content = content
+    self.content_gzip = gzip.compress(content, mtime=0)
+    # Strong ETags, which have to differ between the plain and the compressed version
+    digest = hashlib.sha1(content).hexdigest()[:20]
+    self.etag = f'"{digest}"'
+    self.etag_gzip = f'"{digest}-gzip"'
+
+
+# Keeps the overlay's files in memory, reloading them when they change on disk
+class StaticFileCache():
+  # How often (in seconds) to check if a file changed on disk
+  CHECK_INTERVAL = 1
+
+  def __init__(self, paths):
+    self.lock = Lock()
+    self.files = {}
+    self.last_checked = {}
+    for path in paths:
+      self._reload(path)
+
+  # Loads a file from disk, if it changed since it was last loaded
+  # Must be called with the lock held, or before the cache is shared
+  def _reload(self, path):
+    self.last_checked[path] = time.monotonic()
+    try:
+      mtime = os.stat(path[1:]).st_mtime_ns
+      cached = self.files.get(path)
+      if cached != None and cached.mtime == mtime:
+        return
+      with open(path[1:], "rb") as f:
+        self.files[path] = StaticFile(path, mtime, f.read())
+      if cached != None:
+        log.info("[Local HTTP] Reloaded", path[1:])
+    except FileNotFoundError:
+      self.files.pop(path, None)
+
+  # Gets a file, or None if it doesn't exist
+  def get(self, path):
+    if not path in self.last_checked:
+      return None
+    with self.lock:
+      if time.monotonic() - self.last_checked[path] >= self.CHECK_INTERVAL:
+        self._reload(path)
+      return self.files.get(path)
+
+
+# Checks if a client accepts gzip compressed responses, based on its Accept-Encoding header
+def acceptsGzip(accept_encoding):
+  if accept_encoding == None:
+    return False
+  for item in accept_encoding.split(','):
+    params = item.split(';')
+    if params[0].strip().lower() != "gzip":
+      continue
+    for param in params[1:]:
+      param = param.strip().replace(' ', '')
+      if param in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+        return False
+    return True
+  return False
+
+
+# Builds the response to a request for one of the overlay's files
+# Returns a tuple of status code, list of headers and body
+def staticFileResponse(path, if_none_match, accept_encoding):
+  static_file = static_file_cache.get(path)
+  # 404 Not Found if the file doesn't exist
+  if static_file == None:
+    return (404, [], b"404 Not Found")
+  # Pick compressed version if the client supports it
+  if acceptsGzip(accept_encoding):
+    etag, body = static_file.etag_gzip, static_file.content_gzip
+  else:
+    etag, body = static_file.etag, static_file.content
+  headers = [
+    ("Access-Control-Allow-Origin", "http://localhost:"+str(LOCAL_PORT)),   # Deny other sites from snooping on our code
+    ("ETag", etag),
+    ("Cache-Control", "no-cache"),                                          # Always revalidate, so changes show up right away
+    ("Vary", "Accept-Encoding")
+  ]
+  # 304 Not Modified if the client already has this version
+  if if_none_match != None and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(',')]):
+    return (304, headers, b"")
+  headers.append(("Content-Type", static_file.content_type))                # Figure out what file type we're sending
+  if body is static_file.content_gzip:
+    headers.append(("Content-Encoding", "gzip"))
+  return (200, headers, body)
+
+
+# Parses the query string of a request path into a dict
+def parseQueryString(path):
+  query = {}
+  separator = path.find('?')
+  if separator == -1 or len(path) > 200:
+    return query
+  for item in path[separator+1:].split('&'):
+    separator = item.find('=')
+    if separator != -1:
+      query[item[:separator]] = item[separator+1:]
+  return query
+
+
+# Splits a request path into the channel it's for and the rest of the path
+# Paths starting with /c/<channel>/ are for that channel, and other paths are for the first channel in the config
+# The channel is None if it isn't one we're in
+def routeRequest(path):
+  if path[:3] != "/c/":
+    return chat_channels[CHANNELS[0]], path
+  end = path.find('/', 3)
+  if end == -1:
+    return None, path
+  return chat_channels.get(path[3:end].lower()), path[end:]
+
+
+# Gets the ID of the last message a get-messages request has already received
+# Returns None if it wasn't given or belongs to another session
+def requestedMessageID(query):
+  if query.get("sid") != SESSION_ID:
+    return None
+  try:
+    return int(query["mid"])
+  except (KeyError, ValueError):
+    return None
+
+
+# Gets the counters of every part of the server
+def collectStats():
+  return {name: provider() for name, provider in list(stats_providers.items())}
+
+
+# Builds the JSON body of a stats response, with the counters of every part of the server
+def encodeStatsResponse():
+  stats = collectStats() if remote_stats == None else remote_stats.collect()
+  return json.dumps(stats).encode('utf-8')
+
+
+# Gets the message ID a reconnecting event stream should continue from
+# Uses the Last-Event-ID header, which has the format "sid:mid", or falls back to the query string
+def requestedEventID(path, last_event_id):
+  if last_event_id != None:
+    separator = last_event_id.rfind(':')
+    if separator != -1:
+      return requestedMessageID({"sid": last_event_id[:separator], "mid": last_event_id[separator+1:]})
+  return requestedMessageID(parseQueryString(path))
+
+
+# Builds a single Server-Sent Event, containing a batch of messages
+# Its ID lets the client resume from the last message it got after reconnecting
+def encodeMessagesEvent(session_id, last_message_id, encoded_messages, skipped=0, assets=b""):
+  return b"".join([
+    b"id: ", f"{session_id}:{last_message_id}".encode('utf-8'),
+    b"\ndata: ", encodeMessagesResponse(session_id, encoded_messages, skipped, last_message_id, assets), b"\n\n"
+  ])
+
+
+# Builds a Server-Sent Event from a batch of new messages
+def messagesEvent(batch, assets=b""):
+  return encodeMessagesEvent(SESSION_ID, batch.last_message_id, batch.messages, batch.skipped, assets)
+
+# Sent first on every event stream, telling the client how fast to reconnect
+SSE_STREAM_START = b"retry: 1000\n\n"
+# Sent when there are no new messages for a while, to detect closed connections
+SSE_KEEP_ALIVE = b": keep-alive\n\n"
+
+
+# Magic value from RFC 6455 used to accept WebSocket handshakes
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# WebSocket frame opcodes
+WS_CONTINUATION = 0x0
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+# Biggest message we accept from overlays, which only send small control messages
+WS_MAX_INCOMING_MESSAGE = 4096
+
+
+# Calculates the Sec-WebSocket-Accept value for a handshake
+def webSocketAcceptKey(key):
+  return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('latin-1')).digest()).decode('latin-1')
+
+
+# Builds a WebSocket handshake response, or returns None if the request isn't a valid WebSocket handshake
+def webSocketHandshake(headers):
+  if headers.get("upgrade", "").lower() != "websocket" or headers.get("sec-websocket-version") != "13":
+    return None
+  key = headers.get("sec-websocket-key")
+  if key == None:
+    return None
+  return (
+    "HTTP/1.1 101 Switching Protocols\r\n"
+    "Upgrade: websocket\r\n"
+    "Connection: Upgrade\r\n"
+    f"Sec-WebSocket-Accept: {webSocketAcceptKey(key)}\r\n\r\n"
+  ).encode('latin-1')
+
+
+# Builds a single unmasked WebSocket frame, as sent by servers
+def encodeWebSocketFrame(opcode, payload):
+  if len(payload) < 126:
+    header = struct.pack("!BB", 0x80 | opcode, len(payload))
+  elif len(payload) < 65536:
+    header = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+  else:
+    header = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+  return header + payload
+
+
+# Builds a WebSocket frame from a batch of new messages
+def messagesFrame(batch, assets=b""):
+  return encodeWebSocketFrame(WS_BINARY, batch.response(messagesResponse, assets))
+
+
+# Parses the first two bytes of a WebSocket frame
+# Returns a tuple of FIN flag, opcode, whether the payload is masked, and the payload length (126/127 mean extended length follows)
+def parseWebSocketFrameHeader(header):
+  return (header[0] & 0x80 != 0, header[0] & 0x0F, header[1] & 0x80 != 0, header[1] & 0x7F)
+
+
+# Removes the mask clients put on frame payloads
+def unmaskWebSocketPayload(payload, mask):
+  if len(payload) == 0:
+    return payload
+  repeated_mask = (mask * (len(payload) // 4 + 1))[:len(payload)]
+  return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated_mask, 'big')).to_bytes(len(payload), 'big')
+
+
+# Sent when there are no new messages for a while, to detect closed connections
+WS_KEEP_ALIVE = encodeWebSocketFrame(WS_PING, b"")
+
+
+# Handles the frames a WebSocket client sends, the same way for both HTTP servers, which only read the frames and send the replies
+# Overlays only send control messages, which update their overlay options
+class WebSocketReceiver():
+  def __init__(self, overlay_options):
+    self.overlay_options = overlay_options
+    # Payloads of the frames of the message being received, and their total length
+    self.fragments = []
+    self.fragments_length = 0
+    # Set once the connection should be closed
+    self.closed = False
+    # Set when the connection closes, so a thread waiting for new messages to push stops waiting
+    self.wakeup = Event()
+
+  # Marks the connection as closed, and wakes up the thread pushing messages to it
+  def close(self):
+    self.closed = True
+    self.wakeup.set()
+
+  # Checks the header of the next frame, before its payload is read
+  # Messages can't be longer than WS_MAX_INCOMING_MESSAGE, counting all of their frames
+  # Returns the close frame to send if the frame isn't acceptable, or None if it is
+  def checkFrame(self, masked, length):
+    if not masked or self.fragments_length + length > WS_MAX_INCOMING_MESSAGE:
+      self.close()
+      return encodeWebSocketFrame(WS_CLOSE, struct.pack("!H", 1002 if not masked else 1009))
+    return None
+
+  # Handles a frame, with its payload already unmasked
+  # Returns the frame to reply with, or None if there's no reply
+  def handleFrame(self, fin, opcode, payload):
+    if opcode == WS_CLOSE:
+      self.close()
+      return encodeWebSocketFrame(WS_CLOSE, payload[:2])
+    elif opcode == WS_PING:
+      return encodeWebSocketFrame(WS_PONG, payload)
+    elif opcode in [WS_TEXT, WS_BINARY, WS_CONTINUATION]:
+      self.fragments.append(payload)
+      self.fragments_length += len(payload)
+      if fin:
+        self.overlay_options.update(b"".join(self.fragments))
+        self.fragments = []
+        self.fragments_length = 0
+    return None
+
+
+# Display options an overlay sent over its control channel
+class OverlayOptions():
+  def __init__(self):
+    # Most messages the overlay can show at once
+    self.message_count_max = None
+    # Image scale the overlay currently uses
+    self.scale = None
+    # Most messages per second the overlay wants to show, or None for no limit
+    self.max_rate = None
+    # Whether the overlay wants messages in the compact format,
+    # and the ID of the asset dictionary it has, along with how many of its definitions it has
+    self.compact = False
+    self.asset_dictionary_id = None
+    self.asset_count = 0
+
+  # Gets the variant of messages the overlay wants, or None if it wants them as they are in the queue
+  # Overlays using the compact format pick image scales from the asset definitions themselves
+  def variant(self):
+    if self.compact:
+      return COMPACT_VARIANT
+    return self.scale
+
+  # Updates options from the query string of a request, ignoring invalid values
+  def updateFromQuery(self, query):
+    try:
+      message_count_max = int(query["count_max"])
+      if message_count_max > 0:
+        self.message_count_max = message_count_max
+    except (KeyError, ValueError):
+      pass
+    try:
+      max_rate = float(query["max_rate"])
+      if 0 < max_rate < float("inf"):
+        self.max_rate = max_rate
+    except (KeyError, ValueError):
+      pass
+    self.compact = query.get("fmt") == "compact"
+    # Asset dictionary the overlay has, as its ID and number of definitions, separated by a dot
+    try:
+      dictionary_id, count = query["dv"].split(".")
+      if int(count) >= 0:
+        self.asset_dictionary_id, self.asset_count = dictionary_id, int(count)
+    except (KeyError, ValueError):
+      pass
+
+  # Updates options from a JSON control message, ignoring invalid values
+  def update(self, payload):
+    try:
+      options = json.loads(payload)
+    except (ValueError, UnicodeDecodeError):
+      return
+    if type(options) != dict:
+      return
+    message_count_max = options.get("message_count_max")
+    if type(message_count_max) == int and message_count_max > 0:
+      self.message_count_max = message_count_max
+    scale = options.get("scale")
+    if type(scale) in [int, float] and scale > 0:
+      self.scale = min(int(scale + 0.999), IMAGE_SCALES[-1])
+    max_rate = options.get("max_rate")
+    if type(max_rate) in [int, float] and 0 < max_rate < float("inf"):
+      self.max_rate = max_rate
+    elif "max_rate" in options and max_rate == None:
+      self.max_rate = None
+    fmt = options.get("fmt")
+    if fmt in ["compact", "full"]:
+      self.compact = fmt == "compact"
+
+  # Pre-encodes the asset definitions a client using the compact format is missing, and counts them as sent
+  # Returns an empty string if it doesn't use the compact format, or has all of them
+  def missingAssets(self):
+    if not self.compact:
+      return b""
+    assets, self.asset_dictionary_id, self.asset_count = asset_dictionary.encodeMissing(self.asset_dictionary_id, self.asset_count)
+    return assets
+
+
+# Thins out the messages sent to a single client, so it gets at most as many per second as its overlay wants to show
+# Works like a token bucket, which refills at the overlay's rate, and can hold up to a second worth of messages
+class RateSampler():
+  def __init__(self):
+    self.allowance = None
+    self.updated_at = None
+
+  # Picks the messages to send out of a batch, evenly spread out and always including the newest one
+  # Deletion entries are always sent, and tombstones never, since the client never got the messages they replaced
+  # Returns a tuple of the picked messages, their kinds, and how many were dropped
+  def sample(self, encoded_messages, kinds, max_rate):
+    now = time.monotonic()
+    if self.updated_at == None:
+      self.allowance = max(max_rate, 1)
+    else:
+      self.allowance = min(self.allowance + (now - self.updated_at) * max_rate, max(max_rate, 1))
+    self.updated_at = now
+    candidates = [i for i, kind in enumerate(kinds) if kind == MESSAGE_ENTRY]
+    budget = min(int(self.allowance), len(candidates))
+    self.allowance -= budget
+    picked = set([candidates[(j + 1) * len(candidates) // budget - 1] for j in range(budget)])
+    kept = [i for i, kind in enumerate(kinds) if i in picked or kind == DELETION_ENTRY]
+    return ([encoded_messages[i] for i in kept], [kinds[i] for i in kept], len(candidates) - budget)
+
+
+# Gets the response to send a single client from a batch, built by the given function
+# Unless its rate limit drops some messages, the response is shared with all clients getting the same batch
+# Clients using the compact format also get the asset definitions they are missing, so only the ones that have the same ones share it
+def clientResponse(batch, build, overlay_options, rate_sampler):
+  assets = overlay_options.missingAssets()
+  if overlay_options.max_rate == None or len(batch.messages) == 0:
+    return batch.response(build, assets)
+  messages, kinds, dropped = rate_sampler.sample(batch.messages, batch.kinds, overlay_options.max_rate)
+  if dropped == 0:
+    return batch.response(build, assets)
+  return build(batch.thinned(messages, kinds, dropped), assets)
+
+
+# How a long-polling client wants its new messages batched, from the config or its own query parameters
+class BatchPolicy():
+  def __init__(self, query=None):
+    if query == None:
+      query = {}
+    # Fewest messages to send at once, unless the most milliseconds to wait for more after the first ones are there passed
+    self.min_messages = BATCH_MIN_MESSAGES
+    self.max_delay = BATCH_MAX_DELAY
+    # Most messages to send at once, or 0 for no limit
+    self.max_messages = BATCH_MAX_MESSAGES
+    # Values from the query string override the config, ignoring invalid ones
+    for name, param in [("min_messages", "batch_min"), ("max_delay", "batch_delay"), ("max_messages", "batch_max")]:
+      try:
+        value = int(query[param])
+      except (KeyError, ValueError):
+        continue
+      if value >= 0:
+        setattr(self, name, value)
+
+  # Gets why a batch should be sent right away, or None if it should wait for more messages
+  def sendReason(self, batch):
+    if self.max_messages > 0 and len(batch.messages) >= self.max_messages:
+      return "max_messages"
+    if len(batch.messages) >= self.min_messages:
+      return "min_messages"
+    if self.max_delay == 0:
+      return "max_delay"
+    return None
+
+
+# Counters of how get-messages responses were batched, to help with tuning the batching policy
+class BatchingStats():
+  # Largest batch size counted in each bucket, with one more bucket for bigger batches
+  SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100]
+
+  def __init__(self):
+    self.lock = Lock()
+    self.responses = 0
+    self.empty = 0
+    self.messages = 0
+    self.sizes = [0] * (len(self.SIZE_BUCKETS) + 1)
+    # Seconds batches were held back for more messages after the first ones were there
+    self.delay_total = 0
+    self.delay_max = 0
+    # Why batches were sent
+    self.reasons = {"backlog": 0, "min_messages": 0, "max_delay": 0, "max_messages": 0}
+
+  # Counts a response, with its batch, how long it was held back, and why it was sent
+  def record(self, batch, delay, reason):
+    with self.lock:
+      self.responses += 1
+      if len(batch.messages) == 0:
+        self.empty += 1
+        return
+      self.messages += len(batch.messages)
+      bucket = 0
+      while bucket < len(self.SIZE_BUCKETS) and len(batch.messages) > self.SIZE_BUCKETS[bucket]:
+        bucket += 1
+      self.sizes[bucket] += 1
+      self.delay_total += delay
+      self.delay_max = max(self.delay_max, delay)
+      self.reasons[reason] += 1
+
+  def stats(self):
+    with self.lock:
+      batches = self.responses - self.empty
+      labels = []
+      for i, size in enumerate(self.SIZE_BUCKETS):
+        smallest = self.SIZE_BUCKETS[i-1] + 1 if i > 0 else 1
+        labels.append(str(size) if smallest == size else f"{smallest}-{size}")
+      labels.append(f"{self.SIZE_BUCKETS[-1] + 1}+")
+      return {
+        "responses": self.responses,
+        "empty": self.empty,
+        "mean_size": self.messages / batches if batches > 0 else 0,
+        "sizes": dict(zip(labels, self.sizes)),
+        "mean_delay_ms": self.delay_total / batches * 1000 if batches > 0 else 0,
+        "max_delay_ms": self.delay_max * 1000,
+        "reasons": dict(self.reasons)
+      }
+
+batching_stats = BatchingStats()
+
+
+# Batches new messages for a long-polling client as its policy wants, for both getCoalescedBatch and getCoalescedBatchAsync:
+# once there are new messages, keeps waiting for more until there are enough of them, or the policy's delay passed
+# Messages that were already in queue when the client asked are sent right away, since only waiting for new ones can be cut down
+# Yields the arguments of each getNewBatch call it needs, and is sent the batch it returned, until it returns the batch to send
+def coalesceBatch(queue, message_id, timeout, policy, overlay_options):
+  max_messages = policy.max_messages if policy.max_messages > 0 else None
+  backlog = message_id != None and message_id >= -1 and queue.posOfMID(message_id + 1) != None
+  started_at = time.monotonic()
+  batch = yield (message_id, timeout, overlay_options, max_messages)
+  if len(batch.messages) == 0:
+    batching_stats.record(batch, 0, None)
+    return batch
+  if backlog:
+    batching_stats.record(batch, 0, "backlog")
+    return batch
+  available_at = max(started_at, batch.completed_at)
+  reason = policy.sendReason(batch)
+  while reason == None:
+    remaining = available_at + policy.max_delay / 1000 - time.monotonic()
+    # Wait for messages after the ones in the batch, then take all of them from where the client asked
+    if remaining <= 0 or len((yield (batch.last_message_id, remaining, None, None)).messages) == 0:
+      reason = "max_delay"
+      break
+    newer_batch = yield (batch.key[0], 0, overlay_options, max_messages)
+    # Keep the batch if its messages expired in the meantime
+    if len(newer_batch.messages) == 0:
+      reason = "max_delay"
+      break
+    batch = newer_batch
+    reason = policy.sendReason(batch)
+  batching_stats.record(batch, time.monotonic() - available_at, reason)
+  return batch
+
+
+# Gets new messages for a long-polling client like getNewBatch, but batched as its policy wants
+# Overlay options are applied to every batch, so only the newest messages the overlay has room for are sent
+def getCoalescedBatch(queue, message_id, timeout, policy, overlay_options=None):
+  coalescing = coalesceBatch(queue, message_id, timeout, policy, overlay_options)
+  try:
+    args = next(coalescing)
+    while True:
+      args = coalescing.send(queue.getNewBatch(*args))
+  except StopIteration as done:
+    return done.value
+
+
+# Same as getCoalescedBatch, but waits in an asyncio event loop instead of blocking the thread
+async def getCoalescedBatchAsync(queue, message_id, timeout, policy, overlay_options=None):
+  coalescing = coalesceBatch(queue, message_id, timeout, policy, overlay_options)
+  try:
+    args = next(coalescing)
+    while True:
+      args = coalescing.send(await queue.getNewBatchAsync(*args))
+  except StopIteration as done:
+    return done.value
+
+
+# Headers of responses in JSON
+def jsonResponseHeaders():
+  return [
+    ("Access-Control-Allow-Origin", "http://localhost:"+str(LOCAL_PORT)),   # Deny other sites from snooping on our code
+    ("Content-Type", "application/json")                                    # Responding in JSON
+  ]
+
+
+# Headers of event streams, which have no length, so they end with the connection
+def eventStreamHeaders():
+  return [
+    ("Access-Control-Allow-Origin", "http://localhost:"+str(LOCAL_PORT)),   # Deny other sites from snooping on our code
+    ("Content-Type", "text/event-stream"),                                  # Streaming events
+    ("Cache-Control", "no-cache"),
+    ("Connection", "close")
+  ]
+
+
+# What a request asks for, figured out the same way by both HTTP servers, which then only do the I/O
+# Kinds of requests are:
+# - "response": status, headers and body are sent right away
+# - "messages": long-polls the channel's queue for new messages, which are sent with messagesResponse
+# - "events": status, headers and body start an event stream, which sends streamChunk with messagesEvent after each wait for new messages
+# - "websocket": body is the handshake, after which streamChunk with messagesFrame is sent after each wait for new messages
+class Route():
+  def __init__(self, kind, status=200, headers=None, body=b"", channel=None, query=None, message_id=None):
+    self.kind = kind
+    self.status = status
+    self.headers = headers if headers != None else []
+    self.body = body
+    # Whether the connection can't be kept alive after the response
+    self.close = kind in ["events", "websocket"] or status == 400
+    self.channel = channel
+    # Message ID to continue from, and how the client wants its messages
+    self.message_id = message_id
+    self.options = OverlayOptions()
+    self.policy = None
+    if query != None:
+      self.options.updateFromQuery(query)
+      self.policy = BatchPolicy(query)
+
+  # Builds the response to a long-polling request from the batch of new messages it waited for
+  # Returns a tuple of status code, list of headers and body
+  def messagesResponse(self, batch, rate_sampler):
+    return (200, jsonResponseHeaders(), clientResponse(batch, messagesResponse, self.options, rate_sampler))
+
+  # Builds what a stream sends after waiting for new messages, and continues after them
+  # Returns the messages built by the given function, or the keep-alive if there were none
+  def streamChunk(self, batch, build, keep_alive, rate_sampler):
+    self.message_id = batch.last_message_id
+    if len(batch.messages) > 0:
+      return clientResponse(batch, build, self.options, rate_sampler)
+    return keep_alive
+
+
+# Figures out what a request asks for, and builds the response right away if it doesn't wait for messages
+# Headers must have lowercase keys
+def routeHTTPRequest(method, path, headers):
+  if method != "GET":
+    return Route("response", 501, [], b"501 Not Implemented")
+  channel, path = routeRequest(path)
+  # Request for a channel we aren't in
+  if channel == None:
+    return Route("response", 404, [], b"404 Not Found")
+
+  # Request is for one of the code files
+  elif path in STATIC_FILES:
+    return Route("response", *staticFileResponse(path, headers.get("if-none-match"), headers.get("accept-encoding")))
+
+  # Request for chat messages
+  elif path == "/get-messages" or path[:14] == "/get-messages?":
+    query = parseQueryString(path)
+    return Route("messages", channel=channel, query=query, message_id=requestedMessageID(query))
+
+  # Counters for tuning the server
+  elif path == "/stats":
+    return Route("response", 200, jsonResponseHeaders(), encodeStatsResponse())
+
+  # Stream of chat messages using Server-Sent Events
+  elif path == "/events" or path[:8] == "/events?":
+    return Route("events", 200, eventStreamHeaders(), SSE_STREAM_START, channel, parseQueryString(path), requestedEventID(path, headers.get("last-event-id")))
+
+  # WebSocket connection, which pushes batches of messages as binary frames
+  elif path == "/ws" or path[:4] == "/ws?":
+    handshake = webSocketHandshake(headers)
+    if handshake == None:
+      return Route("response", 400, [], b"400 Bad Request")
+    query = parseQueryString(path)
+    return Route("websocket", 101, [], handshake, channel, query, requestedMessageID(query))
+
+  # Request for non-existent path
+  return Route("response", 404, [], b"404 Not Found")
+
+
+# HTTP request handler
+# Uses HTTP/1.1, so overlays can keep polling over the same connection
+class Response(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  # Applies the idle timeout to connections kept alive between requests
+  def setup(self):
+    self.timeout = HTTP_KEEP_ALIVE_TIMEOUT
+    self.requests_handled = 0
+    self.rate_sampler = RateSampler()
+    super().setup()
+
+  def do_GET(self):
+    self.requests_handled += 1
+    route = routeHTTPRequest("GET", self.path, {key.lower(): value for key, value in self.headers.items()})
+    try:
+      if route.close:
+        self.close_connection = True
+      if route.kind == "response":
+        self._respond(route.status, route.headers, route.body)
+
+      # Send response in JSON, built once from the already encoded messages for all clients waiting for them
+      elif route.kind == "messages":
+        batch = getCoalescedBatch(route.channel.queue, route.message_id, HTTP_REQUEST_TIMEOUT, route.policy, route.options)
+        self._respond(*route.messagesResponse(batch, self.rate_sampler))
+
+      # Push new messages as soon as they arrive, until the client disconnects
+      elif route.kind == "events":
+        self.send_response(route.status)
+        for key, value in route.headers:
+          self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(route.body)
+        while True:
+          batch = route.channel.queue.getNewBatch(message_id=route.message_id, timeout=HTTP_REQUEST_TIMEOUT, overlay_options=route.options)
+          self.wfile.write(route.streamChunk(batch, messagesEvent, SSE_KEEP_ALIVE, self.rate_sampler))
+
+      elif route.kind == "websocket":
+        self.wfile.write(route.body)
+        self.log_request(101)
+        # The connection isn't idle while waiting for control messages
+        self.connection.settimeout(None)
+        self._serveWebSocket(route)
+
+    except (BrokenPipeError, ConnectionResetError):
+      log.info("[Local HTTP] Connection closed by client", self.client_address)
+
+  # Sends request logs through the console logger, at the debug level
+  def log_message(self, format, *args):
+    if log.enabled("debug"):
+      log.debug("[Local HTTP] %s - - [%s] %s" % (self.address_string(), self.log_date_time_string(), format % args))
+
+  # Sends a response with the given status code, headers and body, keeping the connection alive if possible
+  def _respond(self, status, headers, body):
+    if self.requests_handled >= HTTP_KEEP_ALIVE_MAX_REQUESTS:
+      self.close_connection = True
+    self.send_response(status)
+    for key, value in headers:
+      self.send_header(key, value)
+    if status != 304:
+      self.send_header("Content-Length", str(len(body)))
+    if self.close_connection:
+      self.send_header("Connection", "close")
+    else:
+      self.send_header("Keep-Alive", f"timeout={HTTP_KEEP_ALIVE_TIMEOUT}, max={HTTP_KEEP_ALIVE_MAX_REQUESTS - self.requests_handled}")
+    self.end_headers()
+    self.wfile.write(body)
+
+  # Pushes new messages to a WebSocket client, while another thread reads its control messages
+  def _serveWebSocket(self, route):
+    receiver = WebSocketReceiver(route.options)
+    write_lock = Lock()
+
+    def send(frame):
+      with write_lock:
+        self.wfile.write(frame)
+
+    def receive():
+      try:
+        while not receiver.closed:
+          fin, opcode, masked, length = parseWebSocketFrameHeader(self.rfile.read(2))
+          if length == 126:
+            length = struct.unpack("!H", self.rfile.read(2))[0]
+          elif length == 127:
+            length = struct.unpack("!Q", self.rfile.read(8))[0]
+          reply = receiver.checkFrame(masked, length)
+          if reply == None:
+            mask = self.rfile.read(4)
+            reply = receiver.handleFrame(fin, opcode, unmaskWebSocketPayload(self.rfile.read(length), mask))
+          if reply != None:
+            send(reply)
+      except (struct.error, IndexError, OSError):
+        pass
+      receiver.close()
+
+    Thread(target=receive, daemon=True).start()
+    # Push new messages as soon as they arrive, until the client disconnects, which also stops the wait for them
+    while True:
+      # Cleared before checking if the connection closed, so closing it after the check still wakes up the wait
+      receiver.wakeup.clear()
+      if receiver.closed:
+        break
+      batch = route.channel.queue.getNewBatch(message_id=route.message_id, timeout=HTTP_REQUEST_TIMEOUT, overlay_options=route.options, wakeup=receiver.wakeup)
+      if receiver.closed:
+        break
+      send(route.streamChunk(batch, messagesFrame, WS_KEEP_ALIVE, self.rate_sampler))
+
+
+# Parses the header lines of a raw HTTP request into a dict with lowercase keys
+def parseHeaders(request):
+  headers = {}
+  for line in request.decode('latin-1').split("\r\n")[1:]:
+    separator = line.find(':')
+    if separator != -1:
+      headers[line[:separator].strip().lower()] = line[separator+1:].strip()
+  return headers
+
+
+# HTTP server running on an asyncio event loop
+# Clients waiting for new messages are futures instead of threads, so idle clients cost almost nothing
+# Has the same serve_forever/shutdown interface as ThreadingHTTPServer
+# If a listening socket is given, it's used instead of binding to the address
+class AsyncHTTPServer():
+  def __init__(self, server_address, sock=None):
+    self.server_address = server_address
+    self.sock = sock
+    self.loop = None
+    self._stop = None
+
+  # Runs the server in the calling thread until shutdown is called
+  def serve_forever(self):
+    asyncio.run(self._serve())
+
+  async def _serve(self):
+    self.loop = asyncio.get_running_loop()
+    self._stop = asyncio.Event()
+    if self.sock != None:
+      server = await asyncio.start_server(self._handleConnection, sock=self.sock)
+    else:
+      server = await asyncio.start_server(self._handleConnection, *self.server_address)
+    async with server:
+      await self._stop.wait()
+
+  # Stops the server, can be called from any thread
+  def shutdown(self):
+    if self.loop != None:
+      self.loop.call_soon_threadsafe(self._stop.set)
+
+  # Handles a single client connection, serving requests until it's closed or has been idle for too long
+  async def _handleConnection(self, reader, writer):
+    client_address = writer.get_extra_info('peername')
+    requests_handled = 0
+    rate_sampler = RateSampler()
+    try:
+      keep_alive = True
+      while keep_alive:
+        # Read request line and headers
+        try:
+          timeout = HTTP_KEEP_ALIVE_TIMEOUT if requests_handled > 0 else HTTP_REQUEST_TIMEOUT
+          request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+          return
+        requests_handled += 1
+        keep_alive = await self._handleRequest(reader, writer, request, requests_handled, rate_sampler)
+    except (BrokenPipeError, ConnectionResetError):
+      log.info("[Local HTTP] Connection closed by client", client_address)
+    finally:
+      writer.close()
+
+  # Handles a single request
+  # Returns whether the connection can be kept alive for more requests
+  # Rate sampler keeps the rate limits of clients over all requests on the connection
+  async def _handleRequest(self, reader, writer, request, requests_handled, rate_sampler):
+    request_line = request[:request.find(b"\r\n")].decode('latin-1').split(' ')
+    headers = parseHeaders(request)
+    if len(request_line) != 3:
+      await self._respond(writer, 400, [], b"400 Bad Request", False)
+      return False
+    method, path, version = request_line
+    # Figure out if the client wants to keep the connection alive
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+      keep_alive = connection != "close"
+    else:
+      keep_alive = connection == "keep-alive"
+    if requests_handled >= HTTP_KEEP_ALIVE_MAX_REQUESTS:
+      keep_alive = False
+    # Skip request body, if there is one
+    try:
+      body_length = int(headers.get("content-length", 0))
+    except ValueError:
+      await self._respond(writer, 400, [], b"400 Bad Request", False)
+      return False
+    if body_length > 0:
+      await reader.readexactly(body_length)
 
+    route = routeHTTPRequest(method, path, headers)
+    if route.close:
+      keep_alive = False
+    if route.kind == "response":
+      await self._respond(writer, route.status, route.headers, route.body, keep_alive, requests_handled)
 
-# Chat queue
-class ChatQueue():
-  def __init__(self):
-    self.queue = []
-    self.message_id = 0
-    self.oldest_message_id = 0
-    self.lock = Condition()
-    Thread(target=self._timeoutMessages, daemon=True).start()
+    elif route.kind == "messages":
+      batch = await getCoalescedBatchAsync(route.channel.queue, route.message_id, HTTP_REQUEST_TIMEOUT, route.policy, route.options)
+      await self._respond(writer, *route.messagesResponse(batch, rate_sampler), keep_alive, requests_handled)
 
-  # Adds messages to queue
-  def addMessages(self, msg_list):
-    with self.lock:
-      messages_added = False
-      for msg in msg_list:
-        # Remove message if queue is full
-        while len(self.queue) >= QUEUE_MSG_COUNT_LIMIT:
-          self.queue.remove(self.queue[0])
-          self.oldest_message_id += 1
-        # Add message to queue
-        msg_for_queue = msg.copy()
-        msg_for_queue["timestamp"] = int(time.time())
-        msg_for_queue["mid"] = self.message_id
-        self.queue.append(msg_for_queue)
-        self.message_id += 1
-        # Mark that at least one new message was added
-        messages_added = True
-      # Wake up threads waiting for new messages
-      self.lock.notify_all()
+    # Push new messages as soon as they arrive, until the client disconnects
+    elif route.kind == "events":
+      writer.write(self._responseHead(route.status, route.headers) + route.body)
+      await writer.drain()
+      while True:
+        batch = await route.channel.queue.getNewBatchAsync(message_id=route.message_id, timeout=HTTP_REQUEST_TIMEOUT, overlay_options=route.options)
+        writer.write(route.streamChunk(batch, messagesEvent, SSE_KEEP_ALIVE, rate_sampler))
+        await writer.drain()
 
-  # Automatically removes messages from queue
-  def _timeoutMessages(self):
-    target_time = 0
-    while True:
-      oldest_message_timestamp = None
-      with self.lock:
-        # Remove all expired messages
-        target_time = int(time.time()) - QUEUE_MSG_TIMEOUT
-        while len(self.queue) > 0 and self.queue[0]["timestamp"] <= target_time:
-          self.queue.remove(self.queue[0])
-          self.oldest_message_id += 1
-        # If queue is empty, wait until there's an item to remove
-        while len(self.queue) == 0:
-          self.lock.wait()
-        oldest_message_timestamp = self.queue[0]["timestamp"]
-      # Wait until it's time to remove the oldest message
-      wait_for = oldest_message_timestamp + QUEUE_MSG_TIMEOUT + 1 - time.time()
-      if wait_for > 0:
-        time.sleep(wait_for)
+    elif route.kind == "websocket":
+      writer.write(route.body)
+      await self._serveWebSocket(reader, writer, route, rate_sampler)
 
-  # Gets the position in the array of given message ID
-  # Queue must be locked by calling function
-  # Returns -1 if the message expired, None if message hasn't been received yet, or position of message in array
-  def _posOfMID(self, message_id):
-    if message_id < self.oldest_message_id:
-      return -1
-    elif message_id >= self.message_id:
-      return None
+    return keep_alive
+
+  # Pushes new messages to a WebSocket client, while another task reads its control messages
+  async def _serveWebSocket(self, reader, writer, route, rate_sampler):
+    receiver = WebSocketReceiver(route.options)
+
+    async def receive():
+      try:
+        while not receiver.closed:
+          fin, opcode, masked, length = parseWebSocketFrameHeader(await reader.readexactly(2))
+          if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+          elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+          reply = receiver.checkFrame(masked, length)
+          if reply == None:
+            mask = await reader.readexactly(4)
+            reply = receiver.handleFrame(fin, opcode, unmaskWebSocketPayload(await reader.readexactly(length), mask))
+          if reply != None:
+            writer.write(reply)
+      except (asyncio.IncompleteReadError, OSError):
+        pass
+
+    async def push():
+      # Push new messages as soon as they arrive, until the client disconnects
+      while True:
+        batch = await route.channel.queue.getNewBatchAsync(message_id=route.message_id, timeout=HTTP_REQUEST_TIMEOUT, overlay_options=route.options)
+        writer.write(route.streamChunk(batch, messagesFrame, WS_KEEP_ALIVE, rate_sampler))
+        await writer.drain()
+
+    receiver_task = asyncio.create_task(receive())
+    pusher_task = asyncio.create_task(push())
+    # Stop as soon as the client disconnects, or the connection breaks
+    done, pending = await asyncio.wait([receiver_task, pusher_task], return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+      task.cancel()
+    for task in done:
+      if task.exception() != None and not isinstance(task.exception(), (BrokenPipeError, ConnectionResetError)):
+        raise task.exception()
+    await writer.drain()
+
+  # Builds the status line and headers of a response
+  def _responseHead(self, status, headers):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    for key, value in headers:
+      lines.append(f"{key}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+  # Sends a response with the given status code, headers and body, telling the client if the connection is kept alive
+  async def _respond(self, writer, status, headers, body, keep_alive, requests_handled=0):
+    headers = list(headers)
+    if status != 304:
+      headers.append(("Content-Length", str(len(body))))
+    if keep_alive:
+      headers.append(("Keep-Alive", f"timeout={HTTP_KEEP_ALIVE_TIMEOUT}, max={HTTP_KEEP_ALIVE_MAX_REQUESTS - requests_handled}"))
     else:
-      return message_id - self.oldest_message_id
+      headers.append(("Connection", "close"))
+    writer.write(self._responseHead(status, headers) + body)
+    await writer.drain()
 
-  # Same as above, but locks queue, so it can be safely called externally
-  def posOfMID(self, message_id):
-    with self.lock:
-      return self._posOfMID(message_id)
 
-  # Returns new messages from queue after message ID or waits for new messages if there aren't any
-  def getNewMessages(self, message_id=None, timeout=None):
-    assert type(message_id) == int or message_id == None
-    with self.lock:
-      # Ignore pre-existing messages if message id was not given or is out of bounds
-      if message_id == None or message_id < -1 or message_id >= self.message_id:
-        message_id = self.message_id - 1
-      # Wait for new messages to arrive, if there weren't any or all of them expired
-      if self._posOfMID(message_id + 1) == None or len(self.queue) == 0:
-        if not self.lock.wait(timeout):
-          # Return empty list on timeout
-          return []
-      # Get new messages (if there are any)
-      start_from = self._posOfMID(message_id) + 1
-      new_messages = []
-      assert start_from != None
-      for i in range(start_from, len(self.queue)):
-        new_messages.append(self.queue[i])
-      return new_messages
+# Unescapes an IRCv3 tag value, in a single pass
+def unescapeTagValue(value):
+  result = []
+  start = 0
+  escape = value.find('\\')
+  while escape != -1:
+    result.append(value[start:escape])
+    escaped_char = value[escape+1:escape+2]
+    # Unknown escape codes are replaced by the escaped character, and a lone backslash at the end is dropped
+    result.append(IRC_TAG_ESCAPES.get(escaped_char, escaped_char))
+    start = escape + 2
+    escape = value.find('\\', start)
+  result.append(value[start:])
+  return "".join(result)
 
-  # Prints current queue state to console
-  def debugQueue(self):
-    with self.lock:
-      print("message_id:", self.message_id)
-      print("queue:", self.queue)
+IRC_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
 
 
-# HTTP request handler
-class Response(BaseHTTPRequestHandler):
-  def do_GET(self):
-    global chat_queue
-    try:
-      # Request is for one of the code files
-      if self.path == "/script.js" or self.path == "/ui.html" or self.path == "/style.css":
-        # Make sure the file exists
-        if os.path.exists(self.path[1:]):
-          self.send_response(200)                                                         # Response: 200 OK
-          self.send_header("Access-Control-Allow-Origin", "http://localhost:"+str(LOCAL_PORT))  # Deny other sites from snooping on our code
-          self.send_header("Content-Type", mimetypes.guess_type(self.path)[0])            # Figure out what file type we're sending
-          self.end_headers()
-
-          with open(self.path[1:], "rb") as f:
-            self.wfile.write(f.read())
-
-        # 404 Not Found if the file doesn't exist
-        else:
-          self.send_response(404)     # Response: 404 Not Found
-          self.end_headers()
-          self.wfile.write(b"404 Not Found")
-
-      # Request for chat messages
-      elif self.path == "/get-messages" or self.path[:14] == "/get-messages?":
-        request_sid = None
-        request_mid = None
-        new_messages = None
-        if len(self.path) > 13 and self.path[13] == '?' and len(self.path) <= 100:
-          # Parse SID and MID from path
-          items = self.path[14:].split('&')
-          for item in items:
-            try:
-              separator = item.find("=")
-              if separator != -1:
-                key = item[:separator]
-                value = item[separator+1:]
-                if key == "sid":
-                  request_sid = value
-                elif key == "mid":
-                  request_mid = int(value)
-            except:
-              pass
-
-        if request_sid == SESSION_ID:
-          new_messages = chat_queue.getNewMessages(message_id=request_mid, timeout=HTTP_REQUEST_TIMEOUT)
-        else:
-          new_messages = chat_queue.getNewMessages(timeout=HTTP_REQUEST_TIMEOUT)
-
-        response = {
-          "sid": SESSION_ID,
-          "messages": new_messages,
-        }
-
-        self.send_response(200)                                                         # Response: 200 OK
-        self.send_header("Access-Control-Allow-Origin", "http://localhost:"+str(LOCAL_PORT))  # Deny other sites from snooping on our code
-        self.send_header("Content-Type", "application/json")                            # Responding in JSON
-        self.end_headers()
+# Tags of an IRC message, which are only split when first used, and only unescaped when read
+# Behaves like a dict for the operations the message handlers need
+class IRCTags():
+  __slots__ = ("_raw", "_values", "_decoded")
 
-        # Send response in JSON
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+  def __init__(self, raw_tags):
+    self._raw = raw_tags
+    # Values as they were received, before unescaping
+    self._values = None
+    # Values that have been unescaped or set after parsing
+    self._decoded = {}
 
-      # Request for non-existent path
-      else:
-        self.send_response(404)     # Response: 404 Not Found
-        self.end_headers()
-        self.wfile.write(b"404 Not Found")
+  def _split(self):
+    self._values = {}
+    for tag in self._raw.split(';'):
+      key, separator, value = tag.partition('=')
+      # Key with no value
+      self._values[key] = value if separator else None
+
+  def __getitem__(self, key):
+    if key in self._decoded:
+      return self._decoded[key]
+    if self._values == None:
+      self._split()
+    value = self._values[key]
+    # Only values with escape codes need to be converted
+    if value != None and '\\' in value:
+      value = unescapeTagValue(value)
+      self._decoded[key] = value
+    return value
+
+  def __setitem__(self, key, value):
+    self._decoded[key] = value
+
+  def __contains__(self, key):
+    if key in self._decoded:
+      return True
+    if self._values == None:
+      self._split()
+    return key in self._values
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def keys(self):
+    if self._values == None:
+      self._split()
+    return list(self._values.keys()) + [key for key in self._decoded if not key in self._values]
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
 
-    except BrokenPipeError:
-      print("[Local HTTP] Connection closed by client", self.client_address)
+  def __str__(self):
+    return str(dict(self.items()))
 
 
+# Parsed IRC message
+# Scans the line once, leaving the tags to be parsed only if they're used
 class parsedIRCMessage():
+  __slots__ = ("tags", "nickname", "username", "server", "command", "params")
+
   def __init__(self, raw_message):
     # Check for correct type
     if type(raw_message) != str:
       raise TypeError("Message must be a string")
 
-    tags_segment = None
-    prefix_segment = None
-    command_segment = None
-    params_segment = None
-    start = 0
-    end = 0
-
     self.tags = None
     self.nickname = None
     self.username = None
     self.server = None
-    self.command = []
     self.params = None
 
+    # Ignore line ending
+    end = len(raw_message)
+    if raw_message.endswith('\r\n'):
+      end -= 2
+    start = 0
+
     # Get tags, if any
-    if raw_message[start] == '@':
-      end = raw_message.find(' ', start)
-      if end == -1:
+    if raw_message.startswith('@'):
+      tags_end = raw_message.find(' ', 0, end)
+      if tags_end == -1:
         raise ValueError("Invalid IRC command syntax: End of tags section is missing")
-      tags_segment = raw_message[start+1:end]
-      start = end + 1
-
-      # Parse tags
-      self.tags = {}
-      for tag in tags_segment.split(';'):
-        separator = tag.find('=')
-        if separator == -1:
-          # Key with no value
-          self.tags[tag] = None
-        else:
-          # Key with value
-          key = tag[:separator]
-          value = tag[separator+1:]
-          # Convert escape codes
-          value = value.replace('\\:', ';')\
-                       .replace('\\s', ' ')\
-                       .replace('\\\\', '\\')\
-                       .replace('\\r', '\r')\
-                       .replace('\\n', '\n')
-          self.tags[key] = value
+      self.tags = IRCTags(raw_message[1:tags_end])
+      start = tags_end + 1
 
     # Get prefix, if defined
-    if raw_message[start] == ':':
-      end = raw_message.find(' ', start)
-      if end == -1:
+    if raw_message.startswith(':', start):
+      prefix_end = raw_message.find(' ', start, end)
+      if prefix_end == -1:
         raise ValueError("Invalid IRC command syntax: End of prefix section is missing")
-      prefix_segment = raw_message[start+1:end]
-      start = end + 1
-
-      # Parse prefix
-      user_start = prefix_segment.find('!')
-      host_start = prefix_segment.find('@')
+      user_start = raw_message.find('!', start, prefix_end)
+      host_start = raw_message.find('@', start, prefix_end)
       if user_start == host_start == -1:
-        self.server = prefix_segment
+        self.server = raw_message[start+1:prefix_end]
       else:
         if user_start == -1:    # username not defined, so host is defined
-          self.nickname = prefix_segment[:host_start]
-          self.server = prefix_segment[host_start+1:]
+          self.nickname = raw_message[start+1:host_start]
+          self.server = raw_message[host_start+1:prefix_end]
         else:                   # username defined
-          self.nickname = prefix_segment[:user_start]
+          self.nickname = raw_message[start+1:user_start]
           if host_start == -1:  # but host not defined
-            self.username = prefix_segment[user_start+1:]
+            self.username = raw_message[user_start+1:prefix_end]
           else:                 # all 3 defined
-            self.username = prefix_segment[user_start+1:host_start]
-            self.server = prefix_segment[host_start+1:]
-
-    # Get command, channel and acknowledgement
-    # There are either parameters or the end of line after the command segment
-    end = raw_message.find(':', start)
-    if end == -1:
-      end = raw_message.find('\r\n', start)
-    if end == -1:
-      raise ValueError("Invalid IRC command syntax: End of message not found")
-    command_segment = raw_message[start:end-1]
-    start = end
-    self.command = command_segment.split(' ')
-
-    # Get parameters, if any
-    if raw_message[start] == ':':
-      end = raw_message.find('\r\n', start)
-      if end == -1:
-        raise ValueError("Invalid IRC command syntax: End of message not found")
-      params_segment = raw_message[start+1:end]
-      self.params = params_segment
+            self.username = raw_message[user_start+1:host_start]
+            self.server = raw_message[host_start+1:prefix_end]
+      start = prefix_end + 1
 
+    # Get command, channel and acknowledgement, followed by parameters if there are any
+    params_start = raw_message.find(' :', start, end)
+    if params_start == -1:
+      self.command = raw_message[start:end].split(' ')
+    else:
+      self.command = raw_message[start:params_start].split(' ')
+      self.params = raw_message[params_start+2:end]
+    if self.command[0] == "":
+      raise ValueError("Invalid IRC command syntax: Command is missing")
 
   def __str__(self):
     d = {
-      "tags": self.tags,
+      "tags": dict(self.tags.items()) if self.tags != None else None,
       "nickname": self.nickname,
       "username": self.username,
       "server": self.server,
@@ -359,30 +3078,64 @@ class parsedIRCMessage():
 
 
 # Socket IO wrapper that handles sending and receiving messages from server
+# Received data is read straight into a preallocated buffer, and lines are split from it without copying the rest of the buffer
 class SocketIOWrapper():
-  def __init__(self, sock):
+  def __init__(self, sock, read_size=None):
     self._sock = sock
-    self._receive_buffer = b""
-    self._send_buffer = b""
-    self.incoming_message_queue = Queue()
+    self._read_size = read_size if read_size != None else IRC_READ_SIZE
+    self._receive_buffer = bytearray(self._read_size * 2)
+    self._receive_view = memoryview(self._receive_buffer)
+    # Start of data that hasn't been split into lines yet
+    self._read_pos = 0
+    # End of received data
+    self._write_pos = 0
+    # Where to continue searching for the end of the next line
+    self._scan_pos = 0
+    self._send_buffer = bytearray()
     self.connection_open = True
 
+  # Makes sure there's enough free space at the end of the receive buffer for the next read
+  def _makeRoom(self):
+    if self._write_pos + self._read_size <= len(self._receive_buffer):
+      return
+    # Move the unfinished line to the start of the buffer
+    pending = self._write_pos - self._read_pos
+    if pending > 0:
+      self._receive_view[:pending] = self._receive_view[self._read_pos:self._write_pos]
+    self._scan_pos -= self._read_pos
+    self._read_pos = 0
+    self._write_pos = pending
+    # Grow the buffer if a single line is longer than it
+    if pending + self._read_size > len(self._receive_buffer):
+      self._receive_view.release()
+      self._receive_buffer.extend(bytes(pending + self._read_size - len(self._receive_buffer)))
+      self._receive_view = memoryview(self._receive_buffer)
+
   # Receive new data from socket
+  # Returns a list of all full messages that were received (which may be empty)
   def receive(self):
+    lines = []
     # Grab new data from socket
     if self.connection_open:
-      chunk = self._sock.recv(4096)
+      self._makeRoom()
+      bytes_received = self._sock.recv_into(self._receive_view[self._write_pos:], self._read_size)
       # Check if connection closed
-      if len(chunk) == 0:
-        print("[Twitch IRC] Connection closed by server")
+      if bytes_received == 0:
+        log.warning("[Twitch IRC] Connection closed by server")
         self.connection_open = False
-      # Push to buffer, and check if any full messages were received
-      self._receive_buffer += chunk
-      eol = self._receive_buffer.find(b'\r\n')
+      self._write_pos += bytes_received
+      # Check if any full messages were received
+      eol = self._receive_buffer.find(b'\r\n', self._scan_pos, self._write_pos)
       while eol != -1:
-        self.incoming_message_queue.put(self._receive_buffer[:eol+2].decode('utf-8'))
-        self._receive_buffer = self._receive_buffer[eol+2:]
-        eol = self._receive_buffer.find(b'\r\n')
+        lines.append(str(self._receive_view[self._read_pos:eol+2], 'utf-8'))
+        self._read_pos = eol + 2
+        eol = self._receive_buffer.find(b'\r\n', self._read_pos, self._write_pos)
+      # Next search starts where this one stopped, keeping a byte in case \r\n was split between reads
+      self._scan_pos = max(self._read_pos, self._write_pos - 1)
+      # Everything was split into lines, so start over from the beginning of the buffer
+      if self._read_pos == self._write_pos:
+        self._read_pos = self._write_pos = self._scan_pos = 0
+    return lines
 
   # Put message to send buffer, so it can be sent later
   def sendPrepare(self, message):
@@ -394,28 +3147,112 @@ class SocketIOWrapper():
       bytes_sent = self._sock.send(self._send_buffer)
       # Check if conneciton is closed
       if bytes_sent == 0:
-        print("[Twitch IRC] Connection closed by server")
+        log.warning("[Twitch IRC] Connection closed by server")
         self.connection_open = False
       # Remove part that was sent from buffer
-      self._send_buffer = self._send_buffer[bytes_sent:]
+      del self._send_buffer[:bytes_sent]
 
 
 # HTTP server thread
-def HTTPServerThread():
+# In HTTP server processes, serves on the listening socket they share instead
+def HTTPServerThread(sock=None):
   global http_server
   try:
-    with ThreadingHTTPServer(('127.0.0.1', LOCAL_PORT), Response) as server:
+    if HTTP_SERVER_MODE == "asyncio":
+      http_server = AsyncHTTPServer(('127.0.0.1', LOCAL_PORT), sock)
+      if sock == None:
+        log.info("[Local HTTP] Listening at", LOCAL_PORT, "(asyncio)")
+      http_server.serve_forever()
+      return
+    with ThreadingHTTPServer(('127.0.0.1', LOCAL_PORT), Response, bind_and_activate=sock == None) as server:
       http_server = server
-      print("[Local HTTP] Listening at", LOCAL_PORT)
+      if sock == None:
+        log.info("[Local HTTP] Listening at", LOCAL_PORT)
+      else:
+        server.socket.close()
+        server.socket = sock
       server.serve_forever()
   except Exception as e:
-    print("[Local HTTP] Exception:", e)
+    log.error("[Local HTTP] Exception:", e)
     exit(1)
 
 
+# Gets the counters of the main process from an HTTP server process, adding the ones of the HTTP server process
+class RemoteStats():
+  def __init__(self, connection, index):
+    self.connection = connection
+    self.index = index
+    self.lock = Lock()
+
+  def collect(self):
+    with self.lock:
+      self.connection.send(None)
+      stats = self.connection.recv()
+    stats["http_process"] = {"index": self.index, "pid": os.getpid()}
+    # Responses are batched, and compact messages encoded, by this process, not the main one
+    stats["batching"] = batching_stats.stats()
+    stats["assets"] = asset_dictionary.stats()
+    return stats
+
+
+# Runs in HTTP server processes, which are forked from the main process after the chat queues are created, so they have its config and chat channels
+def HTTPProcessMain(sock, index, connection):
+  global remote_stats, asset_dictionary
+  remote_stats = RemoteStats(connection, index)
+  # Asset IDs only mean something to overlays served by this process
+  asset_dictionary = AssetDictionary()
+  try:
+    HTTPServerThread(sock)
+  except KeyboardInterrupt:
+    pass
+  log.flush()
+
+
+# HTTP servers running in separate processes, which share one listening socket and read the chat queues from shared memory,
+# so serving overlays doesn't compete with IRC ingest for the GIL
+# Has the same shutdown interface as the HTTP servers
+class HTTPServerProcesses():
+  def __init__(self, count):
+    self.count = count
+    self.processes = []
+
+  def start(self):
+    sock = socket.create_server(('127.0.0.1', LOCAL_PORT))
+    for index in range(self.count):
+      receiver, sender = process_context.Pipe()
+      process = process_context.Process(target=HTTPProcessMain, args=(sock, index, sender), daemon=True)
+      process.start()
+      sender.close()
+      self.processes.append(process)
+      Thread(target=self._serveStats, args=(receiver,), daemon=True).start()
+    # Only the HTTP server processes accept connections
+    sock.close()
+    log.info("[Local HTTP] Listening at", LOCAL_PORT, f"({self.count} processes)")
+
+  # Answers requests for counters from an HTTP server process, until it stops
+  def _serveStats(self, connection):
+    try:
+      while True:
+        connection.recv()
+        connection.send(collectStats())
+    except (EOFError, OSError):
+      connection.close()
+
+  # Stops the HTTP server processes, can be called from any thread
+  def shutdown(self):
+    for process in self.processes:
+      process.terminate()
+    for process in self.processes:
+      process.join()
+
+  # Returns the state of every HTTP server process
+  def stats(self):
+    return [{"pid": process.pid, "alive": process.is_alive()} for process in self.processes]
+
+
 # Debug message source, which gets messages from terminal instead of Twitch
 def consoleMessageSource():
-  global chat_queue
+  chat_queue = chat_channels[CHANNELS[0]].queue
   try:
     while True:
       message = input("Enter chat message: ")
@@ -451,22 +3288,121 @@ def hexToANSIColorWrap(hex_color, text):
   return f"\033[38;2;{str(r)};{str(g)};{str(b)}m{text}\033[0m"
 
 
+# Twitch and BetterTTV API endpoints
+TWITCH_VALIDATE_URL = "https://id.twitch.tv/oauth2/validate"
+TWITCH_USERS_URL = "https://api.twitch.tv/helix/users"
+TWITCH_GLOBAL_BADGES_URL = "https://api.twitch.tv/helix/chat/badges/global"
+TWITCH_CHANNEL_BADGES_URL = "https://api.twitch.tv/helix/chat/badges"
+BTTV_GLOBAL_EMOTES_URL = "https://api.betterttv.net/3/cached/emotes/global"
+BTTV_CHANNEL_EMOTES_URL = "https://api.betterttv.net/3/cached/users/twitch/{}"
+
+
+# Cache of API responses, saved to disk so restarts don't have to wait for the APIs
+# Responses younger than the TTL are used without a request, older ones are revalidated with their ETag
+class APICache():
+  def __init__(self, path, ttl):
+    self.path = path
+    self.ttl = ttl
+    self.lock = Lock()
+    self.entries = {}
+    if path == None:
+      return
+    try:
+      with open(path, 'r') as cache_file:
+        self.entries = json.load(cache_file)
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError) as e:
+      log.warning(f"[API Cache] Could not load '{path}':", e)
+
+  # Gets the cached entry for a key, or None
+  def get(self, key):
+    with self.lock:
+      return self.entries.get(key)
+
+  # Seconds since an entry was fetched or revalidated
+  def age(self, entry):
+    return time.time() - entry['time']
+
+  # Stores a response, or marks the cached one as fresh again when data is None
+  def put(self, key, data, etag):
+    with self.lock:
+      if data == None:
+        self.entries[key] = {**self.entries[key], 'time': time.time()}
+      else:
+        self.entries[key] = {'time': time.time(), 'etag': etag, 'data': data}
+
+  # Writes the cache to disk, replacing the old file at once so it's never left half written
+  def save(self):
+    if self.path == None:
+      return
+    with self.lock:
+      try:
+        with open(self.path + ".tmp", 'w') as cache_file:
+          json.dump(self.entries, cache_file)
+        os.replace(self.path + ".tmp", self.path)
+      except OSError as e:
+        log.warning(f"[API Cache] Could not save '{self.path}':", e)
+
+
+# Creates the HTTP session used for API requests, so connections to each API are reused
+def createAPISession():
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+
+# Gets JSON from an API through the cache
+# Cached responses younger than max_age seconds are used without a request, which defaults to the cache TTL
+# Returns the status code and the parsed JSON, which is None if the response wasn't JSON
+# The status code is None if the API couldn't be reached and nothing was cached
+def apiGet(cache_key, url, headers=None, params=None, max_age=None):
+  entry = api_cache.get(cache_key)
+  if entry != None and api_cache.age(entry) < (max_age if max_age != None else api_cache.ttl):
+    return 200, entry['data']
+  headers = dict(headers) if headers != None else {}
+  if entry != None and entry['etag'] != None:
+    headers['If-None-Match'] = entry['etag']
+  try:
+    r = api_session.get(url, headers=headers, params=params, timeout=API_TIMEOUT)
+  except requests.exceptions.RequestException as e:
+    log.warning(f"[API] Request to {url} failed:", e)
+    if entry != None:
+      return 200, entry['data']
+    return None, None
+  # Cached response is still valid
+  if r.status_code == 304 and entry != None:
+    api_cache.put(cache_key, None, None)
+    return 200, entry['data']
+  try:
+    data = r.json()
+  except requests.exceptions.JSONDecodeError:
+    return r.status_code, None
+  if r.status_code == 200:
+    api_cache.put(cache_key, data, r.headers.get('ETag'))
+  return r.status_code, data
+
+
 # Checks if Twitch OAuth token is valid and gets required info about it
 # Returns True/False based on validity of token and required scopes
-def twitchValidateToken():
+def twitchValidateToken(max_age=None):
   global OAUTH_TOKEN, oauth_client_id, username, user_id
-  r = requests.get("https://id.twitch.tv/oauth2/validate", headers={'Authorization': f"OAuth {OAUTH_TOKEN}"})
+  # The cache is keyed by a hash of the token, so the token itself is never saved
+  token_hash = hashlib.sha256(OAUTH_TOKEN.encode('utf-8')).hexdigest()[:16]
+  status_code, r_values = apiGet(f"validate:{token_hash}", TWITCH_VALIDATE_URL, headers={'Authorization': f"OAuth {OAUTH_TOKEN}"},
+                                 max_age=max_age)
   # Invalid token
-  if r.status_code == 401:
-    print("[Twitch API] OAuth token is invalid")
+  if status_code == 401:
+    log.error("[Twitch API] OAuth token is invalid")
+    return False
+  elif status_code != 200 or r_values == None:
+    log.error(f"[Twitch API] Could not check validity of OAuth token: Server responded with {str(status_code)} status code")
     return False
-  elif r.status_code != 200:
-    print(f"[Twitch API] Could not check validity of OAuth token: Server responded with {str(r.status_code)} status code")
-  # Parse JSON
-  r_values = r.json()
   # Check for required scope
   if not "chat:read" in r_values['scopes']:
-    print("[Twitch API] OAuth token is missing scope 'chat:read'")
+    log.error("[Twitch API] OAuth token is missing scope 'chat:read'")
     return False
   # Parse info
   oauth_client_id = r_values['client_id']
@@ -475,47 +3411,47 @@ def twitchValidateToken():
   return True
 
 
-def twitchGetIDOfUser(username):
-  global OAUTH_TOKEN, oauth_client_id
-  headers = {
+# Auth headers for the Twitch Helix API
+def twitchHelixHeaders():
+  return {
     "Authorization": f"Bearer {OAUTH_TOKEN}",
     "Client-Id": oauth_client_id
   }
-  r = requests.get("https://api.twitch.tv/helix/users", headers=headers, params={"login": username})
+
+
+def twitchGetIDOfUser(username, max_age=None):
+  status_code, r_values = apiGet(f"users:{username}", TWITCH_USERS_URL, headers=twitchHelixHeaders(), params={"login": username},
+                                 max_age=max_age)
   # Unauthorized or bad request
-  if r.status_code != 200:
-    print(f"[Twitch API] Could not get user ID: Server responded with {str(r.status_code)} status code")
+  if status_code != 200 or r_values == None:
+    log.error(f"[Twitch API] Could not get user ID: Server responded with {str(status_code)} status code")
     return
-  # Parse info
-  r_values = r.json()
   # No value returned
   if len(r_values['data']) == 0:
-    print(f"[Twitch API] Could not get user ID: Server responded with no data")
+    log.error(f"[Twitch API] Could not get user ID: Server responded with no data")
     return
   return r_values['data'][0]['id']
 
 
-# Gets Twitch global and channel chat badges
-def twitchGetChatBadges():
-  global CHANNEL, oauth_client_id, OAUTH_TOKEN
-  # Auth headers
-  headers = {
-    'Authorization': f"Bearer {OAUTH_TOKEN}",
-    'Client-Id': oauth_client_id
-  }
-  # Get global and channel badges
-  r_global_badges = requests.get("https://api.twitch.tv/helix/chat/badges/global", headers=headers)
-  if r_global_badges.status_code != 200:
-    print(f"[Twitch API] Could not get global chat badges. Server responded with {str(r_global_badges.status_code)}")
-    return
-  r_channel_badges = requests.get("https://api.twitch.tv/helix/chat/badges", headers=headers, params={'broadcaster_id': channel_id})
-  if r_channel_badges.status_code != 200:
-    print(f"[Twitch API] Could not get channel chat badges. Server responded with {str(r_channel_badges.status_code)}")
+# Gets Twitch global chat badge sets, or the ones of a channel if its ID is given
+def twitchGetBadgeSets(broadcaster_id=None, max_age=None):
+  if broadcaster_id == None:
+    status_code, r_values = apiGet("badges:global", TWITCH_GLOBAL_BADGES_URL, headers=twitchHelixHeaders(), max_age=max_age)
+    kind = "global"
+  else:
+    status_code, r_values = apiGet(f"badges:{broadcaster_id}", TWITCH_CHANNEL_BADGES_URL, headers=twitchHelixHeaders(),
+                                   params={'broadcaster_id': broadcaster_id}, max_age=max_age)
+    kind = "channel"
+  if status_code != 200 or r_values == None:
+    log.error(f"[Twitch API] Could not get {kind} chat badges. Server responded with {str(status_code)}")
     return
+  return r_values['data']
+
 
-  # Parse badge info
+# Builds the badge table out of Twitch global and channel badge sets
+def twitchParseChatBadges(badge_sets):
   badges = {}
-  for badge_info in r_global_badges.json()['data'] + r_channel_badges.json()['data']:
+  for badge_info in badge_sets:
     # Badge category level (e.g. subscriber, bits, etc.)
     # Create category in local database if it doesn't exist
     if not badge_info['set_id'] in badges:
@@ -529,45 +3465,96 @@ def twitchGetChatBadges():
       badge_version[2] = badge_version_info['image_url_2x']
       badge_version[4] = badge_version_info['image_url_4x']
       badges[badge_info['set_id']][badge_version_info['id']] = badge_version
-
-  print("[Twitch API] Received chat badges")
   return badges
 
 
+# Resolves the badges tag of chat messages to the URLs of each badge
+# Results are cached by the raw tag, since chatters keep sending the same few combinations of badges
+# The returned lists are shared between messages, so they must not be modified
+class BadgeResolver():
+  def __init__(self, badges, cache_size=None):
+    self.badges = badges
+    self.cache_size = cache_size if cache_size != None else BADGE_CACHE_SIZE
+    self.cache = OrderedDict()
+    self.lock = Lock()
+    self.hits = 0
+    self.misses = 0
+    # Badges we already warned about, so each one is only printed once
+    self.unknown_badges = set()
+
+  # Gets the list of badge URLs for the raw badges tag of a message
+  def resolve(self, raw_badges):
+    if raw_badges == None or raw_badges == "":
+      return []
+    with self.lock:
+      resolved = self.cache.get(raw_badges)
+      if resolved != None:
+        self.hits += 1
+        self.cache.move_to_end(raw_badges)
+        return resolved
+      self.misses += 1
+    resolved = []
+    for badge in raw_badges.split(','):
+      badge_info = badge.split('/')
+      try:
+        resolved.append(self.badges[badge_info[0]][badge_info[1]])
+      except (KeyError, IndexError):
+        # Ignore unknown badges, but warn about them once
+        if not badge in self.unknown_badges:
+          self.unknown_badges.add(badge)
+          log.warning("[Twitch IRC] Unknown badge:", badge)
+    with self.lock:
+      self.cache[raw_badges] = resolved
+      # Forget least recently used badge combinations
+      while len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
+    return resolved
+
+  # Returns cache counters, to help with tuning its size
+  def stats(self):
+    with self.lock:
+      return {
+        "size": len(self.cache),
+        "max_size": self.cache_size,
+        "hits": self.hits,
+        "misses": self.misses,
+        "unknown_badges": len(self.unknown_badges)
+      }
+
+
 # Gets BetterTTV global emotes
-def bttvGetGlobalEmotes():
-  r = requests.get("https://api.betterttv.net/3/cached/emotes/global")
-  if r.status_code != 200:
-    print(f"[BetterTTV] Failed to get global emotes. Server responded with {str(r.status_code)}")
-  try:
-    emotes = {}
-    for emote in r.json():
-      emotes[emote['code']] = emote['id']
-    print("[BetterTTV] Received global emotes")
-    return emotes
-  except requests.exceptions.JSONDecodeError:
-    print("[BetterTTV] Failed to get global emotes: JSON decode error")
-  return {}
+def bttvGetGlobalEmotes(max_age=None):
+  status_code, r_values = apiGet("bttv:global", BTTV_GLOBAL_EMOTES_URL, max_age=max_age)
+  if status_code != 200:
+    log.warning(f"[BetterTTV] Failed to get global emotes. Server responded with {str(status_code)}")
+    return {}
+  if r_values == None:
+    log.warning("[BetterTTV] Failed to get global emotes: JSON decode error")
+    return {}
+  emotes = {}
+  for emote in r_values:
+    emotes[emote['code']] = emote['id']
+  return emotes
 
 
-# Gets BetterTTV channel emotes
-def bttvGetChannelEmotes():
-  global user_id
-  r = requests.get(f"https://api.betterttv.net/3/cached/users/twitch/{user_id}")
-  if r.status_code != 200:
-    print(f"[BetterTTV] Failed to get channel emotes. Server responded with {str(r.status_code)}")
+# Gets BetterTTV emotes of a channel
+def bttvGetChannelEmotes(channel_id, max_age=None):
+  status_code, r_values = apiGet(f"bttv:{channel_id}", BTTV_CHANNEL_EMOTES_URL.format(channel_id), max_age=max_age)
+  if status_code != 200:
+    log.warning(f"[BetterTTV] Failed to get channel emotes. Server responded with {str(status_code)}")
+    return {}
+  if r_values == None:
+    log.warning("[BetterTTV] Failed to get channel emotes: JSON decode error")
+    return {}
   try:
     emotes = {}
-    for emote in r.json()['sharedEmotes']:
+    for emote in r_values['sharedEmotes']:
       emotes[emote['code']] = emote['id']
-    print("[BetterTTV] Received channel emotes")
     return emotes
-  except requests.exceptions.JSONDecodeError:
-    print("[BetterTTV] Failed to get channel emotes: JSON decode error")
   except KeyError:
-    print("[BetterTTV] Failed to get channel emotes: missing values from server response")
+    log.warning("[BetterTTV] Failed to get channel emotes: missing values from server response")
   except TypeError:
-    print("[BetterTTV] Failed to get channel emotes: missing values from server response")
+    log.warning("[BetterTTV] Failed to get channel emotes: missing values from server response")
   return {}
 
 
@@ -581,29 +3568,43 @@ def bttvGetEmoteInfo(emote_id):
   return emote
 
 
-# Scans message for BTTV emotes
-def bttvFindEmotes(msg, global_emotes, channel_emotes):
-  emotes = []
-  pos = 0
-  for part in msg.split(' '):
-    eid = None
-    if part in channel_emotes:
-      eid = channel_emotes[part]
-    elif part in global_emotes:
-      eid = global_emotes[part]
-
-    if eid != None:
-      emotes.append({
-        'start': pos,
-        'end': pos + len(part),
-        'scales': bttvGetEmoteInfo(eid)
-      })
-
-    pos += len(part) + 1
-  return emotes
+# Index of BetterTTV emotes, with channel emotes overriding global ones
+# The URLs of each emote are built once and shared by every message that uses it, so they must not be modified
+class EmoteIndex():
+  def __init__(self, global_emotes, channel_emotes):
+    emote_ids = {**global_emotes, **channel_emotes}
+    scales_by_id = {}
+    self.emotes = {}
+    for code, emote_id in emote_ids.items():
+      if not emote_id in scales_by_id:
+        scales_by_id[emote_id] = bttvGetEmoteInfo(emote_id)
+      self.emotes[code] = scales_by_id[emote_id]
+    # Used to quickly skip messages that can't contain any emote
+    self.min_code_length = min([len(code) for code in self.emotes], default=0)
+    self.first_chars = frozenset(code[0] for code in self.emotes if len(code) > 0)
+
+  # Scans message for emotes
+  def find(self, msg):
+    emotes = []
+    # Skip messages that are too short, or don't have any character an emote code starts with
+    if len(self.emotes) == 0 or len(msg) < self.min_code_length or self.first_chars.isdisjoint(msg):
+      return emotes
+    pos = 0
+    for part in msg.split(' '):
+      scales = self.emotes.get(part)
+      if scales != None:
+        emotes.append({
+          'start': pos,
+          'end': pos + len(part),
+          'scales': scales
+        })
+      pos += len(part) + 1
+    return emotes
 
 
 # Gets URL of Twitch emote
+# URLs are remembered for recently used emotes and shared between messages, so they must not be modified
+@functools.lru_cache(maxsize=4096)
 def twitchGetEmoteInfo(emote_id):
   emote = {}
   scales = [(1, '1.0'), (2, '2.0'), (4, '3.0')]
@@ -613,27 +3614,517 @@ def twitchGetEmoteInfo(emote_id):
   return emote
 
 
+# Commands handled by the ingest pipeline: chat messages, announcements, and moderators deleting messages
+INGEST_COMMANDS = ["PRIVMSG", "USERNOTICE", "CLEARMSG", "CLEARCHAT"]
+
+
+# Gets the command of a raw IRC message, without parsing the rest of it
+def ircCommandOf(raw_message):
+  start = 0
+  if raw_message.startswith('@'):
+    start = raw_message.find(' ') + 1
+  if raw_message.startswith(':', start):
+    start = raw_message.find(' ', start) + 1
+  end = raw_message.find(' ', start)
+  if end == -1:
+    return raw_message[start:].rstrip('\r\n')
+  return raw_message[start:end]
+
+
+# Gets the fields of a chat message needed to display it, giving colors to chatters that didn't set theirs
+# The result only contains plain values, so it can be sent to an enrichment worker process
+def parseChatMessage(message, uncolored_chatters):
+  # Announcements (USERNOTICE) come from the server, so the chatter is only in the tags
+  username = message.username if message.username != None else message.tags.get('login', "")
+  # Give color to chatters that didn't set theirs
+  if not 'color' in message.tags or message.tags['color'] == "":
+    # Only generate color if we haven't already from previous messages
+    if not username in uncolored_chatters:
+      # Keep generating colors, until we get one that's bright enough
+      readability = 0
+      while readability < 255:
+        r = random.randrange(256)
+        g = random.randrange(256)
+        b = random.randrange(256)
+        readability = r*1.33 + g*2 + b
+      # Remember this color for later
+      uncolored_chatters[username] = "#%02X%02X%02X" % (r, g, b)
+    # Get saved color
+    message.tags['color'] = uncolored_chatters[username]
+
+  # Use username as display name when the user didn't set theirs
+  if not 'display-name' in message.tags or message.tags['display-name'] == "":
+    message.tags['display-name'] = username
+
+  fields = {
+    'channel': message.command[1][1:],
+    'id': message.tags.get('id'),
+    'user_id': message.tags.get('user-id'),
+    'user': message.tags['display-name'],
+    'user_color': message.tags['color'],
+    'badges': message.tags.get('badges'),
+    'emotes': message.tags.get('emotes'),
+    'message': message.params if message.params != None else ""
+  }
+  # Announcement, like a subscription or raid, which may come with a message from the chatter
+  if message.command[0] == "USERNOTICE":
+    fields['system_message'] = message.tags.get('system-msg', "")
+  if 'reply-parent-display-name' in message.tags and 'reply-parent-msg-body' in message.tags:
+    fields['replying_to_user'] = message.tags['reply-parent-display-name']
+    fields['replying_to_message'] = message.tags['reply-parent-msg-body']
+  return fields
+
+
+# Gets what a CLEARMSG or CLEARCHAT command deletes, as a tuple of Twitch message ID and user ID, which are both None when all of chat was cleared
+# Returns None if the command is missing the tags it needs
+def moderationTarget(message):
+  if message.tags == None:
+    return None
+  if message.command[0] == "CLEARMSG":
+    msg_id = message.tags.get('target-msg-id')
+    return (msg_id, None) if msg_id != None else None
+  # Ban or timeout of a user, if one is given
+  if message.params != None:
+    user_id = message.tags.get('target-user-id')
+    return (None, user_id) if user_id != None else None
+  return (None, None)
+
+
+# Sets the tables used to enrich chat messages in this process
+# Takes a dict of (badge resolver, BTTV emote index) tuples by channel name
+def setEnrichmentTables(tables):
+  global enrichment_tables
+  enrichment_tables = tables
+
+
+# Starts an enrichment worker process, which can't share the badge resolver's lock and cache, so gets the tables of each channel with the chunks of messages
+def initEnrichmentWorker(badge_cache_size):
+  global BADGE_CACHE_SIZE
+  BADGE_CACHE_SIZE = badge_cache_size
+  setEnrichmentTables({})
+
+
+# Same as enrichChatMessages, in an enrichment worker process
+# Chunks come with the pickled (badge table, BTTV emote index) tuple of their channel, which is only unpickled when its generation is newer than the one in use
+def enrichChatMessagesInWorker(channel, generation, pickled_tables, fields_list):
+  if enrichment_generations.get(channel) != generation:
+    badges, bttv_emotes = pickle.loads(pickled_tables)
+    enrichment_tables[channel] = (BadgeResolver(badges), bttv_emotes)
+    enrichment_generations[channel] = generation
+  return enrichChatMessages(channel, fields_list)
+
+
+# Resolves badges and emotes of parsed chat messages of a channel
+# Returns a list of messages ready to be added to the chat queue
+def enrichChatMessages(channel, fields_list):
+  badge_resolver, bttv_emotes = enrichment_tables[channel]
+  enriched = []
+  for fields in fields_list:
+    # Get needed info from this message
+    needed_msg_info = {
+      'id': fields['id'],
+      'user_id': fields['user_id'],
+      'user': fields['user'],
+      'user_color': fields['user_color'],
+      'badges': badge_resolver.resolve(fields['badges']),
+      'emotes': []
+    }
+    if 'system_message' in fields:
+      needed_msg_info['system_message'] = fields['system_message']
+
+    emote_offset = 0
+    # Handle replies
+    if 'replying_to_user' in fields:
+      # Message is a reply
+      needed_msg_info['replying_to_user'] = fields['replying_to_user']
+      needed_msg_info['replying_to_message'] = fields['replying_to_message']
+      # Cut out @user-being-replied-to from message
+      reply_tag_end = fields['message'].find(' ') + 1
+      emote_offset += reply_tag_end
+      needed_msg_info['message'] = fields['message'][reply_tag_end:]
+    else:
+      # Normal message (not reply)
+      needed_msg_info['message'] = fields['message']
+
+    # Handle emotes
+    existing_emote_positions = {}
+    if fields['emotes'] != None and fields['emotes'] != "":
+      # Go through all emotes in message
+      for emote_info in fields['emotes'].split('/'):
+        # Parse info from single emote
+        emote_info_split = emote_info.split(':')
+        for emote_instance in emote_info_split[1].split(','):
+          # Handle each instance of that emote
+          emote_instance_split = emote_instance.split('-')
+          emote = {}
+          emote['start'] = int(emote_instance_split[0]) - emote_offset
+          emote['end'] = int(emote_instance_split[1]) + 1 - emote_offset
+          emote['scales'] = twitchGetEmoteInfo(emote_info_split[0])
+          needed_msg_info['emotes'].append(emote)
+          existing_emote_positions[emote['start']] = True
+    # Find BTTV emotes
+    for emote in bttv_emotes.find(needed_msg_info['message']):
+      if not emote['start'] in existing_emote_positions:
+        existing_emote_positions[emote['start']] = True
+        needed_msg_info['emotes'].append(emote)
+    # Sort by position in message
+    def sortHelper(item):
+      return item['start']
+    needed_msg_info['emotes'].sort(key=sortHelper)
+
+    enriched.append(needed_msg_info)
+  return enriched
+
+
+# Pipeline that turns raw chat lines into messages in the chat queues of their channels, off the thread reading the socket
+# Stages are a feed thread, a parse thread, a pool of enrichment workers, and a thread adding results to the chat queues in order
+# Stages after the feed thread are joined by bounded queues, so a slow stage makes the earlier ones wait instead of piling up messages
+# The feed thread is the one that waits for room, holding on to raw lines meanwhile, so the thread reading the socket never waits
+class IngestPipeline():
+  # Most messages sent to an enrichment worker at once
+  CHUNK_SIZE = 64
+
+  def __init__(self, channels):
+    self.channels = channels
+    # Raw lines pushed while the pipeline had no room for them, and whether the pipeline is closing
+    self._unsent = []
+    self._closing = False
+    self._unsent_lock = Condition()
+    self._raw_batches = Queue(INGEST_QUEUE_SIZE)
+    self._pending_results = Queue(INGEST_QUEUE_SIZE)
+    # Generation and pickled tables of each channel, sent to worker processes with every chunk
+    self._generation = 0
+    self._worker_tables = {}
+    self._pool = self._createPool()
+    self._feed_thread = Thread(target=self._feedStage, daemon=True)
+    self._parse_thread = Thread(target=self._parseStage, daemon=True)
+    self._collect_thread = Thread(target=self._collectStage, daemon=True)
+    self._feed_thread.start()
+    self._parse_thread.start()
+    self._collect_thread.start()
+
+  # Creates the enrichment worker pool, giving it the badge and emote tables of every channel
+  def _createPool(self):
+    if INGEST_POOL == "process":
+      self._setWorkerTables()
+      pool = concurrent.futures.ProcessPoolExecutor(INGEST_WORKERS, mp_context=process_context, initializer=initEnrichmentWorker, initargs=(BADGE_CACHE_SIZE,))
+      # Start the workers now, instead of on the first chunk of messages
+      pool.submit(int).result()
+      return pool
+    self._setThreadTables()
+    return concurrent.futures.ThreadPoolExecutor(INGEST_WORKERS)
+
+  def _setThreadTables(self):
+    setEnrichmentTables({channel.name: (channel.badge_resolver, channel.bttv_emotes) for channel in self.channels.values()})
+
+  # Pickles the tables of every channel once for all the chunks sent to worker processes, with a new generation so the workers switch to them
+  def _setWorkerTables(self):
+    self._generation += 1
+    self._worker_tables = {channel.name: (self._generation, pickle.dumps((channel.badge_resolver.badges, channel.bttv_emotes))) for channel in self.channels.values()}
+
+  # Starts using the current badge and emote tables of the channels, for messages that weren't sent to the workers yet
+  # All tables are swapped at once, and the workers pick them up per chunk, without any locking
+  def setTables(self):
+    if INGEST_POOL == "process":
+      self._setWorkerTables()
+    else:
+      self._setThreadTables()
+
+  # Hands a batch of raw chat lines (INGEST_COMMANDS) to the pipeline without waiting
+  # If the pipeline is full, the lines are kept until it has room, and sent along with the ones pushed meanwhile
+  def push(self, raw_messages):
+    if len(raw_messages) > 0:
+      with self._unsent_lock:
+        self._unsent.extend(raw_messages)
+        self._unsent_lock.notify()
+
+  # Waits for all pushed messages to reach the chat queue, and stops the pipeline
+  def close(self):
+    with self._unsent_lock:
+      self._closing = True
+      self._unsent_lock.notify()
+    self._collect_thread.join()
+    self._pool.shutdown()
+
+  # Moves pushed raw lines into the pipeline, waiting while it's full, and taking all lines pushed meanwhile at once
+  def _feedStage(self):
+    while True:
+      with self._unsent_lock:
+        while len(self._unsent) == 0 and not self._closing:
+          self._unsent_lock.wait()
+        raw_messages = self._unsent
+        self._unsent = []
+      if len(raw_messages) == 0:
+        # Closing, and every line was sent on
+        self._raw_batches.put(None)
+        return
+      self._raw_batches.put(raw_messages)
+
+  # Sends a chunk of messages of a channel to the worker pool, along with the tables of the channel if the workers are processes
+  def _submit(self, channel, fields_list):
+    if INGEST_POOL == "process":
+      return self._pool.submit(enrichChatMessagesInWorker, channel, *self._worker_tables[channel], fields_list)
+    return self._pool.submit(enrichChatMessages, channel, fields_list)
+
+  # Sends parsed messages of each channel to the enrichment workers in chunks, remembering their order
+  def _submitChunks(self, fields_by_channel):
+    for channel, fields_list in fields_by_channel.items():
+      chat_queue = self.channels[channel].queue
+      for i in range(0, len(fields_list), self.CHUNK_SIZE):
+        self._pending_results.put((chat_queue, "add", self._submit(channel, fields_list[i:i+self.CHUNK_SIZE])))
+
+  # Parses messages and sends them to the enrichment workers in chunks, remembering their order
+  # Moderation commands are passed on in order too, so they only apply once the messages before them are in the chat queue
+  def _parseStage(self):
+    # Set and keep track of colors for chatters that didn't set theirs
+    uncolored_chatters = dict()
+    while True:
+      raw_messages = self._raw_batches.get()
+      if raw_messages == None:
+        self._pending_results.put(None)
+        return
+      fields_by_channel = {}
+      for raw_message in raw_messages:
+        try:
+          message = parsedIRCMessage(raw_message)
+        except ValueError as e:
+          log.warning("[Twitch IRC] Could not parse message:", e)
+          continue
+        channel = message.command[1][1:] if len(message.command) > 1 else None
+        if not channel in self.channels:
+          continue
+        channel_prefix = f"#{channel} " if len(self.channels) > 1 or IRC_WORKERS > 0 else ""
+        if message.command[0] in ["CLEARMSG", "CLEARCHAT"]:
+          target = moderationTarget(message)
+          if target == None:
+            continue
+          if log.enabled("chat"):
+            if target[0] != None:
+              log.chat(f"{channel_prefix}* Message of {message.tags.get('login')} deleted")
+            elif target[1] != None:
+              log.chat(f"{channel_prefix}* Messages of {message.params} deleted")
+            else:
+              log.chat(f"{channel_prefix}* Chat cleared")
+          self._submitChunks(fields_by_channel)
+          fields_by_channel = {}
+          self._pending_results.put((self.channels[channel].queue, "delete", target))
+          continue
+        fields = parseChatMessage(message, uncolored_chatters)
+        # Print message to console
+        if log.enabled("chat"):
+          if 'system_message' in fields:
+            log.chat(f"{channel_prefix}* {fields['system_message']} {fields['message']}".rstrip())
+          else:
+            log.chat(f"{channel_prefix}{hexToANSIColorWrap(fields['user_color'], fields['user'])}: {fields['message']}")
+        fields_by_channel.setdefault(channel, []).append(fields)
+      self._submitChunks(fields_by_channel)
+
+  # Adds enriched messages to the chat queues and deletes moderated ones, in the order they were received
+  def _collectStage(self):
+    while True:
+      result = self._pending_results.get()
+      if result == None:
+        return
+      chat_queue, action, item = result
+      if action == "delete":
+        chat_queue.deleteMessages(*item)
+        continue
+      try:
+        chat_queue.addMessages(item.result())
+      except Exception as e:
+        log.error("[Twitch IRC] Could not enrich messages:", repr(e))
+
+
+# Gets the token info, channel IDs, badges and BTTV emotes needed to handle chat in the given channels
+# Requests that don't depend on each other run in parallel, and max_age is passed on to apiGet
+# Returns a dict of (channel ID, badge table, BTTV emote index) tuples by channel name,
+# or an exit code if something required couldn't be fetched
+def twitchBootstrap(channel_names, max_age=None):
+  with concurrent.futures.ThreadPoolExecutor(min(16, 2 + 2 * len(channel_names))) as pool:
+    bttv_global_future = pool.submit(bttvGetGlobalEmotes, max_age)
+    # Validate Twitch OAuth token
+    if not twitchValidateToken(max_age):
+      return 2
+    global_badges_future = pool.submit(twitchGetBadgeSets, None, max_age)
+    # Get channel IDs
+    channel_id_futures = {name: pool.submit(twitchGetIDOfUser, name, max_age) for name in channel_names}
+    channel_ids = {}
+    for name, channel_id_future in channel_id_futures.items():
+      channel_ids[name] = channel_id_future.result()
+      if channel_ids[name] == None:
+        return 2
+    # Get channel badges and BTTV emotes
+    channel_badges_futures = {name: pool.submit(twitchGetBadgeSets, channel_id, max_age) for name, channel_id in channel_ids.items()}
+    bttv_channel_futures = {name: pool.submit(bttvGetChannelEmotes, channel_id, max_age) for name, channel_id in channel_ids.items()}
+    global_badge_sets = global_badges_future.result()
+    if global_badge_sets == None:
+      return 3
+    bttv_global_emotes = bttv_global_future.result()
+    tables = {}
+    for name, channel_id in channel_ids.items():
+      channel_badge_sets = channel_badges_futures[name].result()
+      if channel_badge_sets == None:
+        return 3
+      badges = twitchParseChatBadges(global_badge_sets + channel_badge_sets)
+      tables[name] = (channel_id, badges, EmoteIndex(bttv_global_emotes, bttv_channel_futures[name].result()))
+  api_cache.save()
+  return tables
+
+
+# Keeps the badge and emote tables of the channels up to date while connected
+# New tables are built on this thread, and only swapped into the ingest pipeline when something changed
+class ChatTablesRefresher():
+  def __init__(self, pipeline, channels):
+    self.pipeline = pipeline
+    self.channels = channels
+    self.lock = Lock()
+    self.refreshes = 0
+    self.updates = 0
+    self.failures = 0
+    self.last_refresh_time = None
+    self.last_refresh_duration = None
+    self.thread = Thread(target=self._refreshLoop, daemon=True)
+    self.thread.start()
+
+  def _refreshLoop(self):
+    # Right away, revalidate the cached responses that are older than the cache TTL
+    self.refresh(None)
+    if TABLE_REFRESH_INTERVAL <= 0:
+      return
+    while True:
+      time.sleep(TABLE_REFRESH_INTERVAL)
+      # Revalidate everything, so changes are picked up even while cached responses are still fresh
+      self.refresh(0)
+
+  # Fetches the tables again, and swaps them into the pipeline if they changed
+  def refresh(self, max_age):
+    start = time.perf_counter()
+    tables = twitchBootstrap(list(self.channels), max_age)
+    duration = time.perf_counter() - start
+    with self.lock:
+      self.refreshes += 1
+      self.last_refresh_time = int(time.time())
+      self.last_refresh_duration = round(duration * 1000)
+      if type(tables) == int:
+        self.failures += 1
+    if type(tables) == int:
+      log.warning("[Twitch API] Could not refresh chat badges and emotes, keeping the current ones")
+      return
+    changed = False
+    for name, (channel_id, badges, bttv_emotes) in tables.items():
+      channel = self.channels[name]
+      if badges != channel.badge_resolver.badges or bttv_emotes.emotes != channel.bttv_emotes.emotes:
+        channel.setTables(badges, bttv_emotes)
+        changed = True
+    if not changed:
+      log.debug(f"[Twitch API] Chat badges and emotes are unchanged, checked in {round(duration * 1000)} ms")
+      return
+    self.pipeline.setTables()
+    with self.lock:
+      self.updates += 1
+    log.info("[Twitch API] Updated chat badges and emotes")
+
+  # Returns refresh counters and timings
+  def stats(self):
+    with self.lock:
+      return {
+        "refreshes": self.refreshes,
+        "updates": self.updates,
+        "failures": self.failures,
+        "interval": TABLE_REFRESH_INTERVAL,
+        "last_refresh_time": self.last_refresh_time,
+        "last_refresh_ms": self.last_refresh_duration
+      }
+
+
+# Returns the badge cache counters of every channel
+def badgeCacheStats():
+  return {channel.name: channel.badge_resolver.stats() for channel in list(chat_channels.values())}
+
+
+# Handles lines received from the IRC server, answering connection-level commands and handing chat messages to the ingest pipeline
+# Commands to send are prepared on the socket wrapper, and the caller flushes them
+# Returns whether to disconnect
+def handleIRCLines(raw_messages, sock_wrapper, pipeline, joined_channels):
+  should_disconnect = False
+  chat_messages = []
+  for raw_message in raw_messages:
+    cmd = ircCommandOf(raw_message)
+    if cmd in INGEST_COMMANDS:
+      # Message was sent in chat, or moderators deleted messages, leave it to the ingest pipeline
+      chat_messages.append(raw_message)
+      continue
+
+    message = parsedIRCMessage(raw_message)
+    if cmd == "NOTICE":
+      log.warning("[Twitch IRC] Got notice from server:", message.params)
+      # Authentication failed, likely, when it's not about a channel
+      if len(message.command) < 2 or message.command[1] == "*":
+        should_disconnect = True
+
+    elif cmd == "PART":
+      # Our account was banned
+      channel_name = message.command[1][1:]
+      log.warning(f"[Twitch IRC] Banned from channel #{channel_name}")
+      joined_channels.discard(channel_name)
+      # Disconnect when there's no channel left
+      if len(joined_channels) == 0:
+        should_disconnect = True
+
+    elif cmd == "PING":
+      # Keeping the connection alive
+      sock_wrapper.sendPrepare(f"PONG :{message.params}")
+
+    elif cmd == "421":
+      # We sent a command the server doesn't understand
+      log.warning(f"[Twitch IRC] Server didn't recognize a command: {str(message)}")
+
+    elif cmd == "001":
+      # Successful login
+      log.info("[Twitch IRC] Logged in")
+      # Ask for message tags, and for moderation commands
+      sock_wrapper.sendPrepare(f"CAP REQ :twitch.tv/tags twitch.tv/commands")
+
+    elif cmd == "CAP":
+      # Extended capabilities
+      if message.command[2] == "NAK":
+        # Close connection when denied
+        log.error("[Twitch IRC] Extended capabilities denied")
+        should_disconnect = True
+      elif message.command[2] == "ACK" and "twitch.tv/tags" in message.params.split(' '):
+        # Join channels when accepted
+        log.info("[Twitch IRC] Extended capabilities accepted, joining channels")
+        sock_wrapper.sendPrepare("JOIN " + ",".join([f"#{name}" for name in CHANNELS]))
+        joined_channels.update(CHANNELS)
+
+  # Hand chat messages to the ingest pipeline, which never waits, even while it's full
+  pipeline.push(chat_messages)
+  return should_disconnect
+
+
 # Twitch IRC message source
+# This thread only reads the socket and handles connection-level commands, so PINGs are answered right away,
+# while chat messages go through the ingest pipeline
 def twitchIRCMessageSource():
-  global IRC_SERVER, IRC_PORT, username, CHANNEL, OAUTH_TOKEN, chat_queue, channel_id
-  # Set and keep track of colors for chatters that didn't set theirs
-  uncolored_chatters = dict()
-  # Validate Twitch OAuth token
-  if not twitchValidateToken():
-    return 2
-  print(f"[Twitch API] Logged in as {username} with UID {user_id}")
-  # Get channel ID
-  channel_id = twitchGetIDOfUser(CHANNEL)
-  if channel_id == None:
-    return 2
-  print(f"[Twitch API] Got channel ID {channel_id}")
-  # Get channel badges
-  badges = twitchGetChatBadges()
-  if badges == None:
-    return 3
-  # Get BTTV emotes
-  bttv_global = bttvGetGlobalEmotes()
-  bttv_channel = bttvGetChannelEmotes()
+  global IRC_SERVER, IRC_PORT, username, CHANNELS, OAUTH_TOKEN, chat_channels
+  # Get everything needed to handle chat, from the API cache if possible, no matter how old
+  tables = twitchBootstrap(CHANNELS, max_age=float('inf'))
+  if type(tables) == int:
+    return tables
+  log.info(f"[Twitch API] Logged in as {username} with UID {user_id}")
+  for name, (channel_id, badges, bttv_emotes) in tables.items():
+    channel = chat_channels[name]
+    channel.id = channel_id
+    channel.setTables(badges, bttv_emotes)
+    log.info(f"[Twitch API] Got channel ID {channel_id} for #{name}")
+  log.info("[Twitch API] Received chat badges and BetterTTV emotes")
+  if INGEST_POOL == "thread":
+    stats_providers["badge_cache"] = badgeCacheStats
+  # Start ingest pipeline
+  pipeline = IngestPipeline(chat_channels)
+  # Refresh badges and emotes while connected
+  refresher = ChatTablesRefresher(pipeline, chat_channels)
+  stats_providers["table_refresh"] = refresher.stats
   # Create SSL/TLS context
   ssl_context = ssl.create_default_context()
   # Connect to server
@@ -641,9 +4132,8 @@ def twitchIRCMessageSource():
     # Wrap socket with SSL/TLS
     with ssl_context.wrap_socket(sock, server_hostname=IRC_SERVER) as sock_ssl:
       sock_wrapper = SocketIOWrapper(sock_ssl)
-      in_channel = False
+      joined_channels = set()
       should_disconnect = False
-      for_local_chat_queue = []
       # Send data to server from console
       try:
         # Log in
@@ -652,178 +4142,341 @@ def twitchIRCMessageSource():
         sock_wrapper.sendFlush()
 
         # Listen to server's messages
-        while (sock_wrapper.connection_open and not should_disconnect) or not sock_wrapper.incoming_message_queue.empty():
-          # Receive new messages
-          sock_wrapper.receive()
-
-          # Process any new messages
-          while not sock_wrapper.incoming_message_queue.empty():
-            message = parsedIRCMessage(sock_wrapper.incoming_message_queue.get())
-            #print(message)
-            cmd = message.command[0]
-            if cmd == "NOTICE":
-              # Authentication failed, likely
-              print("[Twitch IRC] Got notice from server:", message.params)
-              should_disconnect = True
-
-            elif cmd == "PART":
-              # Our account was banned
-              print("[Twitch IRC] Banned from channel")
-              should_disconnect = True
-              in_channel = False;
-
-            elif cmd == "PING":
-              # Keeping the connection alive
-              sock_wrapper.sendPrepare(f"PONG :{message.params}")
-
-            elif cmd == "PRIVMSG":
-              # Message was sent in chat
-              # Give color to chatters that didn't set theirs
-              if not 'color' in message.tags or message.tags['color'] == "":
-                # Only generate color if we haven't already from previous messages
-                if not message.username in uncolored_chatters:
-                  # Keep generating colors, until we get one that's bright enough
-                  readability = 0
-                  while readability < 255:
-                    r = random.randrange(256)
-                    g = random.randrange(256)
-                    b = random.randrange(256)
-                    readability = r*1.33 + g*2 + b
-                  # Remember this color for later
-                  uncolored_chatters[message.username] = "#%02X%02X%02X" % (r, g, b)
-                # Get saved color
-                message.tags['color'] = uncolored_chatters[message.username]
-
-              # Use username as display name when the user didn't set theirs
-              if not 'display-name' in message.tags or message.tags['display-name'] == "":
-                message.tags['display-name'] = message.username
-              # Print message to console
-              print(f"{hexToANSIColorWrap(message.tags['color'], message.tags['display-name'])}: {message.params}")
-              # Get needed info from this message
-              needed_msg_info = {
-                'user': message.tags['display-name'],
-                'user_color': message.tags['color'],
-                'badges': [],
-                'emotes': []
-              }
-
-              emote_offset = 0
-              # Handle replies
-              if 'reply-parent-display-name' in message.tags and 'reply-parent-msg-body' in message.tags:
-                # Message is a reply
-                needed_msg_info['replying_to_user'] = message.tags['reply-parent-display-name']
-                needed_msg_info['replying_to_message'] = message.tags['reply-parent-msg-body']
-                # Cut out @user-being-replied-to from message
-                reply_tag_end = message.params.find(' ') + 1
-                emote_offset += reply_tag_end
-                needed_msg_info['message'] = message.params[reply_tag_end:]
-              else:
-                # Normal message (not reply)
-                needed_msg_info['message'] = message.params
-
-              # Handle badges
-              if 'badges' in message.tags and message.tags['badges'] != "":
-                for badge in message.tags['badges'].split(','):
-                  badge_info = badge.split('/')
-                  try:
-                    needed_msg_info['badges'].append(badges[badge_info[0]][badge_info[1]])
-                  except KeyError as e:
-                    # Silently ignore unknown badges
-                    print("[Twitch IRC] Unknown badge:", badge_info[0], badge_info[1])
-              # Append message to local chat queue
-              for_local_chat_queue.append(needed_msg_info)
-
-              # Handle emotes
-              existing_emote_positions = {}
-              if 'emotes' in message.tags and message.tags['emotes'] != "":
-                # Go through all emotes in message
-                for emote_info in message.tags['emotes'].split('/'):
-                  # Parse info from single emote
-                  emote_info_split = emote_info.split(':')
-                  for emote_instance in emote_info_split[1].split(','):
-                    # Handle each instance of that emote
-                    emote_instance_split = emote_instance.split('-')
-                    emote = {}
-                    emote['start'] = int(emote_instance_split[0]) - emote_offset
-                    emote['end'] = int(emote_instance_split[1]) + 1 - emote_offset
-                    emote['scales'] = twitchGetEmoteInfo(emote_info_split[0])
-                    needed_msg_info['emotes'].append(emote)
-                    existing_emote_positions[emote['start']] = True
-              # Find BTTV emotes
-              for emote in bttvFindEmotes(needed_msg_info['message'], bttv_global, bttv_channel):
-                if not emote['start'] in existing_emote_positions:
-                  existing_emote_positions[emote['start']] = True
-                  needed_msg_info['emotes'].append(emote)
-              # Sort by position in message
-              def sortHelper(item):
-                return item['start']
-              needed_msg_info['emotes'].sort(key=sortHelper)
-
-
-            elif cmd == "421":
-              # We sent a command the server doesn't understand
-              print(f"[Twitch IRC] Server didn't recognize a command: {str(message)}")
-
-            elif cmd == "001":
-              # Successful login
-              print("[Twitch IRC] Logged in")
-              # Ask for message tags
-              sock_wrapper.sendPrepare(f"CAP REQ twitch.tv/tags")
-
-            elif cmd == "CAP":
-              # Extended capabilities
-              if message.command[2] == "NAK":
-                # Close connection when denied
-                print("[Twitch IRC] Extended capabilities denied")
-                should_disconnect = True
-              elif message.command[2] == "ACK" and message.params == "twitch.tv/tags":
-                # Join channel when accepted
-                print("[Twitch IRC] Extended capabilities accepted, joining channel")
-                sock_wrapper.sendPrepare(f"JOIN #{CHANNEL}")
-                in_channel = True
-
+        while sock_wrapper.connection_open and not should_disconnect:
+          # Receive and process new messages
+          should_disconnect = handleIRCLines(sock_wrapper.receive(), sock_wrapper, pipeline, joined_channels)
           # Send any queued up commands to server
           sock_wrapper.sendFlush()
-          # Add any received messages to local message queue
-          if len(for_local_chat_queue) > 0:
-            chat_queue.addMessages(for_local_chat_queue)
-            for_local_chat_queue = []
 
       except KeyboardInterrupt:
-        print("[Twitch IRC] Closing connection")
-      # If we're in the channel, leave it
-      if in_channel:
-        sock_wrapper.sendPrepare(f"PART #{CHANNEL}")
+        log.info("[Twitch IRC] Closing connection")
+      # Leave the channels we're still in
+      if len(joined_channels) > 0:
+        sock_wrapper.sendPrepare("PART " + ",".join([f"#{name}" for name in joined_channels]))
         sock_wrapper.sendFlush()
+  # Let messages that were already received reach the chat queues
+  pipeline.close()
   return 0
 
+# Splits channels between IRC worker processes
+# Channels in irc-worker-assignment go to their worker, and the rest go to the workers with the fewest channels
+def assignChannelsToWorkers(channels, worker_count, assignment):
+  workers = [[] for i in range(worker_count)]
+  for channel in channels:
+    if channel in assignment:
+      workers[assignment[channel]].append(channel)
+  for channel in channels:
+    if not channel in assignment:
+      min(workers, key=len).append(channel)
+  return workers
+
+
+# Stands in for the chat queue of a channel in IRC worker processes, sending its messages to the main process
+class ChatQueueSender():
+  def __init__(self, channel_name, connection):
+    self.channel_name = channel_name
+    self.connection = connection
+
+  def addMessages(self, msg_list):
+    self._send("add", msg_list)
+
+  def deleteMessages(self, msg_id=None, user_id=None):
+    self._send("delete", (msg_id, user_id))
+
+  def _send(self, action, item):
+    try:
+      self.connection.send((self.channel_name, action, item))
+    except OSError:
+      # Main process is gone, so there's nobody left to send messages to
+      os._exit(1)
+
+
+# Runs in IRC worker processes, which are forked from the main process, so they have its config
+# Handles the given channels like the main process does without workers, except messages go back through the connection
+def ircWorkerMain(channel_names, connection):
+  global CHANNELS, chat_channels, stats_providers, api_session, api_cache
+  # Own process group, so the supervisor can clean up the ingest worker processes along with this one,
+  # and interrupts from the terminal only reach the supervisor, which passes them on
+  os.setpgrp()
+  CHANNELS = channel_names
+  chat_channels = {name: ChatChannel(name, ChatQueueSender(name, connection)) for name in channel_names}
+  stats_providers = {}
+  # Connections of the API session might have been in use by other threads while forking, so start over
+  api_session = createAPISession()
+  api_cache = APICache(api_cache.path, api_cache.ttl)
+  try:
+    exit_code = twitchIRCMessageSource()
+  except KeyboardInterrupt:
+    # Stopped before connecting
+    exit_code = 0
+  log.flush()
+  sys.exit(exit_code)
+
+
+# Supervisor mode, where IRC connections run in worker processes, each with its share of the channels
+# Workers send enriched messages back through pipes, and they're added to the chat queues here
+# Workers that stop are restarted, waiting longer each time one keeps stopping soon after starting
+class IRCSupervisor():
+  RESTART_DELAY_MIN = 1
+  RESTART_DELAY_MAX = 60
+  # Workers running for at least this many seconds are considered healthy again
+  HEALTHY_TIME = 60
+
+  def __init__(self, assignment):
+    self.lock = Lock()
+    self.running = True
+    self.workers = []
+    for channel_names in assignment:
+      if len(channel_names) > 0:
+        self.workers.append({
+          'channels': channel_names,
+          'process': None,
+          'connection': None,
+          'started_at': None,
+          'restart_at': 0,
+          'restart_delay': self.RESTART_DELAY_MIN,
+          'restarts': 0,
+          'messages': 0,
+          'given_up': False
+        })
+
+  def _start(self, worker):
+    receiver, sender = process_context.Pipe(duplex=False)
+    process = process_context.Process(target=ircWorkerMain, args=(worker['channels'], sender))
+    process.start()
+    # Only the worker should have the sending end, so the pipe closes when the worker stops
+    sender.close()
+    with self.lock:
+      worker['process'] = process
+      worker['connection'] = receiver
+      worker['started_at'] = time.monotonic()
+
+  # Kills whatever is left of a stopped worker's process group, like ingest worker processes of a crashed worker
+  def _killProcessGroup(self, worker):
+    try:
+      os.killpg(worker['process'].pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+      pass
+
+  def _stopped(self, worker):
+    worker['connection'].close()
+    worker['process'].join()
+    self._killProcessGroup(worker)
+    exit_code = worker['process'].exitcode
+    channels = ", ".join([f"#{name}" for name in worker['channels']])
+    with self.lock:
+      worker['connection'] = None
+      # Invalid token or channel, which won't get better by restarting
+      if exit_code == 2:
+        worker['given_up'] = True
+        log.error(f"[IRC Supervisor] Worker for {channels} stopped with exit code {exit_code}, not restarting it")
+        return
+      if time.monotonic() - worker['started_at'] >= self.HEALTHY_TIME:
+        worker['restart_delay'] = self.RESTART_DELAY_MIN
+      else:
+        worker['restart_delay'] = min(worker['restart_delay'] * 2, self.RESTART_DELAY_MAX)
+      worker['restart_at'] = time.monotonic() + worker['restart_delay']
+    log.warning(f"[IRC Supervisor] Worker for {channels} stopped with exit code {exit_code}, restarting in {worker['restart_delay']} s")
+
+  # Receives a batch of messages or a deletion from a worker, and applies it to the chat queue of its channel
+  # Returns False if the worker has stopped
+  def _receive(self, worker):
+    try:
+      channel_name, action, item = worker['connection'].recv()
+    except (EOFError, OSError):
+      return False
+    if action == "delete":
+      chat_channels[channel_name].queue.deleteMessages(*item)
+      return True
+    chat_channels[channel_name].queue.addMessages(item)
+    with self.lock:
+      worker['messages'] += len(item)
+    return True
+
+  # Receives messages from the given running workers, for up to timeout seconds
+  # Returns the workers that stopped
+  def _receiveAll(self, workers, timeout):
+    connections = {worker['connection']: worker for worker in workers}
+    stopped = []
+    for connection in multiprocessing.connection.wait(list(connections), timeout):
+      if not self._receive(connections[connection]):
+        stopped.append(connections[connection])
+    # Ingest worker processes of a crashed worker keep its pipe open, so check the worker process itself too
+    for worker in workers:
+      if not worker['process'].is_alive() and not any([stopped_worker is worker for stopped_worker in stopped]):
+        # Pass on the messages the worker sent before stopping
+        while worker['connection'].poll() and self._receive(worker):
+          pass
+        stopped.append(worker)
+    return stopped
+
+  # Starts the workers, and keeps them running until stop is called or the process is interrupted
+  def run(self):
+    for worker in self.workers:
+      self._start(worker)
+    try:
+      while self.running:
+        for worker in self._receiveAll([worker for worker in self.workers if worker['connection'] != None], 1):
+          self._stopped(worker)
+        # Restart stopped workers when it's time to
+        for worker in self.workers:
+          if worker['connection'] == None and not worker['given_up'] and time.monotonic() >= worker['restart_at']:
+            with self.lock:
+              worker['restarts'] += 1
+            self._start(worker)
+    except KeyboardInterrupt:
+      pass
+    log.info("[IRC Supervisor] Stopping workers")
+    self._stopWorkers()
+    return 0
+
+  # Stops the supervisor, can be called from any thread
+  def stop(self):
+    self.running = False
+
+  # Lets workers leave their channels and send their last messages, and terminates the ones that take too long
+  def _stopWorkers(self):
+    running = [worker for worker in self.workers if worker['connection'] != None]
+    # Interrupt workers, so they leave their channels and pass on the messages they already received
+    for worker in running:
+      try:
+        os.kill(worker['process'].pid, signal.SIGINT)
+      except ProcessLookupError:
+        pass
+    deadline = time.monotonic() + 5
+    while len(running) > 0 and time.monotonic() < deadline:
+      stopped = self._receiveAll(running, deadline - time.monotonic())
+      running = [worker for worker in running if not any([stopped_worker is worker for stopped_worker in stopped])]
+    for worker in self.workers:
+      if worker['process'] != None:
+        if worker['process'].is_alive():
+          worker['process'].terminate()
+        worker['process'].join()
+        self._killProcessGroup(worker)
+    with self.lock:
+      for worker in self.workers:
+        if worker['connection'] != None:
+          worker['connection'].close()
+          worker['connection'] = None
+
+  # Returns channels and counters of every worker
+  def stats(self):
+    with self.lock:
+      return [{
+        'channels': worker['channels'],
+        'pid': worker['process'].pid if worker['process'] != None else None,
+        'alive': worker['connection'] != None,
+        'restarts': worker['restarts'],
+        'messages': worker['messages']
+      } for worker in self.workers]
+
+
 if __name__ == "__main__":
   # Load config
   if not loadConfig("server.config"):
     # Exit on invalid config
     exit(1)
+  # Continue the session of the journal, if there is one
+  if JOURNAL_DIR != "":
+    try:
+      SESSION_ID = journalSessionID(JOURNAL_DIR, CHANNELS)
+    except OSError as e:
+      print("Could not open journal:", e)
+      exit(1)
   # Print config to console
   print("Session ID:", SESSION_ID)
   print("Local port:", LOCAL_PORT)
   print("HTTP request timeout:", HTTP_REQUEST_TIMEOUT)
+  print("HTTP server mode:", HTTP_SERVER_MODE)
+  print("HTTP keep-alive timeout:", HTTP_KEEP_ALIVE_TIMEOUT)
+  print("HTTP keep-alive max requests:", HTTP_KEEP_ALIVE_MAX_REQUESTS)
+  print("HTTP processes:", HTTP_PROCESSES)
+  print("Batch min messages:", BATCH_MIN_MESSAGES)
+  print("Batch max delay:", BATCH_MAX_DELAY)
+  print("Batch max messages:", BATCH_MAX_MESSAGES if BATCH_MAX_MESSAGES > 0 else "(no limit)")
   print("Queue message timeout:", QUEUE_MSG_TIMEOUT)
   print("Queue message count limit:", QUEUE_MSG_COUNT_LIMIT)
+  print("Queue backend:", QUEUE_BACKEND)
+  if QUEUE_BACKEND == "shared":
+    print("Shared queue size:", SHARED_QUEUE_SIZE)
+  print("Journal directory:", JOURNAL_DIR if JOURNAL_DIR != "" else "(disabled)")
+  if JOURNAL_DIR != "":
+    print("Journal fsync interval:", JOURNAL_FSYNC_INTERVAL)
+    print("Journal segment size:", JOURNAL_SEGMENT_SIZE)
+    print("Journal segment age:", JOURNAL_SEGMENT_AGE)
+  print("Badge cache size:", BADGE_CACHE_SIZE)
+  print("Asset dictionary size:", ASSET_DICTIONARY_SIZE)
   print("IRC Server:", IRC_SERVER)
   print("IRC Port:", IRC_PORT)
+  print("IRC read size:", IRC_READ_SIZE)
+  print("Ingest pool:", INGEST_POOL)
+  print("Ingest workers:", INGEST_WORKERS)
+  print("Ingest queue size:", INGEST_QUEUE_SIZE)
+  print("Log level:", LOG_LEVEL)
+  print("Log buffer size:", LOG_BUFFER_SIZE)
+  print("Log overflow policy:", LOG_OVERFLOW_POLICY)
+  print("API timeout:", API_TIMEOUT)
+  print("API cache file:", API_CACHE_FILE)
+  print("API cache TTL:", API_CACHE_TTL)
+  print("Table refresh interval:", TABLE_REFRESH_INTERVAL)
+  print("IRC workers:", IRC_WORKERS)
+  if len(IRC_WORKER_ASSIGNMENT) > 0:
+    print("IRC worker assignment:", ", ".join([f"{channel}:{worker}" for channel, worker in IRC_WORKER_ASSIGNMENT.items()]))
+  print("Channels:", ", ".join(CHANNELS))
   print("OAuth Token:", len(OAUTH_TOKEN)*'*')   # Censor token for security
   print()
 
 
-  # Create chat queue
-  chat_queue = ChatQueue()
-  # Start HTTP server
-  http_server_thread = Thread(target=HTTPServerThread)
-  http_server_thread.start()
-  # Start Twitch IRC client
-  exit_code = twitchIRCMessageSource()
+  # Apply log settings
+  log.configure(LOG_LEVEL, LOG_BUFFER_SIZE, LOG_OVERFLOW_POLICY)
+  stats_providers["log"] = log.stats
+  stats_providers["batching"] = batching_stats.stats
+  # Asset dictionary of the configured size
+  asset_dictionary = AssetDictionary()
+  stats_providers["assets"] = asset_dictionary.stats
+  # Set up API requests
+  api_session = createAPISession()
+  api_cache = APICache(API_CACHE_FILE if API_CACHE_FILE != "" else None, API_CACHE_TTL)
+  # Load overlay files
+  static_file_cache = StaticFileCache(STATIC_FILES)
+  # Create chat queue of every channel
+  chat_channels = {name: ChatChannel(name) for name in CHANNELS}
+  # Restore chat queues from the journal
+  journals = {}
+  if JOURNAL_DIR != "":
+    try:
+      journals = openJournals()
+    except OSError as e:
+      log.error("[Journal] Could not open journal:", e)
+      log.flush()
+      exit(1)
+    stats_providers["journal"] = lambda: {name: journal.stats() for name, journal in journals.items()}
+  if QUEUE_BACKEND == "shared":
+    stats_providers["shared_queues"] = lambda: {name: channel.queue.stats() for name, channel in chat_channels.items()}
+  # Start HTTP server, in separate processes if configured
+  if HTTP_PROCESSES > 0:
+    http_server = HTTPServerProcesses(HTTP_PROCESSES)
+    http_server.start()
+    stats_providers["http_processes"] = http_server.stats
+  else:
+    http_server_thread = Thread(target=HTTPServerThread)
+    http_server_thread.start()
+  # Start Twitch IRC client, in worker processes in supervisor mode
+  if IRC_WORKERS > 0:
+    supervisor = IRCSupervisor(assignChannelsToWorkers(CHANNELS, IRC_WORKERS, IRC_WORKER_ASSIGNMENT))
+    stats_providers["irc_workers"] = supervisor.stats
+    exit_code = supervisor.run()
+  else:
+    exit_code = twitchIRCMessageSource()
 
   # Stop
-  print("[Local HTTP] Stopping")
+  log.info("[Local HTTP] Stopping")
   http_server.shutdown()
+  for journal in journals.values():
+    journal.close()
+  if QUEUE_BACKEND == "shared":
+    for channel in chat_channels.values():
+      channel.queue.close()
+  log.flush()
   exit(exit_code)
 
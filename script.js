@@ -6,9 +6,20 @@ var message_timeout = MESSAGE_TIMEOUT_DEFAULT;
 var message_remove_animation_duration = MESSAGE_REMOVE_ANIMATION_DURATION_DEFAULT;
 var message_count_max = MESSAGE_COUNT_MAX_DEFAULT;
 
+// How new messages are received: "ws" (WebSocket, falls back to "sse"), "sse" (Server-Sent Events, falls back to "poll")
+// or "poll" (long-polling)
+var transport = window.EventSource !== undefined ? "sse" : "poll";
+
 var img_scale = 1;
 var ui_scale = 1;
 
+// Batching policy asked from the server when long-polling, as query parameters
+var batch_query = "";
+// Most messages per second to show, so the server thins out floods of messages, or null for no limit
+var max_rate = null;
+// Whether messages are asked for in the compact format, where badges and emotes are IDs of assets the server sends once
+var compact = false;
+
 // DOM
 const css_root = document.querySelector(":root");
 var chat_container;
@@ -25,8 +36,17 @@ server.ontimeout = function() {
   getNewMessages();
 }
 server.timeout = 30000;
+var event_source = null;
+var web_socket = null;
 var session_id = null;
 var last_message_id = null;
+// Elements of the messages on screen by message ID, so messages deleted by moderators can be removed
+var message_elements = new Map();
+// Image URLs of each scale of badges and emotes by asset ID, from the server's asset dictionary with this ID,
+// and how many of its changes we have, since the server defines the IDs of images it no longer uses again
+var assets = [];
+var asset_dictionary_id = null;
+var asset_count = 0;
 
 // Handle window resizing
 function resize() {
@@ -37,6 +57,7 @@ function resize() {
     console.log("Changed image scale to " + img_scale);
     for (let img of document.getElementsByTagName('img'))
       pickImageScale(img);
+    sendOverlayOptions();
   }
 }
 
@@ -46,6 +67,9 @@ function urlParamsChange() {
   message_timeout = MESSAGE_TIMEOUT_DEFAULT;
   message_remove_animation_duration = MESSAGE_REMOVE_ANIMATION_DURATION_DEFAULT;
   message_count_max = MESSAGE_COUNT_MAX_DEFAULT;
+  batch_query = "";
+  max_rate = null;
+  compact = false;
 
   // get all params, which will override the defaults
   for (const [key, value] of new URLSearchParams(window.location.hash.substring(1))) {
@@ -70,8 +94,30 @@ function urlParamsChange() {
       case "message_count_max":
         message_count_max = parseInt(value);
         break;
+
+      case "max_rate":
+        max_rate = parseFloat(value);
+        if (!(max_rate > 0))
+          max_rate = null;
+        break;
+
+      case "fmt":
+        compact = value == "compact";
+        break;
+
+      case "batch_min":
+      case "batch_delay":
+      case "batch_max":
+        batch_query += "&" + key + "=" + parseInt(value);
+        break;
+
+      case "transport":
+        if (value == "poll" || (value == "sse" && window.EventSource !== undefined) || (value == "ws" && window.WebSocket !== undefined))
+          transport = value;
+        break;
     }
   }
+  sendOverlayOptions();
 }
 
 // Initialize when the page fully loads
@@ -84,16 +130,115 @@ function init() {
   resize();
   urlParamsChange();
   // Start requesting messages from server
-  getNewMessages();
+  if (transport == "ws")
+    openWebSocket();
+  else if (transport == "sse")
+    openEventStream();
+  else
+    getNewMessages();
 }
 window.addEventListener("load", init);
 
+// Opens a WebSocket, which pushes batches of new messages as binary frames
+function openWebSocket() {
+  let opened = false;
+  let url = new URL("ws", window.location.href);
+  url.protocol = url.protocol == "https:" ? "wss:" : "ws:";
+  if (session_id != null && last_message_id != null)
+    url.search = "?sid=" + session_id + "&mid=" + last_message_id + displayQuery();
+  else
+    url.search = "?" + displayQuery().substring(1);
+  web_socket = new WebSocket(url);
+  web_socket.binaryType = "arraybuffer";
+  const decoder = new TextDecoder();
+  web_socket.onopen = function() {
+    opened = true;
+    sendOverlayOptions();
+  }
+  web_socket.onmessage = function(event) {
+    try {
+      displayMessages(JSON.parse(typeof event.data == "string" ? event.data : decoder.decode(event.data)));
+    } catch (error) {
+      console.error(error);
+      console.error("Error parsing new messages.");
+    }
+  }
+  web_socket.onclose = function() {
+    web_socket = null;
+    if (opened) {
+      // Reconnect, resuming after the last message we got
+      console.warn("WebSocket closed. Reconnecting in 1s.");
+      setTimeout(openWebSocket, 1000);
+    } else {
+      // The server doesn't support it, so fall back to the next best thing
+      console.warn("Could not open WebSocket. Falling back to " + (window.EventSource !== undefined ? "Server-Sent Events." : "long-polling."));
+      if (window.EventSource !== undefined) {
+        transport = "sse";
+        openEventStream();
+      } else {
+        transport = "poll";
+        getNewMessages();
+      }
+    }
+  }
+}
+
+// Tells the server how many messages and which image scale this overlay shows, so it only sends what's needed
+function sendOverlayOptions() {
+  if (web_socket != null && web_socket.readyState == WebSocket.OPEN)
+    web_socket.send(JSON.stringify({"message_count_max": message_count_max, "scale": img_scale, "max_rate": max_rate, "fmt": compact ? "compact" : "full"}));
+}
+
+// Same as above, as query parameters for requests that start a stream or poll for messages
+function displayQuery() {
+  let query = "&count_max=" + message_count_max;
+  if (max_rate != null)
+    query += "&max_rate=" + max_rate;
+  if (compact) {
+    query += "&fmt=compact";
+    if (asset_dictionary_id != null)
+      query += "&dv=" + asset_dictionary_id + "." + asset_count;
+  }
+  return query;
+}
+
+// Opens a stream of Server-Sent Events, which pushes new messages as soon as they arrive
+function openEventStream() {
+  let opened = false;
+  if (session_id != null && last_message_id != null)
+    event_source = new EventSource("events?sid=" + session_id + "&mid=" + last_message_id + displayQuery());
+  else
+    event_source = new EventSource("events?" + displayQuery().substring(1));
+  event_source.onopen = function() {
+    opened = true;
+  }
+  event_source.onmessage = function(event) {
+    try {
+      displayMessages(JSON.parse(event.data));
+    } catch (error) {
+      console.error(error);
+      console.error("Error parsing new messages.");
+    }
+  }
+  event_source.onerror = function() {
+    // The browser reconnects by itself (resuming with Last-Event-ID) if the stream worked before
+    if (opened && event_source.readyState != EventSource.CLOSED)
+      return;
+    // Otherwise the server doesn't support it, so fall back to long-polling
+    console.warn("Could not open event stream. Falling back to long-polling.");
+    event_source.close();
+    event_source = null;
+    transport = "poll";
+    getNewMessages();
+  }
+}
+
 // Requests new messages from server
 function getNewMessages() {
   if (session_id != null && last_message_id != null)
-    server.open("GET", "get-messages?sid=" + session_id + "&mid=" + last_message_id);
+    server.open("GET", "get-messages?sid=" + session_id + "&mid=" + last_message_id + displayQuery() + batch_query);
   else
-    server.open("GET", "get-messages");
+    server.open("GET", "get-messages?" + (displayQuery() + batch_query).substring(1));
   server.send();
 }
 
@@ -126,32 +271,79 @@ function parseNewMessages() {
     if (server.status != 200)
       throw new Error("Server responded with " + server.status + " " + server.statusText);
     // Parse JSON
-    let data = JSON.parse(server.responseText);
-    // Get session ID
-    session_id = data.sid;
-    // Go through messages
-    for (let msg of data.messages) {
-      // Print message to console
-      // console.log(msg);
-
-      // Remove oldest messages if we've reached max message limit
-      while (chat_container.children.length >= message_count_max) {
-        oldest_message = chat_container.lastElementChild;
-        clearTimeout(oldest_message.removal_timeout);
-        oldest_message.remove();
-      }
+    displayMessages(JSON.parse(server.responseText));
+    // Check for messages again right away, since the server already waits to send them in batches
+    getNewMessages();
+  } catch (error) {
+    console.error(error);
+    console.error("Error parsing new messages. Retrying in 5s.");
+    setTimeout(getNewMessages, 5000);
+  }
+}
 
-      // Create new HTML element, which will contain this message
-      // Main div
-      let msg_main = document.createElement("div");
-      msg_main.classList.add("message");
-      // Replying to another message
-      if (msg.replying_to_user != undefined && msg.replying_to_message !== undefined) {
-        let msg_replying_to = document.createElement("div");
-        msg_replying_to.classList.add("replying-to");
-        msg_replying_to.textContent = "Replying to @" + msg.replying_to_user + ": " + msg.replying_to_message;
-        msg_main.appendChild(msg_replying_to)
-      }
+// Displays new messages received from server
+function displayMessages(data) {
+  // Message IDs of another session don't point to the same messages
+  if (data.sid != session_id)
+    message_elements.clear();
+  // Get session ID
+  session_id = data.sid;
+  // Add asset definitions we didn't have, starting over if they're from another dictionary
+  if (data.assets !== undefined) {
+    if (data.assets.dict != asset_dictionary_id) {
+      asset_dictionary_id = data.assets.dict;
+      assets = [];
+    }
+    for (let i = 0; i < data.assets.defs.length; i++)
+      assets[data.assets.ids[i]] = data.assets.defs[i];
+    asset_count = data.assets.next;
+  }
+  // Go through messages
+  for (let msg of data.messages) {
+    // Print message to console
+    // console.log(msg);
+    resolveAssets(msg);
+
+    // Message was deleted by a moderator before we got it
+    if (msg.deleted) {
+      last_message_id = msg.mid;
+      continue;
+    }
+    // Moderator deleted messages, or cleared chat
+    if (msg.delete !== undefined || msg.clear) {
+      deleteMessages(msg);
+      last_message_id = msg.mid;
+      continue;
+    }
+
+    // Remove oldest messages if we've reached max message limit
+    while (chat_container.children.length >= message_count_max) {
+      oldest_message = chat_container.lastElementChild;
+      clearTimeout(oldest_message.removal_timeout);
+      message_elements.delete(oldest_message.mid);
+      oldest_message.remove();
+    }
+
+    // Create new HTML element, which will contain this message
+    // Main div
+    let msg_main = document.createElement("div");
+    msg_main.classList.add("message");
+    // Replying to another message
+    if (msg.replying_to_user != undefined && msg.replying_to_message !== undefined) {
+      let msg_replying_to = document.createElement("div");
+      msg_replying_to.classList.add("replying-to");
+      msg_replying_to.textContent = "Replying to @" + msg.replying_to_user + ": " + msg.replying_to_message;
+      msg_main.appendChild(msg_replying_to)
+    }
+    // Announcement, like a subscription or raid
+    if (msg.system_message !== undefined) {
+      let msg_system = document.createElement("div");
+      msg_system.classList.add("system-message");
+      msg_system.textContent = msg.system_message;
+      msg_main.appendChild(msg_system);
+    }
+    // Announcements don't always come with a message from the chatter
+    if (msg.system_message === undefined || msg.message != "") {
       // Badges
       for (let badge of msg.badges) {
         let msg_badge = new Image();
@@ -187,27 +379,53 @@ function parseNewMessages() {
       }
       // Text after last emote
       msg_main.appendChild(document.createTextNode(message_separated_correctly.slice(prev_end).join('')));
-      // Put message into main container
-      chat_container.prepend(msg_main);
-      // Animate
-      msg_main.style.setProperty("--message-height", msg_main.clientHeight + "px");
-      msg_main.classList.add("message-add");
-      // Start timeout for removal of this message
-      msg_main.removal_timeout = setTimeout(() => removeMessage(msg_main), message_timeout);
-
-      // Remember the ID of this message, so we don't get it again
-      last_message_id = msg.mid;
     }
-    // Wait 250ms before checking for messages again
-    setTimeout(getNewMessages, 250);
-  } catch (error) {
-    console.error(error);
-    console.error("Error parsing new messages. Retrying in 5s.");
-    setTimeout(getNewMessages, 5000);
+    // Put message into main container
+    chat_container.prepend(msg_main);
+    msg_main.mid = msg.mid;
+    message_elements.set(msg.mid, msg_main);
+    // Animate
+    msg_main.style.setProperty("--message-height", msg_main.clientHeight + "px");
+    msg_main.classList.add("message-add");
+    // Start timeout for removal of this message
+    msg_main.removal_timeout = setTimeout(() => removeMessage(msg_main), message_timeout);
+
+    // Remember the ID of this message, so we don't get it again
+    last_message_id = msg.mid;
+  }
+  // Server left out messages we had no room or time for, so continue after them
+  if (data.skipped) {
+    console.info("Server skipped " + data.skipped + " messages.");
+    last_message_id = data.last_mid;
+  }
+}
+
+// Turns asset IDs of a message in the compact format back into image URLs of each scale
+function resolveAssets(msg) {
+  if (msg.badges !== undefined)
+    msg.badges = msg.badges.map(badge => typeof badge == "number" ? assets[badge] : badge);
+  if (msg.emotes !== undefined)
+    msg.emotes = msg.emotes.map(emote => Array.isArray(emote) ? {"start": emote[0], "end": emote[1], "scales": assets[emote[2]]} : emote);
+}
+
+// Removes messages deleted by moderators right away, or all messages if chat was cleared
+function deleteMessages(deletion) {
+  let elements;
+  if (deletion.clear)
+    elements = Array.from(chat_container.children);
+  else
+    elements = deletion.delete.map(mid => message_elements.get(mid)).filter(element => element !== undefined);
+  for (let element of elements) {
+    if (element.classList.contains("message-remove"))
+      continue;
+    clearTimeout(element.removal_timeout);
+    removeMessage(element);
   }
 }
 
 function removeMessage(msg) {
+  if (message_elements.get(msg.mid) === msg)
+    message_elements.delete(msg.mid);
   msg.classList.remove("message-add");
   msg.classList.add("message-remove");
   setTimeout(() => msg.remove(), message_remove_animation_duration);
@@ -0,0 +1,39 @@
+# Shared fixtures of the server tests
+# Usage: python3 -m pytest tests
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The benchmarks already load the server as a module, and have stand-ins for the APIs it uses
+import benchmark
+
+
+@pytest.fixture(scope="session")
+def server():
+  benchmark.server.log.configure("warning", 1000, "summarize")
+  return benchmark.server
+
+
+# Message like the ones the ingest pipeline adds to chat queues
+def chatMessage(text, **fields):
+  return dict({"user": "tester", "user_color": "#FF0000", "message": text, "badges": [], "emotes": []}, **fields)
+
+
+# Creates a chat queue of each backend, closing it after the test
+@pytest.fixture(params=["memory", "shared"])
+def make_queue(request, server, monkeypatch):
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  queues = []
+
+  def make(capacity, data_size=100000):
+    if request.param == "shared":
+      queue = server.SharedChatQueue(capacity, data_size)
+    else:
+      queue = server.ChatQueue(capacity)
+    queues.append(queue)
+    return queue
+
+  yield make
+  for queue in queues:
+    if request.param == "shared":
+      queue.close()
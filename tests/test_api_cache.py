@@ -0,0 +1,102 @@
+# Tests of the API response cache, against the stub API of the benchmarks
+import socket
+import pytest
+import benchmark
+
+
+@pytest.fixture
+def stub_api(server, monkeypatch, tmp_path):
+  monkeypatch.setattr(benchmark.StubAPIHandler, "latency", 0)
+  monkeypatch.setattr(benchmark.StubAPIHandler, "responses", dict(benchmark.StubAPIHandler.responses))
+  # Status codes the stub responded with
+  statuses = []
+  send_response = benchmark.StubAPIHandler.send_response
+
+  def recordResponse(handler, code, message=None):
+    statuses.append(code)
+    send_response(handler, code, message)
+
+  monkeypatch.setattr(benchmark.StubAPIHandler, "send_response", recordResponse)
+  # Restored after the test, since the stub points them at itself
+  for name in ["TWITCH_VALIDATE_URL", "TWITCH_USERS_URL", "TWITCH_GLOBAL_BADGES_URL", "TWITCH_CHANNEL_BADGES_URL",
+               "BTTV_GLOBAL_EMOTES_URL", "BTTV_CHANNEL_EMOTES_URL", "OAUTH_TOKEN", "api_session"]:
+    monkeypatch.setattr(server, name, getattr(server, name))
+  monkeypatch.setattr(server, "API_TIMEOUT", 5)
+  monkeypatch.setattr(server, "api_cache", server.APICache(str(tmp_path / "api-cache.json"), 3600))
+  stub = benchmark.startStubAPI()
+  yield statuses
+  stub.shutdown()
+  stub.server_close()
+
+
+# Makes the cached entry of a key look like it was fetched the given number of seconds ago
+def age(server, key, seconds):
+  server.api_cache.entries[key]['time'] -= seconds
+
+
+def test_fresh_entry_is_used_without_request(server, stub_api):
+  first = server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  assert first == (200, benchmark.StubAPIHandler.responses["/bttv/global"])
+  assert server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL) == first
+  assert stub_api == [200]
+
+
+def test_expired_entry_is_revalidated(server, stub_api):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  age(server, "bttv:global", 3601)
+  assert server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)[0] == 200
+  assert stub_api == [200, 304]
+  # Revalidating makes the entry fresh again
+  assert server.api_cache.age(server.api_cache.get("bttv:global")) < 60
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  assert stub_api == [200, 304]
+
+
+def test_max_age_overrides_ttl(server, stub_api):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  age(server, "bttv:global", 10)
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL, max_age=float('inf'))
+  assert stub_api == [200]
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL, max_age=5)
+  assert stub_api == [200, 304]
+
+
+def test_not_modified_reuses_cached_body(server, stub_api):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  etag = server.api_cache.get("bttv:global")['etag']
+  assert etag != None
+  # The 304 has no body, so the data can only come from the cache
+  server.api_cache.entries["bttv:global"]['data'] = ["cached"]
+  age(server, "bttv:global", 3601)
+  assert server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL) == (200, ["cached"])
+  assert stub_api == [200, 304]
+  assert server.api_cache.get("bttv:global")['etag'] == etag
+
+
+def test_changed_response_replaces_entry(server, stub_api):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  benchmark.StubAPIHandler.responses["/bttv/global"] = [{"code": "changed", "id": "x"}]
+  age(server, "bttv:global", 3601)
+  assert server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL) == (200, [{"code": "changed", "id": "x"}])
+  assert stub_api == [200, 200]
+  assert server.api_cache.get("bttv:global")['data'] == [{"code": "changed", "id": "x"}]
+
+
+def test_failed_request_falls_back_to_cache(server, stub_api, monkeypatch):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  age(server, "bttv:global", 3601)
+  # Nothing listens on a port that was just closed
+  with socket.socket() as unused:
+    unused.bind(('127.0.0.1', 0))
+    unreachable = f"http://127.0.0.1:{unused.getsockname()[1]}/bttv/global"
+  assert server.apiGet("bttv:global", unreachable) == (200, benchmark.StubAPIHandler.responses["/bttv/global"])
+  # Without a cached response, there's nothing to fall back to
+  assert server.apiGet("bttv:other", unreachable) == (None, None)
+  assert stub_api == [200]
+
+
+def test_cache_is_saved_and_loaded(server, stub_api):
+  server.apiGet("bttv:global", server.BTTV_GLOBAL_EMOTES_URL)
+  server.api_cache.save()
+  loaded = server.APICache(server.api_cache.path, 3600)
+  assert loaded.get("bttv:global") == server.api_cache.get("bttv:global")
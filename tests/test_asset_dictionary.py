@@ -0,0 +1,119 @@
+# Tests of the asset dictionary of the compact message format
+import json
+from conftest import chatMessage
+
+BADGE_A = {1: "a1", 2: "a2"}
+BADGE_B = {1: "b1", 2: "b2"}
+BADGE_C = {1: "c1", 2: "c2"}
+
+
+# Keeps the definitions of a dictionary like an overlay does
+class Overlay():
+  def __init__(self):
+    self.dictionary_id = None
+    self.count = 0
+    self.assets = {}
+
+  def update(self, dictionary):
+    encoded, self.dictionary_id, count = dictionary.encodeMissing(self.dictionary_id, self.count)
+    self.count = count
+    if encoded == b"":
+      return None
+    assets = json.loads(encoded)
+    for asset_id, definition in zip(assets["ids"], assets["defs"]):
+      self.assets[asset_id] = {int(scale): url for scale, url in definition.items()}
+    return assets
+
+
+def test_ids_are_reused_for_the_same_image(server):
+  dictionary = server.AssetDictionary(10)
+  assert dictionary.assetID(BADGE_A) == 0
+  assert dictionary.assetID(BADGE_B) == 1
+  assert dictionary.assetID(dict(reversed(BADGE_A.items()))) == 0
+  overlay = Overlay()
+  assert overlay.update(dictionary)["ids"] == [0, 1]
+  assert overlay.assets == {0: BADGE_A, 1: BADGE_B}
+  # Only new definitions are sent after that
+  assert overlay.update(dictionary) == None
+  dictionary.assetID(BADGE_C)
+  assert overlay.update(dictionary)["ids"] == [2]
+
+
+def test_full_dictionary_defines_least_recently_used_id_again(server):
+  dictionary = server.AssetDictionary(2)
+  overlay = Overlay()
+  dictionary.assetID(BADGE_A)
+  before_b = dictionary.stamp()
+  dictionary.assetID(BADGE_B)
+  after_b = dictionary.stamp()
+  overlay.update(dictionary)
+  dictionary.assetID(BADGE_A)
+  assert dictionary.assetID(BADGE_C) == 1
+  assert dictionary.stats()["redefined"] == 1
+  assert overlay.update(dictionary)["ids"] == [1]
+  assert overlay.assets == {0: BADGE_A, 1: BADGE_C}
+  # Messages encoded before B was last used may refer to it, the ones after can't
+  assert not dictionary.isCurrent(before_b)
+  assert dictionary.isCurrent(after_b)
+
+
+def test_dictionary_starts_over_once_changes_pile_up(server):
+  dictionary = server.AssetDictionary(2)
+  overlay = Overlay()
+  dictionary.assetID(BADGE_A)
+  overlay.update(dictionary)
+  first_id = dictionary.id
+  for i in range(4):
+    dictionary.assetID({1: f"new{i}"})
+  assert dictionary.id != first_id
+  assert dictionary.stats()["changes"] == 2
+  # Overlays of the old dictionary get all current definitions
+  assert overlay.update(dictionary)["ids"] == [0, 1]
+  assert overlay.assets == {0: {1: "new3"}, 1: {1: "new2"}}
+
+
+def test_queue_encodes_messages_again_once_their_ids_were_defined_again(server, make_queue, monkeypatch):
+  monkeypatch.setattr(server, "asset_dictionary", server.AssetDictionary(2))
+  queue = make_queue(10)
+  options = server.OverlayOptions()
+  options.compact = True
+  overlay = Overlay()
+  queue.addMessages([chatMessage("m0", badges=[BADGE_A])])
+  first = json.loads(queue.getNewBatch(-1, 0, options).messages[0])
+  overlay.update(server.asset_dictionary)
+  assert overlay.assets[first["badges"][0]] == BADGE_A
+  # B and C take both IDs, so A gets another one when the first message is sent again
+  queue.addMessages([chatMessage("m1", badges=[BADGE_B])])
+  queue.getNewBatch(0, 0, options)
+  queue.addMessages([chatMessage("m2", badges=[BADGE_C])])
+  queue.getNewBatch(1, 0, options)
+  again = json.loads(queue.getNewBatch(-1, 0, options, 1).messages[0])
+  overlay.update(server.asset_dictionary)
+  assert overlay.assets[again["badges"][0]] == BADGE_A
+
+
+def test_least_recently_used_ids_are_freed_together(server):
+  dictionary = server.AssetDictionary(16)
+  for i in range(16):
+    dictionary.assetID({1: f"old{i}"})
+  # Keep the first image in use, so the next least recently used ones are freed
+  dictionary.assetID({1: "old0"})
+  assert dictionary.assetID({1: "new0"}) == 1
+  assert dictionary.assetID({1: "new1"}) == 2
+  assert dictionary.assetID({1: "old0"}) == 0
+  assert dictionary.stats()["redefined"] == 2
+
+
+def test_remembered_image_is_defined_again_once_its_id_was_freed(server):
+  dictionary = server.AssetDictionary(2)
+  assert dictionary.assetID(BADGE_A) == 0
+  assert dictionary.assetID(BADGE_B) == 1
+  dictionary.assetID(BADGE_A)
+  # C takes the ID of B, so the same dict of B gets another ID instead of the one it had
+  assert dictionary.assetID(BADGE_C) == 1
+  assert dictionary.assetID(BADGE_B) == 0
+  overlay = Overlay()
+  overlay.update(dictionary)
+  assert overlay.assets == {0: BADGE_B, 1: BADGE_C}
+  dictionary.forgetObjects()
+  assert dictionary.assetID(BADGE_C) == 1
@@ -0,0 +1,77 @@
+# Tests of how long-polling clients get their new messages batched
+import asyncio, time
+from threading import Thread
+from conftest import chatMessage
+
+
+def mids(batch):
+  return list(range(batch.last_message_id + 1 - len(batch.messages), batch.last_message_id + 1))
+
+
+# Adds messages to a queue from another thread, waiting the given seconds before each one
+def addLater(queue, delays):
+  def add():
+    for delay in delays:
+      time.sleep(delay)
+      queue.addMessages([chatMessage("later")])
+  thread = Thread(target=add)
+  thread.start()
+  return thread
+
+
+def test_default_policy_sends_first_messages(server, make_queue):
+  queue = make_queue(50)
+  thread = addLater(queue, [0.05, 0.05])
+  batch = server.getCoalescedBatch(queue, -1, 5, server.BatchPolicy())
+  thread.join()
+  assert mids(batch) == [0]
+
+
+def test_backlog_is_sent_right_away(server, make_queue):
+  queue = make_queue(50)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  policy = server.BatchPolicy({"batch_min": "10", "batch_delay": "5000"})
+  started_at = time.monotonic()
+  batch = server.getCoalescedBatch(queue, -1, 5, policy)
+  assert time.monotonic() - started_at < 1
+  assert mids(batch) == [0, 1, 2]
+
+
+def test_new_messages_wait_for_min_messages(server, make_queue):
+  queue = make_queue(50)
+  thread = addLater(queue, [0.05] * 4)
+  policy = server.BatchPolicy({"batch_min": "3", "batch_delay": "5000"})
+  batch = server.getCoalescedBatch(queue, None, 5, policy)
+  thread.join()
+  assert len(batch.messages) >= 3
+
+
+def test_new_messages_wait_at_most_max_delay(server, make_queue):
+  queue = make_queue(50)
+  thread = addLater(queue, [0.05, 1])
+  policy = server.BatchPolicy({"batch_min": "10", "batch_delay": "200"})
+  started_at = time.monotonic()
+  batch = server.getCoalescedBatch(queue, -1, 5, policy)
+  assert 0.2 <= time.monotonic() - started_at < 1
+  assert mids(batch) == [0]
+  thread.join()
+
+
+def test_max_messages_limits_backlog(server, make_queue):
+  queue = make_queue(50)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(5)])
+  batch = server.getCoalescedBatch(queue, -1, 5, server.BatchPolicy({"batch_max": "2"}))
+  assert mids(batch) == [0, 1]
+  batch = server.getCoalescedBatch(queue, batch.last_message_id, 5, server.BatchPolicy({"batch_max": "2"}))
+  assert mids(batch) == [2, 3]
+
+
+def test_asyncio_clients_are_batched_the_same(server, make_queue):
+  queue = make_queue(50)
+  policy = server.BatchPolicy({"batch_min": "3", "batch_delay": "5000"})
+  queue.addMessages([chatMessage("m0")])
+  assert mids(asyncio.run(server.getCoalescedBatchAsync(queue, -1, 5, policy))) == [0]
+  thread = addLater(queue, [0.05] * 4)
+  batch = asyncio.run(server.getCoalescedBatchAsync(queue, 0, 5, policy))
+  thread.join()
+  assert len(batch.messages) >= 3 and mids(batch)[0] == 1
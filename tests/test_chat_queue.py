@@ -0,0 +1,233 @@
+# Tests of the ring buffer chat queues
+import json, time
+from threading import Event, Thread
+from conftest import chatMessage
+
+
+def mids(messages):
+  return [msg["mid"] for msg in messages]
+
+
+def test_full_queue_evicts_oldest(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(8)])
+  assert mids(queue.getNewMessages(-1, timeout=0)) == [3, 4, 5, 6, 7]
+  assert [msg["message"] for msg in queue.getNewMessages(-1, timeout=0)] == ["m3", "m4", "m5", "m6", "m7"]
+  assert queue.posOfMID(2) == -1
+  assert queue.posOfMID(3) == 0
+  assert queue.posOfMID(8) == None
+
+
+def test_reads_wrap_around_the_ring(make_queue):
+  queue = make_queue(4)
+  for i in range(11):
+    queue.addMessages([chatMessage(f"m{i}")])
+  # Slots of the remaining messages wrap around the end of the buffer
+  assert mids(queue.getNewMessages(7, timeout=0)) == [8, 9, 10]
+  assert mids(queue.getNewMessages(6, timeout=0)) == [7, 8, 9, 10]
+
+
+def test_evicted_mid_continues_from_oldest(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(12)])
+  # Client fell behind, so it gets everything that's still there
+  assert mids(queue.getNewMessages(2, timeout=0)) == [7, 8, 9, 10, 11]
+
+
+def test_unknown_mid_ignores_existing_messages(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  # Message IDs that weren't handed out yet, or no ID at all, only get messages added from now on
+  assert queue.getNewMessages(100, timeout=0) == []
+  assert queue.getNewMessages(None, timeout=0) == []
+  assert queue.getNewMessages(-5, timeout=0) == []
+
+
+def test_expired_messages_are_not_returned(server, make_queue, monkeypatch):
+  queue = make_queue(10)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 0.2)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  assert mids(queue.getNewMessages(-1, timeout=0)) == [0, 1, 2]
+  time.sleep(0.3)
+  assert queue.getNewMessages(-1, timeout=0) == []
+  assert queue.posOfMID(1) == -1
+
+
+def test_expired_mid_continues_with_new_messages(server, make_queue, monkeypatch):
+  queue = make_queue(10)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 0.2)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  time.sleep(0.3)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  queue.addMessages([chatMessage("new")])
+  # Message 1 expired, but the client still gets what came after it, and nothing expired
+  assert mids(queue.getNewMessages(1, timeout=0)) == [3]
+  assert mids(queue.getNewMessages(-1, timeout=0)) == [3]
+
+
+def test_reader_times_out_without_new_messages(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage("old")])
+  started = time.monotonic()
+  assert queue.getNewMessages(0, timeout=0.2) == []
+  assert time.monotonic() - started >= 0.15
+
+
+def test_waiting_reader_gets_new_messages(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage("old")])
+  Thread(target=lambda: (time.sleep(0.1), queue.addMessages([chatMessage("new")])), daemon=True).start()
+  assert [msg["message"] for msg in queue.getNewMessages(0, timeout=5)] == ["new"]
+
+
+def test_every_waiting_reader_is_woken_up(make_queue):
+  queue = make_queue(5)
+  queue.addMessages([chatMessage("old")])
+  results = []
+  readers = [Thread(target=lambda: results.append(queue.getNewBatch(0, timeout=5))) for i in range(20)]
+  for reader in readers:
+    reader.start()
+  time.sleep(0.2)
+  queue.addMessages([chatMessage("new")])
+  for reader in readers:
+    reader.join()
+  assert len(results) == 20 and all(len(batch.messages) == 1 for batch in results)
+
+
+def test_reader_leaving_after_its_turn_wakes_up_the_next_one(server):
+  batch = server.MessageBatch((0, None, None, None))
+  first, second = Event(), Event()
+  batch.addWaiter(first)
+  batch.addWaiter(second)
+  batch.complete(1, (b"{}",), (server.MESSAGE_ENTRY,))
+  assert first.is_set() and not second.is_set()
+  # As if the first reader timed out right as the batch was completed
+  batch.removeWaiter(first)
+  assert second.is_set()
+
+
+# Waits for a message in a process forked from the one adding messages, and reports how long that took
+# and whether the thread watching for new messages stopped once nothing waited anymore
+def waitInOtherProcess(queue, connection):
+  started = time.monotonic()
+  batch = queue.getNewBatch(None, timeout=10)
+  waited = time.monotonic() - started
+  time.sleep(0.2)
+  connection.send((len(batch.messages), waited, queue.watching))
+  # Nothing is added while this waits, so it times out
+  queue.getNewBatch(None, timeout=0.2)
+  time.sleep(0.2)
+  connection.send(queue.watching)
+
+
+def test_other_process_is_woken_up_by_writer(server, monkeypatch):
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  queue = server.SharedChatQueue(10, 100000)
+  try:
+    receiver, sender = server.process_context.Pipe(duplex=False)
+    reader = server.process_context.Process(target=waitInOtherProcess, args=(queue, sender))
+    reader.start()
+    time.sleep(0.5)
+    queue.addMessages([chatMessage("new")])
+    assert receiver.poll(5)
+    count, waited, watching = receiver.recv()
+    assert count == 1
+    assert waited < 1
+    assert not watching
+    assert receiver.poll(5)
+    assert receiver.recv() == False
+    # The writer process wakes up its own readers, without watching
+    assert queue.getNewBatch(None, timeout=0.1).messages == ()
+    assert not queue.watching
+    reader.join(5)
+    # Pipes of stopped processes are let go of when messages are added
+    queue.addMessages([chatMessage("after")])
+    assert queue.watcher_pipes == []
+  finally:
+    queue.close()
+
+
+# Deletes what a CLEARMSG or CLEARCHAT command received from Twitch deletes
+def moderate(server, queue, raw_message):
+  queue.deleteMessages(*server.moderationTarget(server.parsedIRCMessage(raw_message)))
+
+
+def addChatters(queue):
+  queue.addMessages([chatMessage(f"m{i}", id=f"msg-{i}", user_id=f"user-{i % 2}") for i in range(4)])
+
+
+def test_clearmsg_replaces_message_with_tombstone(server, make_queue):
+  queue = make_queue(10)
+  addChatters(queue)
+  moderate(server, queue, "@login=tester;target-msg-id=msg-1 :tmi.twitch.tv CLEARMSG #channel :m1\r\n")
+  messages = queue.getNewMessages(-1, timeout=0)
+  assert [msg.get("deleted", False) for msg in messages[:4]] == [False, True, False, False]
+  assert messages[1] == {"mid": 1, "timestamp": messages[1]["timestamp"], "deleted": True}
+  # Overlays that already show it remove it when they get the deletion entry
+  assert messages[4]["delete"] == [1] and messages[4]["mid"] == 4
+  batch = queue.getNewBatch(-1, timeout=0)
+  assert batch.kinds == (server.MESSAGE_ENTRY, server.TOMBSTONE_ENTRY, server.MESSAGE_ENTRY, server.MESSAGE_ENTRY, server.DELETION_ENTRY)
+
+
+def test_clearchat_of_user_replaces_their_messages_with_tombstones(server, make_queue):
+  queue = make_queue(10)
+  addChatters(queue)
+  moderate(server, queue, "@ban-duration=600;target-user-id=user-0 :tmi.twitch.tv CLEARCHAT #channel :tester\r\n")
+  messages = queue.getNewMessages(-1, timeout=0)
+  assert [msg.get("deleted", False) for msg in messages[:4]] == [True, False, True, False]
+  assert messages[4]["delete"] == [0, 2]
+
+
+def test_clearchat_replaces_all_messages_with_tombstones(server, make_queue):
+  queue = make_queue(10)
+  addChatters(queue)
+  moderate(server, queue, "@login=tester;target-msg-id=msg-1 :tmi.twitch.tv CLEARMSG #channel :m1\r\n")
+  moderate(server, queue, "@room-id=1;tmi-sent-ts=1 :tmi.twitch.tv CLEARCHAT #channel\r\n")
+  # Messages stay in queue as tombstones, so clients continue from their message IDs, and the earlier deletion entry is kept too
+  assert queue.posOfMID(0) == 0
+  messages = queue.getNewMessages(-1, timeout=0)
+  assert mids(messages) == [0, 1, 2, 3, 4, 5]
+  assert [msg.get("deleted", False) for msg in messages[:4]] == [True, True, True, True]
+  assert messages[4]["delete"] == [1]
+  assert messages[5]["clear"] == True
+  # Cleared messages can't be deleted again
+  moderate(server, queue, "@login=tester;target-msg-id=msg-2 :tmi.twitch.tv CLEARMSG #channel :m2\r\n")
+  assert queue.getNewMessages(5, timeout=0) == []
+  queue.addMessages([chatMessage("m6")])
+  assert [msg["message"] for msg in queue.getNewMessages(5, timeout=0)] == ["m6"]
+
+
+def test_deletions_skipped_for_room_are_still_sent(server, make_queue):
+  queue = make_queue(20)
+  addChatters(queue)
+  moderate(server, queue, "@room-id=1;tmi-sent-ts=1 :tmi.twitch.tv CLEARCHAT #channel\r\n")
+  queue.addMessages([chatMessage(f"n{i}") for i in range(3)])
+  overlay_options = server.OverlayOptions()
+  overlay_options.message_count_max = 2
+  batch = queue.getNewBatch(-1, timeout=0, overlay_options=overlay_options)
+  assert batch.kinds == (server.DELETION_ENTRY, server.MESSAGE_ENTRY, server.MESSAGE_ENTRY)
+  assert b'"clear": true' in batch.messages[0]
+
+
+def test_skipped_deletions_are_found_after_older_ones_left_the_queue(server, make_queue):
+  queue = make_queue(6)
+  # More deletion entries than the queue has room for, so the oldest ones leave it
+  for i in range(10):
+    queue.addMessages([chatMessage(f"m{i}", id=f"msg-{i}", user_id="user")])
+    moderate(server, queue, f"@login=tester;target-msg-id=msg-{i} :tmi.twitch.tv CLEARMSG #channel :m{i}\r\n")
+  queue.addMessages([chatMessage(f"n{i}") for i in range(2)])
+  overlay_options = server.OverlayOptions()
+  overlay_options.message_count_max = 2
+  batch = queue.getNewBatch(-1, timeout=0, overlay_options=overlay_options)
+  # Of the 4 skipped entries in queue, the deletions of m8 and m9 are sent
+  assert batch.kinds == (server.DELETION_ENTRY, server.DELETION_ENTRY, server.MESSAGE_ENTRY, server.MESSAGE_ENTRY)
+  assert [json.loads(entry)["delete"] for entry in batch.messages[:2]] == [[16], [18]]
+
+
+def test_rate_sampler_keeps_deletions_and_drops_tombstones(server):
+  kinds = [server.MESSAGE_ENTRY, server.TOMBSTONE_ENTRY, server.MESSAGE_ENTRY, server.DELETION_ENTRY, server.MESSAGE_ENTRY]
+  messages = [f"entry{i}".encode() for i in range(len(kinds))]
+  picked, picked_kinds, dropped = server.RateSampler().sample(messages, kinds, 1)
+  assert picked == [b"entry3", b"entry4"]
+  assert picked_kinds == [server.DELETION_ENTRY, server.MESSAGE_ENTRY]
+  assert dropped == 2
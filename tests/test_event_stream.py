@@ -0,0 +1,64 @@
+# Tests of resuming Server-Sent Event streams with Last-Event-ID
+import json
+import pytest
+from conftest import chatMessage
+
+
+@pytest.fixture
+def channel(server, make_queue, monkeypatch):
+  channel = server.ChatChannel("tester", make_queue(50))
+  monkeypatch.setattr(server, "chat_channels", {"tester": channel})
+  monkeypatch.setattr(server, "CHANNELS", ["tester"])
+  monkeypatch.setattr(server, "LOCAL_PORT", 8080)
+  return channel
+
+
+# Waits for the next batch of an event stream, and splits the event it sends into its ID and message IDs
+def nextEvent(server, route):
+  batch = route.channel.queue.getNewBatch(message_id=route.message_id, timeout=0, overlay_options=route.options)
+  event = route.streamChunk(batch, server.messagesEvent, server.SSE_KEEP_ALIVE, None)
+  if event == server.SSE_KEEP_ALIVE:
+    return None, []
+  id_line, data_line = event.decode('utf-8').strip().split('\n')
+  return id_line.removeprefix("id: "), [msg["mid"] for msg in json.loads(data_line.removeprefix("data: "))["messages"]]
+
+
+def test_stream_resumes_after_last_event_id(server, channel):
+  channel.queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  route = server.routeHTTPRequest("GET", f"/events?sid={server.SESSION_ID}&mid=0", {})
+  assert route.kind == "events"
+  assert route.body == server.SSE_STREAM_START
+  event_id, mids = nextEvent(server, route)
+  assert mids == [1, 2]
+  assert event_id == f"{server.SESSION_ID}:2"
+
+  # Client reconnects with the ID of the last event it got, and only gets what it missed
+  channel.queue.addMessages([chatMessage(f"m{i}") for i in range(3, 5)])
+  route = server.routeHTTPRequest("GET", "/events", {"last-event-id": event_id})
+  assert route.message_id == 2
+  event_id, mids = nextEvent(server, route)
+  assert mids == [3, 4]
+  assert event_id == f"{server.SESSION_ID}:4"
+  assert nextEvent(server, route) == (None, [])
+
+
+def test_last_event_id_overrides_query(server, channel):
+  channel.queue.addMessages([chatMessage(f"m{i}") for i in range(5)])
+  route = server.routeHTTPRequest("GET", f"/events?sid={server.SESSION_ID}&mid=0", {"last-event-id": f"{server.SESSION_ID}:3"})
+  assert nextEvent(server, route)[1] == [4]
+
+
+def test_last_event_id_of_another_session_ignores_existing_messages(server, channel):
+  channel.queue.addMessages([chatMessage(f"m{i}") for i in range(5)])
+  route = server.routeHTTPRequest("GET", "/events", {"last-event-id": "1234:3"})
+  assert route.message_id == None
+  assert nextEvent(server, route) == (None, [])
+  channel.queue.addMessages([chatMessage("new")])
+  assert nextEvent(server, route)[1] == [5]
+
+
+def test_malformed_last_event_id_falls_back_to_query(server, channel):
+  channel.queue.addMessages([chatMessage(f"m{i}") for i in range(5)])
+  route = server.routeHTTPRequest("GET", f"/events?sid={server.SESSION_ID}&mid=2", {"last-event-id": "garbage"})
+  assert route.message_id == 2
+  assert nextEvent(server, route)[1] == [3, 4]
@@ -0,0 +1,87 @@
+# Tests of the ingest pipeline turning raw chat lines into messages in the chat queues
+import pytest
+from threading import Event, Thread
+
+
+def privmsg(channel, number):
+  return f"@badges=vip/1;color=#00FF00;display-name=Tester;emotes=;id=msg-{number};user-id=42 :tester!tester@tester.tmi.twitch.tv PRIVMSG #{channel} :message {number}\r\n"
+
+
+@pytest.fixture(params=["thread", "process"])
+def pipeline(request, server, monkeypatch):
+  monkeypatch.setattr(server, "INGEST_POOL", request.param)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  channels = {}
+  for name in ["one", "two"]:
+    channels[name] = server.ChatChannel(name, server.ChatQueue(100))
+    channels[name].setTables({"vip": {"1": f"{name}-vip-v1"}}, server.EmoteIndex({}, {}))
+  pipeline = server.IngestPipeline(channels)
+  yield pipeline
+  pipeline.close()
+
+
+# Waits for the messages pushed so far to reach the chat queue of a channel, and gets their badges
+def badgesOf(pipeline, channel, count):
+  messages = []
+  while len(messages) < count:
+    messages += pipeline.channels[channel].queue.getNewMessages(messages[-1]["mid"] if len(messages) > 0 else -1, timeout=5)
+  return [msg["badges"] for msg in messages]
+
+
+def test_messages_reach_their_channel(pipeline):
+  pipeline.push([privmsg("one", 0), privmsg("two", 1), privmsg("one", 2)])
+  assert badgesOf(pipeline, "one", 2) == [["one-vip-v1"], ["one-vip-v1"]]
+  assert badgesOf(pipeline, "two", 1) == [["two-vip-v1"]]
+
+
+def test_new_tables_apply_to_later_messages_with_same_workers(pipeline):
+  pool = pipeline._pool
+  pipeline.push([privmsg("one", i) for i in range(3)])
+  assert badgesOf(pipeline, "one", 3) == [["one-vip-v1"]] * 3
+  for refresh in range(2, 4):
+    pipeline.channels["one"].setTables({"vip": {"1": f"one-vip-v{refresh}"}}, pipeline.channels["one"].bttv_emotes)
+    pipeline.setTables()
+    pipeline.push([privmsg("one", 10 * refresh + i) for i in range(3)])
+    assert badgesOf(pipeline, "one", 3 * refresh)[-3:] == [[f"one-vip-v{refresh}"]] * 3
+  pipeline.push([privmsg("two", 100)])
+  assert badgesOf(pipeline, "two", 1) == [["two-vip-v1"]]
+  # Workers aren't restarted to pick up the tables
+  assert pipeline._pool is pool
+
+
+# Stands in for the socket wrapper of the IRC connection, keeping the commands sent
+class SentCommands():
+  def __init__(self):
+    self.commands = []
+
+  def sendPrepare(self, command):
+    self.commands.append(command)
+
+
+def test_ping_is_answered_while_enrichment_is_stalled(server, monkeypatch):
+  monkeypatch.setattr(server, "INGEST_POOL", "thread")
+  monkeypatch.setattr(server, "INGEST_QUEUE_SIZE", 1)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  stalled = Event()
+  enrichChatMessages = server.enrichChatMessages
+
+  def stalledEnrichment(channel, fields_list):
+    stalled.wait()
+    return enrichChatMessages(channel, fields_list)
+
+  monkeypatch.setattr(server, "enrichChatMessages", stalledEnrichment)
+  channel = server.ChatChannel("one", server.ChatQueue(100))
+  channel.setTables({"vip": {"1": "one-vip-v1"}}, server.EmoteIndex({}, {}))
+  pipeline = server.IngestPipeline({"one": channel})
+  sock_wrapper = SentCommands()
+  # Far more batches than the pipeline has room for, followed by a PING
+  batches = [[privmsg("one", i)] for i in range(20)] + [["PING :tmi.twitch.tv\r\n"]]
+  reader = Thread(target=lambda: [server.handleIRCLines(batch, sock_wrapper, pipeline, {"one"}) for batch in batches], daemon=True)
+  reader.start()
+  reader.join(5)
+  assert not reader.is_alive()
+  assert sock_wrapper.commands == ["PONG :tmi.twitch.tv"]
+  # Held back lines reach the chat queue once enrichment goes on
+  stalled.set()
+  assert len(badgesOf(pipeline, "one", 20)) == 20
+  pipeline.close()
@@ -0,0 +1,78 @@
+# Tests of parsing IRC messages, and of their lazily split and unescaped tags
+import pytest
+
+PRIVMSG = "@badge-info=;badges=moderator/1;color=#FF0000;display-name=Tester;emotes=;id=abc-123;system-msg=hello\\sthere\\:\\sfriend;flag :tester!tester@tester.tmi.twitch.tv PRIVMSG #channel :hi there\r\n"
+
+
+@pytest.mark.parametrize("escaped, unescaped", [
+  ("plain", "plain"),
+  ("a\\sb", "a b"),
+  ("semi\\:colon", "semi;colon"),
+  ("back\\\\slash", "back\\slash"),
+  ("cr\\rlf\\n", "cr\rlf\n"),
+  ("\\s\\s", "  "),
+  # Unknown escape codes become the escaped character, and a lone backslash at the end is dropped
+  ("unknown\\x", "unknownx"),
+  ("trailing\\", "trailing"),
+  ("", ""),
+])
+def test_unescape_tag_value(server, escaped, unescaped):
+  assert server.unescapeTagValue(escaped) == unescaped
+
+
+def test_tags_are_only_split_when_used(server):
+  msg = server.parsedIRCMessage(PRIVMSG)
+  assert msg.tags._values == None
+  assert msg.tags["color"] == "#FF0000"
+  assert msg.tags._values != None
+  # Values are kept as received until read
+  assert msg.tags._values["system-msg"] == "hello\\sthere\\:\\sfriend"
+
+
+def test_tag_values_are_unescaped_when_read(server):
+  tags = server.parsedIRCMessage(PRIVMSG).tags
+  assert tags["system-msg"] == "hello there; friend"
+  assert tags._decoded["system-msg"] == "hello there; friend"
+  # Values without escape codes aren't copied
+  assert tags["display-name"] == "Tester"
+  assert not "display-name" in tags._decoded
+
+
+def test_tags_behave_like_dict(server):
+  tags = server.parsedIRCMessage(PRIVMSG).tags
+  assert "id" in tags
+  assert not "missing" in tags
+  assert tags.get("missing", "default") == "default"
+  assert tags["badge-info"] == ""
+  assert tags["flag"] == None
+  with pytest.raises(KeyError):
+    tags["missing"]
+  tags["emotes"] = "parsed"
+  tags["added"] = 1
+  assert tags["emotes"] == "parsed"
+  assert tags.keys() == ["badge-info", "badges", "color", "display-name", "emotes", "id", "system-msg", "flag", "added"]
+  assert dict(tags.items())["system-msg"] == "hello there; friend"
+
+
+def test_message_parts(server):
+  msg = server.parsedIRCMessage(PRIVMSG)
+  assert (msg.nickname, msg.username, msg.server) == ("tester", "tester", "tester.tmi.twitch.tv")
+  assert msg.command == ["PRIVMSG", "#channel"]
+  assert msg.params == "hi there"
+
+
+def test_message_without_trailing_params_keeps_last_argument(server):
+  msg = server.parsedIRCMessage(":tmi.twitch.tv CAP * ACK\r\n")
+  assert msg.tags == None
+  assert msg.server == "tmi.twitch.tv"
+  assert msg.command == ["CAP", "*", "ACK"]
+  assert msg.params == None
+
+
+def test_invalid_messages(server):
+  with pytest.raises(ValueError):
+    server.parsedIRCMessage("@only-tags")
+  with pytest.raises(ValueError):
+    server.parsedIRCMessage(":only-prefix")
+  with pytest.raises(TypeError):
+    server.parsedIRCMessage(b"PING")
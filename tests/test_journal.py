@@ -0,0 +1,130 @@
+# Tests of the chat journal, which restores chat queues after a restart
+import os
+import pytest
+from conftest import chatMessage
+
+
+def mids(messages):
+  return [msg["mid"] for msg in messages]
+
+
+@pytest.fixture
+def journal_config(server, monkeypatch):
+  # Sync on every write, so no sync thread is left running, and rotate after a few messages
+  monkeypatch.setattr(server, "JOURNAL_FSYNC_INTERVAL", 0)
+  monkeypatch.setattr(server, "JOURNAL_SEGMENT_SIZE", 300)
+  monkeypatch.setattr(server, "JOURNAL_SEGMENT_AGE", 3600)
+
+
+# Opens the journal of a queue like the server does on start, restoring the messages that were in it
+def openJournal(server, queue, path):
+  journal = server.ChatJournal(path)
+  encoded_messages, next_message_id = journal.replay(queue.capacity)
+  queue.restoreMessages(encoded_messages, next_message_id)
+  journal.open(next_message_id, next_message_id - len(encoded_messages))
+  queue.journal = journal
+  return journal
+
+
+def segmentIDs(journal):
+  return [first_message_id for first_message_id, name in journal._segments()]
+
+
+def test_replay_across_segment_rotation(server, make_queue, journal_config, tmp_path):
+  queue = make_queue(50)
+  journal = openJournal(server, queue, tmp_path)
+  for i in range(20):
+    queue.addMessages([chatMessage(f"m{i}")])
+  journal.close()
+  assert journal.stats()["rotations"] > 1
+  assert len(segmentIDs(journal)) > 2
+
+  restored = make_queue(50)
+  journal = openJournal(server, restored, tmp_path)
+  assert mids(restored.getNewMessages(-1, timeout=0)) == list(range(20))
+  assert [msg["message"] for msg in restored.getNewMessages(-1, timeout=0)] == [f"m{i}" for i in range(20)]
+  # Message IDs continue from where they left off
+  restored.addMessages([chatMessage("m20")])
+  assert mids(restored.getNewMessages(19, timeout=0)) == [20]
+  journal.close()
+
+
+def test_replay_only_fills_the_queue(server, make_queue, journal_config, tmp_path):
+  queue = make_queue(50)
+  journal = openJournal(server, queue, tmp_path)
+  for i in range(20):
+    queue.addMessages([chatMessage(f"m{i}")])
+  journal.close()
+
+  restored = make_queue(6)
+  journal = openJournal(server, restored, tmp_path)
+  assert mids(restored.getNewMessages(-1, timeout=0)) == list(range(14, 20))
+  journal.close()
+
+
+def test_partly_written_message_is_skipped(server, make_queue, journal_config, tmp_path):
+  queue = make_queue(50)
+  journal = openJournal(server, queue, tmp_path)
+  queue.addMessages([chatMessage(f"m{i}") for i in range(3)])
+  journal.close()
+  with open(os.path.join(tmp_path, journal._segments()[-1][1]), 'ab') as segment:
+    segment.write(b'{"mid": 3, "timestamp"')
+
+  restored = make_queue(50)
+  journal = openJournal(server, restored, tmp_path)
+  assert mids(restored.getNewMessages(-1, timeout=0)) == [0, 1, 2]
+  journal.close()
+
+
+def test_expired_messages_are_not_replayed(server, make_queue, journal_config, tmp_path, monkeypatch):
+  queue = make_queue(50)
+  journal = openJournal(server, queue, tmp_path)
+  queue.addMessages([chatMessage(f"m{i}", timestamp=0) for i in range(3)])
+  journal.close()
+
+  restored = make_queue(50)
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 0)
+  journal = openJournal(server, restored, tmp_path)
+  assert restored.getNewMessages(-1, timeout=0) == []
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", 3600)
+  # Message IDs still continue, so overlays don't mistake new messages for ones they've seen
+  restored.addMessages([chatMessage("m3")])
+  assert mids(restored.getNewMessages(2, timeout=0)) == [3]
+  journal.close()
+
+
+def test_segments_are_removed_once_their_messages_left_the_queue(server, make_queue, journal_config, tmp_path):
+  queue = make_queue(5)
+  journal = openJournal(server, queue, tmp_path)
+  rotations = 0
+  for i in range(40):
+    queue.addMessages([chatMessage(f"m{i}")])
+    if journal.stats()["rotations"] == rotations:
+      continue
+    rotations = journal.stats()["rotations"]
+    # Right after starting a segment, only the one holding the oldest message in the queue, and the ones after it, are kept
+    segments = segmentIDs(journal)
+    assert len([first_message_id for first_message_id in segments if first_message_id <= queue.oldest_message_id]) <= 1
+  assert rotations > 3
+  assert segmentIDs(journal)[0] > 0
+  journal.close()
+
+  restored = make_queue(5)
+  journal = openJournal(server, restored, tmp_path)
+  assert mids(restored.getNewMessages(-1, timeout=0)) == list(range(35, 40))
+  journal.close()
+
+
+def test_session_is_kept_while_journal_has_messages(server, make_queue, journal_config, tmp_path, monkeypatch):
+  monkeypatch.setattr(server, "SESSION_ID", "first")
+  assert server.journalSessionID(tmp_path, ["channel"]) == "first"
+  queue = make_queue(50)
+  journal = openJournal(server, queue, os.path.join(tmp_path, "channel"))
+  queue.addMessages([chatMessage("m0")])
+  journal.close()
+
+  monkeypatch.setattr(server, "SESSION_ID", "second")
+  assert server.journalSessionID(tmp_path, ["channel"]) == "first"
+  # Once every message expired there's nothing to continue from, so a new session starts
+  monkeypatch.setattr(server, "QUEUE_MSG_TIMEOUT", -10)
+  assert server.journalSessionID(tmp_path, ["channel"]) == "second"
@@ -0,0 +1,135 @@
+# Tests of WebSocket framing, and of handling the frames overlays send
+import os, struct, time
+from threading import Thread
+from conftest import chatMessage
+
+
+# Builds a short frame like browsers send it, with a masked payload
+# Returns a tuple of the frame without its mask, and the mask
+def clientFrame(server, opcode, payload, fin=True, mask=b"\x12\x34\x56\x78"):
+  assert len(payload) < 126
+  header = bytes([(0x80 if fin else 0) | opcode, 0x80 | len(payload)])
+  return header + server.unmaskWebSocketPayload(payload, mask), mask
+
+
+# Reads a client frame the way the HTTP servers do, and passes it to the receiver
+def receive(server, receiver, frame, mask):
+  fin, opcode, masked, length = server.parseWebSocketFrameHeader(frame[:2])
+  reply = receiver.checkFrame(masked, length)
+  if reply == None:
+    reply = receiver.handleFrame(fin, opcode, server.unmaskWebSocketPayload(frame[2:], mask))
+  return reply
+
+
+def closeCode(frame):
+  assert frame[0] == 0x80 | 0x8
+  return struct.unpack("!H", frame[2:4])[0]
+
+
+def test_frame_lengths(server):
+  for length, header_length in [(0, 2), (125, 2), (126, 4), (65535, 4), (65536, 10)]:
+    frame = server.encodeWebSocketFrame(server.WS_BINARY, b"x" * length)
+    fin, opcode, masked, short_length = server.parseWebSocketFrameHeader(frame[:2])
+    assert (fin, opcode, masked) == (True, server.WS_BINARY, False)
+    if short_length == 126:
+      short_length = struct.unpack("!H", frame[2:4])[0]
+    elif short_length == 127:
+      short_length = struct.unpack("!Q", frame[2:10])[0]
+    assert short_length == length
+    assert len(frame) == header_length + length
+
+
+def test_unmasking(server):
+  payload = os.urandom(37)
+  mask = b"\xA1\xB2\xC3\xD4"
+  masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+  assert server.unmaskWebSocketPayload(masked, mask) == payload
+  assert server.unmaskWebSocketPayload(b"", mask) == b""
+
+
+def test_unmasked_frame_is_refused(server):
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  fin, opcode, masked, length = server.parseWebSocketFrameHeader(server.encodeWebSocketFrame(server.WS_TEXT, b"{}")[:2])
+  assert closeCode(receiver.checkFrame(masked, length)) == 1002
+  assert receiver.closed
+
+
+def test_continuation_frames_update_options(server):
+  options = server.OverlayOptions()
+  receiver = server.WebSocketReceiver(options)
+  payload = b'{"message_count_max": 7, "scale": 2}'
+  assert receive(server, receiver, *clientFrame(server, server.WS_TEXT, payload[:10], fin=False)) == None
+  assert options.message_count_max != 7
+  assert receive(server, receiver, *clientFrame(server, server.WS_CONTINUATION, payload[10:20], fin=False)) == None
+  assert receive(server, receiver, *clientFrame(server, server.WS_CONTINUATION, payload[20:])) == None
+  assert options.message_count_max == 7
+  assert options.scale == 2
+  assert not receiver.closed
+
+
+def test_fragmented_message_over_limit_is_refused(server, monkeypatch):
+  monkeypatch.setattr(server, "WS_MAX_INCOMING_MESSAGE", 100)
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  for i in range(2):
+    assert receive(server, receiver, *clientFrame(server, server.WS_CONTINUATION if i > 0 else server.WS_TEXT, b" " * 40, fin=False)) == None
+  # Every frame fits, but the message doesn't
+  assert closeCode(receive(server, receiver, *clientFrame(server, server.WS_CONTINUATION, b" " * 40))) == 1009
+  assert receiver.closed
+
+
+def test_completed_messages_dont_count_towards_limit(server, monkeypatch):
+  monkeypatch.setattr(server, "WS_MAX_INCOMING_MESSAGE", 100)
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  for i in range(5):
+    assert receive(server, receiver, *clientFrame(server, server.WS_TEXT, b'{"scale": 1}' + b" " * 50)) == None
+  assert not receiver.closed
+
+
+def test_ping_gets_pong(server):
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  assert receive(server, receiver, *clientFrame(server, server.WS_PING, b"hi")) == server.encodeWebSocketFrame(server.WS_PONG, b"hi")
+  assert not receiver.closed
+
+
+def test_close_is_echoed(server):
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  assert closeCode(receive(server, receiver, *clientFrame(server, server.WS_CLOSE, struct.pack("!H", 1001) + b"bye"))) == 1001
+  assert receiver.closed
+  assert receiver.wakeup.is_set()
+
+
+def test_close_wakes_up_waiting_pusher(server, make_queue):
+  queue = make_queue(10)
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  result = []
+
+  def push():
+    start = time.monotonic()
+    batch = queue.getNewBatch(message_id=None, timeout=30, overlay_options=receiver.overlay_options, wakeup=receiver.wakeup)
+    result.append((batch.messages, time.monotonic() - start))
+
+  pusher = Thread(target=push)
+  pusher.start()
+  time.sleep(0.2)
+  receive(server, receiver, *clientFrame(server, server.WS_CLOSE, struct.pack("!H", 1000)))
+  pusher.join(5)
+  assert not pusher.is_alive()
+  messages, waited = result[0]
+  assert len(messages) == 0
+  assert waited < 5
+  # Messages added later still reach other clients
+  queue.addMessages([chatMessage("after")])
+  assert len(queue.getNewBatch(message_id=-1, timeout=0).messages) == 1
+
+
+def test_new_messages_still_wake_up_pusher(server, make_queue):
+  queue = make_queue(10)
+  receiver = server.WebSocketReceiver(server.OverlayOptions())
+  result = []
+  pusher = Thread(target=lambda: result.append(queue.getNewBatch(message_id=None, timeout=30, wakeup=receiver.wakeup)))
+  pusher.start()
+  time.sleep(0.2)
+  queue.addMessages([chatMessage("new")])
+  pusher.join(5)
+  assert len(result[0].messages) == 1
+  assert not receiver.closed